@@ -37,6 +37,49 @@ def alert(text):
     flip()
 
 
+def cache_messages(messages, style='default', align='left', wrap_width=None):
+    """Renders a list of messages ahead of time so they can be shown later without
+    any rendering delay.
+
+    Rendered text is cached automatically, so showing the same message again with
+    :func:`message` is usually fast. However, the cache only holds a limited amount
+    of text (``P.text_cache_size`` MB), so messages shown rarely (e.g. block break
+    prompts) may need to be rendered again if lots of other text (e.g. a countdown
+    timer) has been rendered in the meantime. Messages cached with this function are
+    always kept, so calling it during ``setup()`` ensures that no text needs to be
+    rendered during trials::
+
+       def setup(self):
+           cache_messages(["Press space to continue.", "Too slow!", "Incorrect!"])
+
+    Note that cached messages must be rendered with exactly the same text, style,
+    alignment, and wrap width in order to be reused.
+
+    Args:
+        messages (list): The strings of text to render and cache.
+        style (str or :obj:`~klibs.KLText.TextStyle`, optional): The text style to use
+            for rendering the messages. Defaults to the 'default' style if not specified.
+        align (str, optional): The alignment method for multi-line text. Can be "left"
+            (left-justified, default), "right" (right-justified), or "center".
+        wrap_width (int, optional): The maximum width (in pixels) of the rendered text
+            surfaces. Defaults to None (no text wrapping).
+
+    Returns:
+        int: The number of messages cached. This will be less than the number of
+        messages given if there isn't enough room in the text cache for all of them.
+
+    """
+    from klibs.KLEnvironment import txtm
+
+    if not isinstance(style, TextStyle):
+        if style not in txtm.styles.keys():
+            e = "No text style with the name '{0}' has been added to the klibs runtime."
+            raise RuntimeError(e.format(style))
+        style = txtm.styles[style]
+
+    return txtm.preload(messages, style, align, wrap_width)
+
+
 def collect_demographics(anonymous=False):
     '''Collects participant demographics and writes them to the 'participants' table in the
     experiment's database, based on the queries in the "demographic" section of the project's
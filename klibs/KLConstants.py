@@ -116,6 +116,7 @@ DB_INTERNAL_TABLES = [
     'sqlite_sequence',
     'session_info',
     'export_history',
+    'frame_stats',
 ]
 
 # AudioResponse Constants
@@ -2,13 +2,23 @@ __author__ = 'Jonathan Mulle & Austin Hurst'
 
 import os
 import io
+import re
+import json
 import time
+import random
 import socket
 import shutil
 import sqlite3
 import tempfile
+import multiprocessing
 from copy import copy
+from glob import glob
+from itertools import groupby, repeat
+from functools import lru_cache
 from collections import OrderedDict
+from urllib.request import pathname2url
+
+import numpy as np
 
 from klibs.KLEnvironment import EnvAgent
 from klibs.KLConstants import (
@@ -18,7 +28,8 @@ from klibs.KLConstants import (
     QUERY_SEL, TAB, DB_INTERNAL_TABLES,
 )
 from klibs import P
-from klibs.KLInternal import full_trace, iterable, utf8
+from klibs.KLInternal import full_trace, iterable, utf8, package_available
+from klibs.KLInternal import colored_stdout as cso
 from klibs.KLRuntimeInfo import session_info_schema
 
 
@@ -27,7 +38,22 @@ CREATE TABLE export_history (
     id integer primary key autoincrement not null,
     participant_id integer not null references participants(id),
     table_name text not null,
-    timestamp float not null
+    timestamp float not null,
+    last_row_id integer
+)"""
+
+frame_stats_schema = """
+CREATE TABLE frame_stats (
+    id integer primary key autoincrement not null,
+    participant_id integer not null references participants(id),
+    trial_id integer not null,
+    block_num integer not null,
+    trial_num integer not null,
+    flips integer not null,
+    mean_interval float,
+    max_interval float,
+    max_swap float,
+    dropped integer not null
 )"""
 
 
@@ -43,29 +69,82 @@ def _set_type_conversions(export=False):
         sqlite3.register_converter("BOOLEAN", lambda x: bool(int(x)))
 
 
+def _as_bool(value):
+    # convert to int because sqlite3 has no native boolean type
+    value = str(value).lower()
+    if value in ('true', '1'):
+        return 1
+    elif value in ('false', '0'):
+        return 0
+    raise TypeError
+
+
+def _as_str(value):
+    value = str(value)
+    # convert true/false to uppercase for R
+    if value.lower() in ('true', 'false'):
+        value = value.upper()
+    return value
+
+
+def _as_bin(value):
+    raise NotImplementedError("SQL blob insertion is not supported.")
+
+
+def _as_is(value):
+    return value
+
+
+_column_coercers = {
+    PY_BOOL: _as_bool,
+    PY_FLOAT: float,
+    PY_INT: int,
+    PY_STR: _as_str,
+    PY_BIN: _as_bin,
+}
+
+
 def _as_column_type(value, col_type):
     # Coerces a value to the correct type for a given database column
-    if col_type == PY_BOOL:
-        # convert to int because sqlite3 has no native boolean type
-        if utf8(value).lower() in ['true', '1']: value = 1
-        elif utf8(value).lower() in ['false', '0']: value = 0
-        else: raise TypeError
-    elif col_type == PY_FLOAT:
-        value = float(value)
-    elif col_type == PY_INT:
-        value = int(value)
-    elif col_type == PY_STR:
-        value = utf8(value)
-        # convert true/false to uppercase for R
-        if value.lower() in ['true', 'false']:
-            value = value.upper()
-    elif col_type == PY_BIN:
-        raise NotImplementedError("SQL blob insertion is not supported.")
-    else:
+    try:
+        coerce = _column_coercers[col_type]
+    except KeyError:
         e = "Unknown or unsupported column type '{0}'"
         raise RuntimeError(e.format(col_type))
-
-    return value
+    return coerce(value)
+
+
+# File extensions for each supported export format (None = P.datafile_ext)
+_export_formats = {
+    'txt': None,
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'npz': '.npz',
+}
+
+# NumPy dtypes to use for each column type when exporting to .npz
+_numpy_types = {
+    PY_INT: 'int64',
+    PY_FLOAT: 'float64',
+    PY_BOOL: 'bool',
+    PY_STR: 'str',
+    PY_BIN: 'bytes',
+}
+
+# NumPy dtype kinds that can be inserted into each column type without coercion
+_native_kinds = {
+    PY_INT: 'iu',
+    PY_FLOAT: 'f',
+    PY_BOOL: 'b',
+}
+
+
+@lru_cache(maxsize=256)
+def _insert_query(table, cols):
+    # Builds (and caches) the SQL statement for inserting into a set of columns
+    col_str = u", ".join(cols)
+    qmark_str = u", ".join(["?"] * len(cols))
+    return u"INSERT INTO `{0}` ({1}) VALUES({2})".format(table, col_str, qmark_str)
 
 
 def _convert_to_query_format(value, col_name, col_type):
@@ -101,11 +180,12 @@ def _convert_to_query_format(value, col_name, col_type):
 
 def _get_user_tables(db):
     # Gets names of all user-defined tables in the database (including 'trials')
-    non_user = ['session_info', 'export_history', 'participants']
+    non_user = ['session_info', 'export_history', 'frame_stats', 'participants']
     return [t for t in db.tables if not t in non_user]
             
 
-def _build_filepath(multi, id_info=None, base=None, joined=[], duplicate=False):
+def _build_filepath(multi, id_info=None, base=None, joined=[], duplicate=False, ext=None,
+        incremental=False):
     # If alternate base table or joined tables specified, note this in filename
     tables = ''
     if base != P.primary_table or len(joined):	
@@ -127,46 +207,67 @@ def _build_filepath(multi, id_info=None, base=None, joined=[], duplicate=False):
         outdir = P.incomplete_data_dir if incomplete else P.data_dir
     else:
         basename = "{0}_all_trials{1}".format(P.project_name, tables)
+        suffix += ("_incremental" if incremental else "")
         outdir = P.data_dir
 
     # If the file is a duplicate, add a number to the suffix and increment until
     # we find a filename that doesn't exist yet
+    ext = P.datafile_ext if ext is None else ext
     duplicate_count = 1
     while duplicate:
         dupe_num = "_{0}".format(duplicate_count)
-        filename = basename + suffix + dupe_num + P.datafile_ext
+        filename = basename + suffix + dupe_num + ext
         if os.path.isfile(os.path.join(outdir, filename)):
             duplicate_count += 1
         else:
             suffix = suffix + dupe_num
             break
 
-    return os.path.join(outdir, basename + suffix + P.datafile_ext)
+    return os.path.join(outdir, basename + suffix + ext)
 
 
-def _build_export_header(db, user_id=None):
+def _collect_runtime_info(db):
+    # Gathers the distinct runtime info values for every participant in the database
+    # at once, returning a dict in the format {participant_id: {column: [values]}}.
     # Old versions of KLibs didn't have session_info table for runtime info,
     # so we do a bit of work to keep export compatibility with old databases
-    legacy = False
     if 'session_info' in db.tables:
-        info_table = 'session_info'
+        info_table, id_col = ('session_info', 'participant_id')
         info_cols = db.get_columns('session_info')
         info_cols.remove('participant_id')
     else:
-        info_table = 'participants'
+        info_table, id_col = ('participants', 'id')
         info_cols = ['klibs_commit', 'random_seed']
-        legacy = True
+
+    runtime_info = {}
+    q = "SELECT `{0}`, {1} FROM {2}".format(id_col, ", ".join(info_cols), info_table)
+    for row in db.query(q):
+        if row[0] not in runtime_info:
+            runtime_info[row[0]] = OrderedDict((col, []) for col in info_cols)
+        p_info = runtime_info[row[0]]
+        for col, value in zip(info_cols, row[1:]):
+            if value not in p_info[col]:
+                p_info[col].append(value)
+
+    return runtime_info
+
+
+def _build_export_header(db, user_id=None, runtime_info=None):
+    legacy = not 'session_info' in db.tables
+    if runtime_info is None:
+        runtime_info = _collect_runtime_info(db)
 
     # Gather runtime info, checking for non-unique values if multi-participant export
+    p_ids = [user_id] if user_id else runtime_info.keys()
+    values = OrderedDict()
+    for p_id in p_ids:
+        for colname, p_values in runtime_info.get(p_id, {}).items():
+            col_values = values.setdefault(colname, [])
+            col_values += [v for v in p_values if v not in col_values]
     runtime_info = {}
-    for colname in info_cols:
-        q = "SELECT DISTINCT {0} FROM {1}".format(colname, info_table)
-        if user_id:
-            q += " WHERE `participant_id` = ?"
-            values = db.query(q, q_vars=[user_id])
-        else:
-            values = db.query(q)
-        runtime_info[colname] = "(multiple)" if len(values) > 1 else values[0][0]
+    for colname, col_values in values.items():
+        if len(col_values):
+            runtime_info[colname] = "(multiple)" if len(col_values) > 1 else col_values[0]
 
     # If database is from a legacy project, guess at runtime values from params
     if legacy:
@@ -202,7 +303,7 @@ def _build_export_header(db, user_id=None):
         ],
     }
     sections = ["KLIBS INFO", "EXPERIMENT SETTINGS"]
-    if info_table == 'session_info':
+    if not legacy:
         sections += ["SYSTEM INFO", "DISPLAY INFO"]
     if P.eye_tracking:
         sections.append("EYELINK SETTINGS")
@@ -219,6 +320,350 @@ def _build_export_header(db, user_id=None):
     return "#\n".join(chunks)
 
 
+def _batched(rows, size):
+    # Splits an iterator of rows into lists of at most the given size
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+def _as_numpy_column(values, col_type):
+    # Converts a list of column values into a typed NumPy array. Since NumPy has no
+    # missing value for non-float types, NULLs are converted to NaN for numeric
+    # columns (promoting them to float) and to empty strings for text columns.
+    dtype = _numpy_types[col_type]
+    if None in values:
+        if col_type in (PY_STR, PY_BIN):
+            empty = '' if col_type == PY_STR else b''
+            values = [empty if v is None else v for v in values]
+        else:
+            values = [np.nan if v is None else v for v in values]
+            dtype = 'float64'
+    return np.array(values, dtype=dtype)
+
+
+def _write_columnar_file(path, fmt, header, colnames, coltypes, rows):
+    # Writes a typed columnar data file in Parquet, Arrow IPC, or NumPy .npz format
+    if fmt == 'npz':
+        # Since .npz files store arrays by name, any repeated column names (e.g. from
+        # joined tables) are numbered to keep them unique, and the file header is
+        # stored as its own 'klibs_header' entry after the columns
+        columns = list(zip(*rows)) or [[] for _ in colnames]
+        arrays = OrderedDict()
+        for name, col_type, values in zip(colnames, coltypes, columns):
+            unique_name, n = (name, 1)
+            while unique_name in arrays or unique_name == 'klibs_header':
+                n += 1
+                unique_name = "{0}_{1}".format(name, n)
+            arrays[unique_name] = _as_numpy_column(list(values), col_type)
+        arrays['klibs_header'] = np.array(header)
+        with io.open(path, 'wb') as out:
+            np.savez(out, **arrays)
+        return
+
+    import pyarrow as pa
+    pa_types = {
+        PY_INT: pa.int64(), PY_FLOAT: pa.float64(), PY_BOOL: pa.bool_(),
+        PY_STR: pa.string(), PY_BIN: pa.binary(),
+    }
+    fields = [pa.field(name, pa_types[t]) for name, t in zip(colnames, coltypes)]
+    schema = pa.schema(fields, metadata={'klibs_header': header})
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    try:
+        for batch in _batched(rows, 10000):
+            columns = zip(*batch)
+            arrays = [pa.array(values, type=f.type) for values, f in zip(columns, fields)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        writer.close()
+
+
+def _write_export_file(path, fmt, header, colnames, coltypes, rows):
+    # Writes a header, column names, and rows of data to an export file
+    if fmt != 'txt':
+        _write_columnar_file(path, fmt, header, colnames, coltypes, rows)
+        return
+    with io.open(path, 'w+', encoding='utf-8') as out:
+        out.write(u"\n".join([header, TAB.join(colnames)]))
+        empty = True
+        for row in rows:
+            out.write(u"\n" + TAB.join(utf8(col) for col in row))
+            empty = False
+        if empty:
+            out.write(u"\n")
+
+
+def _append_export_file(path, rows):
+    # Appends rows of data to the end of an existing text export file
+    # Check whether the file already ends in a newline (e.g. if it has no rows yet)
+    with io.open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        newline = f.tell() > 0
+        if newline:
+            f.seek(-1, os.SEEK_END)
+            newline = f.read(1) != b"\n"
+    with io.open(path, 'a', encoding='utf-8') as out:
+        for row in rows:
+            out.write((u"\n" if newline else u"") + TAB.join(utf8(col) for col in row))
+            newline = True
+
+
+def _iter_export_rows(db, query, q_vars=(), chunk_size=1000):
+    # Lazily fetches rows from an export query in chunks, yielding the
+    # participant id and data values for each row
+    cursor = db.cursor()
+    try:
+        cursor.execute(query, q_vars)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not len(rows):
+                break
+            for row in rows:
+                yield row[0], row[1:]
+    finally:
+        cursor.close()
+
+
+def _group_by_participant(rows, participant_ids):
+    # Groups a stream of (participant_id, row) tuples ordered by participant id,
+    # yielding each of the given participant ids along with an iterator over
+    # their rows. Each participant's rows must be consumed before the next.
+    pending = [next(rows, None)]
+
+    def _participant_rows(pid):
+        while pending[0] is not None and pending[0][0] == pid:
+            yield pending[0][1]
+            pending[0] = next(rows, None)
+
+    for pid in participant_ids:
+        # Skip over any unconsumed rows from previous participants
+        while pending[0] is not None and pending[0][0] < pid:
+            pending[0] = next(rows, None)
+        yield pid, _participant_rows(pid)
+
+
+def _split_contiguous(items, n):
+    # Splits a list into n contiguous chunks of roughly equal size
+    chunks = []
+    start = 0
+    for i in range(n):
+        end = start + len(items) // n + (1 if i < len(items) % n else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def _apply_pragmas(db, profile):
+    # Applies a dict of SQLite pragma settings to a database connection. Note that
+    # some pragmas (e.g. journal_mode) are stored in the database file itself.
+    cursor = db.cursor()
+    for pragma, value in profile.items():
+        if not re.match(r"^\w+$", pragma) or not re.match(r"^-?\w+$", str(value)):
+            e = "Invalid database connection setting '{0} = {1}'."
+            raise ValueError(e.format(pragma, value))
+        cursor.execute("PRAGMA {0} = {1}".format(pragma, value))
+        cursor.fetchall()
+    cursor.close()
+
+
+def _export_participants(args):
+    # Writes out the export files for a range of participants. Since this can be
+    # run in a worker process, a separate read-only connection to the database
+    # is used and a list of the ids of the exported participants is returned.
+    db_path, query, colnames, coltypes, fmt, files = args
+    _set_type_conversions(export=(fmt == 'txt'))
+    uri = "file:{0}?mode=ro".format(pathname2url(os.path.abspath(db_path)))
+    db = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+    try:
+        id_range = (files[0][0], files[-1][0])
+        rows = _iter_export_rows(db, query, id_range)
+        participants = _group_by_participant(rows, [f[0] for f in files])
+        for (p_id, header, file_path), (_, trials) in zip(files, participants):
+            _write_export_file(file_path, fmt, header, colnames, coltypes, trials)
+    finally:
+        db.close()
+    return [f[0] for f in files]
+
+
+def _create_indexes(cursor):
+    # Creates an index on the 'participant_id' column of each table that has one,
+    # (unless already indexed) so that per-participant lookups don't require full
+    # table scans. Returns the number of indexes created.
+    q = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    created = 0
+    for (table, ) in cursor.execute(q).fetchall():
+        cols = [col[1] for col in cursor.execute("PRAGMA table_info(`{0}`)".format(table))]
+        if not 'participant_id' in cols:
+            continue
+        indexed = False
+        for index in cursor.execute("PRAGMA index_list(`{0}`)".format(table)).fetchall():
+            index_info = "PRAGMA index_info(`{0}`)".format(index[1])
+            first_col = cursor.execute(index_info).fetchone()
+            if first_col and first_col[2] == 'participant_id':
+                indexed = True
+                break
+        if not indexed:
+            q_idx = "CREATE INDEX `{0}_participant_id_idx` ON `{0}` (participant_id)"
+            cursor.execute(q_idx.format(table))
+            created += 1
+    return created
+
+
+def _is_locked(e):
+    # Checks whether an sqlite3 error was caused by another connection holding a
+    # lock on the database (i.e. SQLITE_BUSY or SQLITE_LOCKED)
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+
+def _merge_tables(db):
+    # Copies all data from the main database of a connection into its attached
+    # 'master' database, giving participants new ids in the master database and
+    # updating the participant ids of all other tables to match. Participants that
+    # already exist in the master database (e.g. from an earlier merge of the same
+    # data that committed but wasn't cleaned up) are skipped. If any participants
+    # were skipped, tables without participant ids are skipped too, since their
+    # rows can't be matched to participants and were already copied before.
+    q = "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    tables = [t[0] for t in db.execute(q).fetchall()]
+    columns = {}
+    for table in tables:
+        cols = [col[1] for col in db.execute("PRAGMA main.table_info(`{0}`)".format(table))]
+        columns[table] = [col for col in cols if col != 'id']
+
+    # Copy over any new participants, mapping their old ids to their new ones
+    match_cols = [col for col in [P.unique_identifier, 'created'] if col in columns['participants']]
+    match = " AND ".join(["`{0}` IS ?".format(col) for col in match_cols])
+    p_cols = ", ".join(["`{0}`".format(col) for col in columns['participants']])
+    q_ids = "SELECT id, {0} FROM main.participants ORDER BY id"
+    q_exists = "SELECT id FROM master.participants WHERE {0}".format(match)
+    q_insert = "INSERT INTO master.participants ({0}) SELECT {0} FROM main.participants WHERE id = ?"
+    id_map = OrderedDict()
+    participants = db.execute(q_ids.format(", ".join(match_cols))).fetchall()
+    for row in participants:
+        if db.execute(q_exists, row[1:]).fetchone():
+            continue
+        id_map[row[0]] = db.execute(q_insert.format(p_cols), (row[0], )).lastrowid
+    if len(participants) and not len(id_map):
+        return id_map
+    already_merged = len(id_map) < len(participants)
+
+    # Copy over all rows from the other tables using the new participant ids
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS id_map (old_id integer, new_id integer)")
+    db.execute("DELETE FROM temp.id_map")
+    db.executemany("INSERT INTO temp.id_map VALUES (?, ?)", list(id_map.items()))
+    for table in tables:
+        if table == 'participants' or not len(columns[table]):
+            continue
+        id_cols = [col for col in ['participant_id', 'user_id'] if col in columns[table]]
+        if already_merged and not len(id_cols):
+            continue
+        select = ["m.new_id" if col in id_cols else "t.`{0}`".format(col) for col in columns[table]]
+        q = "INSERT INTO master.`{0}` ({1}) SELECT {2} FROM main.`{0}` AS t".format(
+            table, ", ".join(["`{0}`".format(col) for col in columns[table]]), ", ".join(select)
+        )
+        if len(id_cols):
+            q += " JOIN temp.id_map AS m ON t.`{0}` = m.old_id".format(id_cols[0])
+        db.execute(q + " ORDER BY t.rowid")
+    return id_map
+
+
+def merge_database(src_path, dest_path, retries=8, backoff=0.05, timeout=5.0):
+    """Merges all data from one KLibs database into another.
+
+    The merge is done as a single immediate transaction, meaning that either all
+    of the source database's data is added to the destination database or none
+    of it is. If the destination database is locked by another connection at any
+    point during the merge (including while committing), the transaction is rolled
+    back and the whole merge is retried after an exponentially-increasing delay
+    (with some random jitter, so that machines waiting on the same database don't
+    retry in lockstep).
+
+    Participants are given new ids in the destination database, with the
+    ``participant_id`` (and legacy ``user_id``) columns of all other tables
+    updated to match. Participants that already exist in the destination (i.e.
+    with the same unique identifier and creation time) are skipped along with their
+    data, so that retrying a merge that has already been committed is harmless.
+
+    Args:
+        src_path (str): The path of the database to copy data from.
+        dest_path (str): The path of the database to copy data into. Must have the
+            same tables and columns as the source database.
+        retries (int, optional): The maximum number of times to retry the merge if
+            the destination database is locked. Defaults to 8.
+        backoff (float, optional): The number of seconds to wait before the first
+            retry, doubling after each subsequent attempt. Defaults to 0.05.
+        timeout (float, optional): The number of seconds each attempt waits for
+            other connections to release their locks on the destination database
+            before giving up. Defaults to 5.0.
+
+    Returns:
+        :obj:`OrderedDict`: A mapping of the participant ids in the source database
+        to their new ids in the destination database.
+
+    Raises:
+        sqlite3.OperationalError: If the destination database is still locked
+            after all retries, or if the merge fails for any other reason.
+
+    """
+    db = sqlite3.connect(src_path, timeout=timeout, isolation_level=None)
+    try:
+        db.execute("ATTACH DATABASE ? AS master", (dest_path, ))
+        attempt = 0
+        while True:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    id_map = _merge_tables(db)
+                    db.execute("COMMIT")
+                except Exception:
+                    if db.in_transaction:
+                        db.execute("ROLLBACK")
+                    raise
+                return id_map
+            except sqlite3.OperationalError as e:
+                if not _is_locked(e) or attempt >= retries:
+                    raise
+            time.sleep(backoff * (2 ** attempt) * random.uniform(1.0, 1.5))
+            attempt += 1
+    finally:
+        db.close()
+
+
+def backup_database(path, backup_path):
+    """Creates a backup copy of a KLibs database.
+
+    Unlike copying the database file directly, this uses SQLite's backup API so that
+    the backup includes any recently-committed changes that are still in the
+    database's write-ahead log, and is consistent even if another session is writing
+    to the database at the same time. Any existing backup is replaced.
+
+    Args:
+        path (str): The path of the database to back up.
+        backup_path (str): The path at which to write the backup.
+
+    """
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(backup_path + suffix):
+            os.remove(backup_path + suffix)
+    src = sqlite3.connect(path)
+    dest = sqlite3.connect(backup_path)
+    try:
+        src.backup(dest)
+    finally:
+        dest.close()
+        src.close()
+
+
 # TODO: look for required tables and columns explicitly and give informative error if absent
 # (ie. participants, created). Need to make list of required columns first.
 def rebuild_database(path, schema):
@@ -226,7 +671,9 @@ def rebuild_database(path, schema):
 
     In addition to the tables specified in the schema, a 'session_info' table
     used internally for storing experiment runtime information will be
-    automatically added to the created database.
+    automatically added to the created database. Indexes for the
+    'participant_id' column of each table are also created automatically,
+    along with any indexes defined in the schema.
 
     Args:
         path (str): The path at which to create the empty database.
@@ -246,19 +693,81 @@ def rebuild_database(path, schema):
         cursor.executescript(f.read())
     cursor.execute(session_info_schema)
     cursor.execute(export_history_schema)
+    cursor.execute(frame_stats_schema)
+    _create_indexes(cursor)
+    # Give each new database a random initial batch marker, so that deferred-insert
+    # journals left over from any previous database at the same path are never
+    # recovered into it
+    cursor.execute("PRAGMA user_version = {0}".format(random.randint(1, 2**31 - 1)))
+    db.commit()
     cursor.close()
     db.close()
 
-    # If successful, back up old database and replace with new one
+    # If successful, back up old database and replace with new one. Any leftover
+    # write-ahead log and deferred-insert journal files are backed up too, since
+    # they would otherwise be applied to the new database.
     backup_path = path + ".backup"
-    if os.path.exists(path):
-        if os.path.exists(backup_path):
-            os.remove(backup_path)
-        os.rename(path, backup_path)
+    for suffix in ["", "-wal", "-shm", ".journal"]:
+        if os.path.exists(path + suffix):
+            if os.path.exists(backup_path + suffix):
+                os.remove(backup_path + suffix)
+            os.rename(path + suffix, backup_path + suffix)
     shutil.move(tmppath, path)
 
 
 
+class _Inserter(object):
+    # A validated, pre-compiled inserter for a given set of columns in a table.
+    # Column names are kept in schema order, and each column's type coercion
+    # function is looked up once so that rows can be coerced with minimal overhead.
+
+    def __init__(self, table, columns, schema):
+        self.table = table
+        self.columns = tuple(col for col in schema.keys() if col in columns)
+        self.cols = tuple(u"`{0}`".format(col) for col in self.columns)
+        self.types = tuple(schema[col]['type'] for col in self.columns)
+        self.coercers = tuple(_column_coercers[t] for t in self.types)
+
+    def _coerce_error(self, values):
+        # Finds the first value that can't be coerced and raises an informative error
+        for value, col, col_type in zip(values, self.columns, self.types):
+            try:
+                _as_column_type(value, col_type)
+            except (TypeError, ValueError):
+                e = "Could not coerce '{0}' to type '{1}' for column '{2}' in '{3}'"
+                raise ValueError(e.format(value, col_type, col, self.table))
+
+    def coerce(self, values, coercers=None):
+        # Coerces a sequence of values (in column order) to their column types
+        if coercers is None:
+            coercers = self.coercers
+        try:
+            return tuple([f(v) for f, v in zip(coercers, values)])
+        except (TypeError, ValueError):
+            self._coerce_error(values)
+            raise
+
+    def coerce_dict(self, data):
+        # Coerces a dict of {column: value} pairs to their column types
+        return self.coerce([data[col] for col in self.columns])
+
+    def coerce_column(self, values, index):
+        # Coerces a sequence of values for a single column to the column's type
+        coerce = self.coercers[index]
+        try:
+            return [coerce(v) for v in values]
+        except (TypeError, ValueError):
+            col, col_type = (self.columns[index], self.types[index])
+            for value in values:
+                try:
+                    coerce(value)
+                except (TypeError, ValueError):
+                    e = "Could not coerce '{0}' to type '{1}' for column '{2}' in '{3}'"
+                    raise ValueError(e.format(value, col_type, col, self.table))
+            raise
+
+
+
 class EntryTemplate(object):
 
     def __init__(self, table):
@@ -283,16 +792,41 @@ class EntryTemplate(object):
 class Database(object):
     """An object for reading, writing, and modifying data in the KLibs database.
 
+    The connection is configured using the SQLite pragmas in
+    ``P.db_connection_profile``. By default, this puts the database in
+    write-ahead log (WAL) mode, which greatly reduces the cost of each commit
+    and allows other processes (e.g. ``klibs export``) to read the database
+    while a session is writing to it.
+
+    Since WAL mode doesn't work for databases shared between machines over a
+    network, shared databases (e.g. the master database in multi-user mode)
+    always use SQLite's default rollback journal with full disk syncing.
+
     Args:
         path (str): The path to the database file to load. The database must
             already exist before loading.
+        shared (bool, optional): Whether the database may be accessed by other
+            machines over a network. Defaults to False.
 
     """
-    def __init__(self, path):
+    def __init__(self, path, shared=False):
         super(Database, self).__init__()
         self.db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        profile = P.db_connection_profile
+        if shared:
+            profile = dict(profile or {}, journal_mode='DELETE', synchronous='FULL')
+        if profile:
+            _apply_pragmas(self.db, profile)
         self.cursor = self.db.cursor()
         self.table_schemas = self._build_table_schemas()
+        self._inserters = {}
+        # Initialize queue and crash journal for deferred inserts
+        self._deferred = []
+        self._deferred_since = None
+        self._journal = None
+        self._journal_batch = None
+        self._journal_path = path + ".journal"
+        self._recover_journal()
 
     def _to_sql_equals_statements(self, data, table):
         sql_strs = []
@@ -344,51 +878,152 @@ class Database(object):
     def _flush(self):
         # Clears all data from the database while keeping its table structure.
         # This also resets the row id counts for each table.
+        self.flush_deferred()
         for table in self.tables:
             self.cursor.execute(u"DELETE FROM `{0}`".format(table))
             self.cursor.execute(u"DELETE FROM sqlite_sequence WHERE name='{0}'".format(table))
         self.db.commit()
 
-    def _gather_insert_values(self, data, table):
-        # Gathers and validates columns/values for insertion into a given table
+    def _get_inserter(self, table, columns):
+        # Gets a compiled inserter for a given set of columns in a table, validating
+        # the columns and caching the inserter for reuse if not already cached
+        key = (table, frozenset(columns))
+        if key in self._inserters:
+            return self._inserters[key]
         self._ensure_table(table)
         template = copy(self.table_schemas[table])
         template.pop('id', None) # remove id column from template if present
         # Ensure all provided values correspond to an existing column
-        for colname in data.keys():
+        for colname in columns:
             if colname not in template.keys():
                 err = "Column '{0}' does not exist in table '{1}'."
                 raise ValueError(err.format(colname, table))
-        # Gather all values to insert into the database
-        cols = []
-        values = []
+        # Ensure values are provided for all non-nullable columns
         for colname, info in template.items():
-            if colname in data.keys():
-                try:
-                    value = _as_column_type(data[colname], info['type'])
-                except (TypeError, ValueError):
-                    e = "Could not coerce '{0}' to type '{1}' for column '{2}' in '{3}'"
-                    raise ValueError(
-                        e.format(data[colname], info['type'], colname, table)
-                    )
-                cols.append(u"`{0}`".format(colname))
-                values.append(value)
-            elif info['allow_null']:
-                continue
-            else:
+            if colname not in columns and not info['allow_null']:
                 raise ValueError("No value provided for column '{0}'.".format(colname))
-        return cols, values
+        inserter = _Inserter(table, key[1], template)
+        self._inserters[key] = inserter
+        return inserter
+
+    def _write_rows(self, rows):
+        # Writes a sequence of (table, cols, values) rows to the database, batching
+        # consecutive rows with the same table and columns into a single query.
+        # NOTE: executemany doesn't update lastrowid, so only the final row of the
+        # sequence is inserted with execute.
+        for (table, cols), batch in groupby(rows, key=lambda row: row[:2]):
+            q = _insert_query(table, cols)
+            values = [row[2] for row in batch]
+            try:
+                if len(values) > 1:
+                    self.cursor.executemany(q, values[:-1])
+                self.cursor.execute(q, values[-1])
+            except sqlite3.OperationalError as e:
+                err = "\n\n\nTried to match the following:\n\n{0}\n\nwith\n\n{1}"
+                print(full_trace())
+                print(err.format(self.table_schemas[table], q))
+                raise e
+
+    def _set_batch_marker(self, batch_id):
+        # Records the id of the last journaled batch written to the database in
+        # the file header (via user_version), which is only updated if the
+        # current transaction is committed
+        self.cursor.execute("PRAGMA user_version = {0}".format(int(batch_id)))
+
+    def _defer_rows(self, rows):
+        # Queues validated rows for writing later, logging each one to the journal
+        # file so that queued data can be recovered if the session crashes. Each
+        # journal starts with a random batch id, which is stored in the database
+        # when the batch is committed so that recovery never writes it twice, along
+        # with the database's batch marker at the time the journal was started so
+        # that journals are only ever recovered into the database they came from.
+        if self._journal is None:
+            self.cursor.execute("PRAGMA user_version")
+            header = {'batch': random.randint(1, 2**31 - 1), 'base': self.cursor.fetchone()[0]}
+            self._journal = io.open(self._journal_path, 'w', encoding='utf-8')
+            self._journal_batch = header['batch']
+            self._journal.write(utf8(json.dumps(header)) + u"\n")
+        for row in rows:
+            self._journal.write(utf8(json.dumps(row)) + u"\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        if not len(self._deferred):
+            self._deferred_since = time.time()
+        self._deferred += rows
+        # Write out queued rows if the row count or time limits have been reached
+        over_rows = P.db_flush_rows and len(self._deferred) >= P.db_flush_rows
+        over_time = (
+            P.db_flush_interval is not None and
+            (time.time() - self._deferred_since) >= P.db_flush_interval
+        )
+        if over_rows or over_time:
+            self.flush_deferred()
+
+    def _recover_journal(self):
+        # Writes any rows left in the journal by a crashed session to the database.
+        # A partially-written final line (e.g. from a crash mid-write) is ignored.
+        # Batches that were already committed before the crash are skipped, as are
+        # journals left over from a different database at the same path (e.g. one
+        # that has since been rebuilt).
+        if not os.path.isfile(self._journal_path):
+            return
+        rows = []
+        batch_id, base = (None, None)
+        with io.open(self._journal_path, 'r', encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+                batch_id, base = (header['batch'], header.get('base'))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                pass
+            for line in f:
+                try:
+                    table, cols, values = json.loads(line)
+                except ValueError:
+                    break
+                rows.append((table, tuple(cols), tuple(values)))
+        self.cursor.execute("PRAGMA user_version")
+        marker = self.cursor.fetchone()[0]
+        if batch_id is None or marker == batch_id:
+            rows = []
+        elif base is not None and marker != base:
+            msg = "Ignored {0} unsaved row{1} in '{2}' from a different database."
+            print(msg.format(len(rows), "" if len(rows) == 1 else "s", self._journal_path))
+            rows = []
+        if len(rows):
+            self._write_rows(rows)
+            self._set_batch_marker(batch_id)
+            self.db.commit()
+            msg = "Recovered {0} unsaved row{1} from '{2}'."
+            print(msg.format(len(rows), "" if len(rows) == 1 else "s", self._journal_path))
+        os.remove(self._journal_path)
 
     
+    def checkpoint(self):
+        """Writes all changes in the database's write-ahead log to the database file.
+
+        SQLite does this automatically as the log grows and when the last
+        connection to the database is closed, so this only needs to be called
+        before copying the database file while it is still open. Does nothing if
+        the database is not in WAL mode.
+
+        """
+        self.flush_deferred()
+        self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.cursor.fetchall()
+
+
     def close(self):
         """Closes the connection to the database.
 
-        Once called, the Database object can no longer be used.
+        Any deferred rows are written to the database before closing. Once
+        called, the Database object can no longer be used.
 
         """
+        self.flush_deferred()
         self.cursor.close()
         self.db.close()
         self.table_schemas = {}
+        self._inserters = {}
 
 
     def get_columns(self, table):
@@ -422,7 +1057,39 @@ class Database(object):
         return len(self.query(q, q_vars=[value])) > 0
 
 
-    def insert(self, data, table=None):
+    def _commit_rows(self, rows, defer=False):
+        # Writes or defers a list of validated (table, cols, values) rows
+        if defer:
+            if len(rows):
+                self._defer_rows(rows)
+            return None
+        self.flush_deferred()
+        self._write_rows(rows)
+        self.db.commit()
+        return self.cursor.lastrowid
+
+
+    def flush_deferred(self):
+        """Writes any rows queued by deferred inserts to the database.
+
+        This is called automatically before any reads or modifications of the
+        database, as well as when the database is closed.
+
+        """
+        if not len(self._deferred):
+            return
+        self._write_rows(self._deferred)
+        self._set_batch_marker(self._journal_batch)
+        self.db.commit()
+        self._deferred = []
+        self._deferred_since = None
+        # Once the rows are safely committed, the journal is no longer needed
+        self._journal.close()
+        self._journal = None
+        os.remove(self._journal_path)
+
+
+    def insert(self, data, table=None, defer=False):
         """Inserts one or more rows of data into a table in the database.
 
         Each row of data is represented as a dict in ``{'column': value}``
@@ -449,14 +1116,25 @@ class Database(object):
                })
            self.db.insert(rows, table='gamepad')
 
+        If ``defer`` is True, the rows are validated immediately but are queued
+        in memory instead of being written to the database right away. Queued
+        rows are written in a single batch once ``P.db_flush_rows`` rows have
+        been queued or ``P.db_flush_interval`` seconds have passed, whenever
+        the database is next read or modified, or when :meth:`flush_deferred`
+        is called. Until then, queued rows are logged to a journal file next to
+        the database so that they can be recovered if the experiment crashes.
+
         Args:
             data (:obj:`dict` or :obj:`list`): A dictionary (or list of dicts)
                 containing the data to insert into the database. The column
                 names must match the columns of the destination table.
             table (str): The name of the table to insert the data into.
+            defer (bool, optional): If True, the rows will be queued and written
+                to the database later instead of immediately. Defaults to False.
 
         Returns:
-            int: The row id of the last row inserted into the table.
+            int: The row id of the last row inserted into the table, or None if
+            the insert was deferred.
 
         """
         if isinstance(data, EntryTemplate):
@@ -471,20 +1149,162 @@ class Database(object):
 
         if not isinstance(data, list):
             data = [data]
+        rows = []
         for row in data:
-            cols, values = self._gather_insert_values(row, table)
-            col_str = u", ".join(cols)
-            qmark_str = u", ".join(["?"] * len(values))
-            q = u"INSERT INTO `{0}` ({1}) VALUES({2})".format(table, col_str, qmark_str)
-            try:
-                self.cursor.execute(q, values)
-            except sqlite3.OperationalError as e:
-                err = "\n\n\nTried to match the following:\n\n{0}\n\nwith\n\n{1}"
-                print(full_trace())
-                print(err.format(self.table_schemas[table], q))
-                raise e
-        self.db.commit()
-        return self.cursor.lastrowid
+            inserter = self._get_inserter(table, row.keys())
+            rows.append((table, inserter.cols, inserter.coerce_dict(row)))
+        return self._commit_rows(rows, defer)
+
+
+    def insert_rows(self, rows, table, columns=None, defer=False):
+        """Inserts a sequence of row tuples or a NumPy structured array into a table.
+
+        This is a faster alternative to :meth:`insert` for tables that receive
+        large amounts of data (e.g. gaze samples or cursor positions), since
+        the columns for the rows only need to be validated once. For example,
+        to insert a list of gamepad samples, you could do::
+
+           cols = ['participant_id', 'trial_num', 'time', 'stick_x', 'stick_y']
+           rows = [(P.p_id, P.trial_number, t, x, y) for t, x, y in axis_data]
+           self.db.insert_rows(rows, 'gamepad', columns=cols)
+
+        If ``rows`` is a NumPy structured array, its field names are used as the
+        column names and any fields with dtypes already matching their column
+        types (e.g. int fields for integer columns) are inserted without any
+        per-value type coercion.
+
+        Args:
+            rows (:obj:`list` or :obj:`numpy.ndarray`): A list of tuples (or other
+                sequences) containing the values for each row in the same order
+                as ``columns``, or a structured array with one field per column.
+            table (str): The name of the table to insert the data into.
+            columns (:obj:`list`, optional): The names of the columns corresponding
+                to the values in each row. Defaults to all columns in the table
+                (excluding 'id') in table order. Ignored for structured arrays.
+            defer (bool, optional): If True, the rows will be queued and written
+                to the database later instead of immediately. See :meth:`insert`
+                for more details. Defaults to False.
+
+        Returns:
+            int: The row id of the last row inserted into the table, or None if
+            the insert was deferred.
+
+        """
+        kinds = None
+        if hasattr(rows, 'dtype'):
+            if not rows.dtype.names:
+                raise TypeError("NumPy arrays must be structured arrays with named fields.")
+            columns = rows.dtype.names
+            kinds = [rows.dtype[name].kind for name in columns]
+            rows = rows.tolist()
+        elif columns is None:
+            columns = [col for col in self.get_columns(table) if col != 'id']
+        columns = list(columns)
+        if len(set(columns)) != len(columns):
+            raise ValueError("Column names for inserted rows must be unique.")
+        inserter = self._get_inserter(table, columns)
+
+        # Map the order of the provided columns to the table's column order
+        order = [columns.index(col) for col in inserter.columns]
+        reorder = order != list(range(len(columns)))
+
+        # Skip type coercion for any array fields that already match their column types
+        coercers = inserter.coercers
+        if kinds:
+            coercers = tuple(
+                _as_is if kinds[i] in _native_kinds.get(col_type, '') else f
+                for i, col_type, f in zip(order, inserter.types, coercers)
+            )
+        skip_coercion = all(f is _as_is for f in coercers)
+
+        gathered = []
+        for row in rows:
+            if len(row) != len(columns):
+                e = "Expected {0} values per row for table '{1}', got {2}."
+                raise ValueError(e.format(len(columns), table, len(row)))
+            if reorder:
+                row = [row[i] for i in order]
+            values = tuple(row) if skip_coercion else inserter.coerce(row, coercers)
+            gathered.append((table, inserter.cols, values))
+        return self._commit_rows(gathered, defer)
+
+
+    def insert_columns(self, table, data, defer=False):
+        """Inserts columns of data (e.g. NumPy arrays) into a table.
+
+        This is the fastest way of inserting large numbers of samples (e.g. gaze
+        positions, audio levels, or cursor coordinates) into the database, since
+        each column is validated and type-converted as a whole instead of value by
+        value. Single values (e.g. participant ids or trial numbers) are repeated
+        for every row. For example, to insert the points from a
+        :class:`~klibs.KLResponseCollectors.DrawResponse` as separate rows, you
+        could do::
+
+           pts = np.array(self.rc.draw_listener.response(rt=False))
+           self.db.insert_columns('cursor', {
+               'participant_id': P.participant_id,
+               'trial_num': P.trial_number,
+               'x': pts[:, 0],
+               'y': pts[:, 1],
+               'time': pts[:, 2],
+           })
+
+        NumPy arrays with dtypes that already match their column types (e.g. int
+        arrays for integer columns) are inserted without any type coercion.
+
+        Args:
+            table (str): The name of the table to insert the data into.
+            data (dict): A dict of column names and their corresponding values,
+                which can be NumPy arrays, lists, or other sequences of the same
+                length, or single values to use for all rows.
+            defer (bool, optional): If True, the rows will be queued and written
+                to the database later instead of immediately. See :meth:`insert`
+                for more details. Defaults to False.
+
+        Returns:
+            int: The row id of the last row inserted into the table, or None if
+            the insert was deferred.
+
+        Raises:
+            ValueError: If any of the provided columns differ in length, do not
+                exist in the table, or contain values that can't be converted to
+                the column's data type.
+
+        """
+        inserter = self._get_inserter(table, list(data.keys()))
+        columns = []
+        scalars = []
+        nrows = None
+        for i, (col, col_type) in enumerate(zip(inserter.columns, inserter.types)):
+            values = data[col]
+            if isinstance(values, bytes) or not iterable(values):
+                columns.append(values)
+                scalars.append(i)
+                continue
+            if hasattr(values, 'dtype'):
+                if values.ndim != 1:
+                    e = "Arrays for column '{0}' must be 1-dimensional."
+                    raise ValueError(e.format(col))
+                native = values.dtype.kind in _native_kinds.get(col_type, '')
+                values = values.tolist()
+            else:
+                values = list(values)
+                native = False
+            if nrows is None:
+                nrows = len(values)
+            elif len(values) != nrows:
+                e = "All columns inserted into '{0}' must be the same length."
+                raise ValueError(e.format(table))
+            columns.append(values if native else inserter.coerce_column(values, i))
+
+        # Repeat any single values for all rows of data
+        if nrows is None:
+            nrows = 1
+        for i in scalars:
+            columns[i] = repeat(inserter.coerce_column([columns[i]], i)[0], nrows)
+
+        gathered = [(table, inserter.cols, values) for values in zip(*columns)]
+        return self._commit_rows(gathered, defer)
 
 
     def last_row_id(self, table):
@@ -503,6 +1323,7 @@ class Database(object):
 
     def query(self, query, q_vars=(), commit=False):
         # Can probably also be made private after updating TraceLab
+        self.flush_deferred()
         result = self.cursor.execute(query, tuple(q_vars))
         if commit:
             self.db.commit()
@@ -565,6 +1386,7 @@ class Database(object):
             filters = self._to_sql_equals_statements(where, table)
             filter_str = " AND ".join(filters)
             q += " WHERE {0}".format(filter_str)
+        self.flush_deferred()
         self.cursor.execute(q)
         self.db.commit()
 
@@ -598,6 +1420,7 @@ class Database(object):
             raise ValueError(err.format(table, filter_str))
 
         q = "UPDATE `{0}` SET {1} WHERE {2}".format(table, replacements_str, filter_str)
+        self.flush_deferred()
         self.cursor.execute(q)
         self.db.commit()
         return self.cursor.lastrowid
@@ -611,7 +1434,7 @@ class Database(object):
 
 class DatabaseManager(EnvAgent):
     
-    def __init__(self, path, local_path=None):
+    def __init__(self, path, local_path=None, spool_dir=None):
         super(DatabaseManager, self).__init__()
         # Initialize column type conversions for session
         _set_type_conversions()
@@ -619,11 +1442,16 @@ class DatabaseManager(EnvAgent):
         self.multi_user = local_path != None
         self._path = path
         self._local_path = local_path
+        self._spool_dir = spool_dir
         # Initialize connections to database(s)
-        self._primary = Database(path)
+        self._primary = Database(path, shared=(self.multi_user or P.multi_user))
         self._validate_structure(self._primary)
         self._local = None
         if self.multi_user:
+            # Try merging any sessions left over from failed merges into the master
+            self.merge_spooled()
+            # Make sure all changes are in the main file before copying it
+            self._primary.checkpoint()
             shutil.copy(path, local_path)
             self._local = Database(local_path)
             self._local._flush()
@@ -659,36 +1487,57 @@ class DatabaseManager(EnvAgent):
             if not 'participant_id' in db.get_columns(table):
                 raise RuntimeError(e.format(table))
 
-    def _is_complete(self, pid):
+    def _get_completion(self):
+        # Gets the completion status of every participant in the database at once
         # TODO: For multisession projects, need to know the number of sessions
         # per experiment for this to work correctly: currently, this only checks
         # whether all sessions so far were completed, even if there are more
         # sessions remaining.
-        if 'session_info' in self._primary.table_schemas:	
-            q = "SELECT complete FROM session_info WHERE participant_id = ?"
-            sessions = self._primary.query(q, q_vars=[pid])
-            complete = [bool(s[0]) for s in sessions]
-            return all(complete)
+        p_ids = [row[0] for row in self._primary.query("SELECT id FROM participants")]
+        if 'session_info' in self._primary.table_schemas:
+            q = "SELECT participant_id FROM session_info WHERE NOT IFNULL(complete, 0)"
+            incomplete = set(row[0] for row in self._primary.query(q))
+            return {pid: pid not in incomplete for pid in p_ids}
         else:
-            q = "SELECT id FROM trials WHERE participant_id = ?"
-            trialcount = len(self._primary.query(q, q_vars=[pid]))
-            return trialcount >= P.trials_per_block * P.blocks_per_experiment
-
-    def _log_export(self, pid, table):
-        # Logs a successfully exported participant in the database
-        if 'export_history' in self._primary.tables:
+            q = "SELECT participant_id, COUNT(*) FROM trials GROUP BY participant_id"
+            trialcounts = dict(self._primary.query(q))
+            required = P.trials_per_block * P.blocks_per_experiment
+            return {pid: trialcounts.get(pid, 0) >= required for pid in p_ids}
+
+    def _log_export(self, pids, table, last_row_id=None):
+        # Logs a list of successfully exported participants in the database
+        if 'export_history' in self._primary.tables and len(pids):
+            row = {'table_name': table, 'timestamp': time.time()}
+            if last_row_id is not None:
+                row['last_row_id'] = last_row_id
             self._primary.insert(
-                {'participant_id': pid, 'table_name': table, 'timestamp': time.time()},
-                table='export_history'
+                [dict(row, participant_id=pid) for pid in pids], table='export_history'
             )
 
-    def _already_exported(self, pid, table):
-        # Checks whether an id/table combination has already been exported
+    def _ensure_export_marks(self):
+        # Ensures the export_history table exists and has a column for tracking the
+        # highest exported row id, upgrading the table for older databases
+        if not 'export_history' in self._primary.tables:
+            self._primary.query(export_history_schema, commit=True)
+        elif not 'last_row_id' in self._primary.get_columns('export_history'):
+            q = "ALTER TABLE export_history ADD COLUMN last_row_id integer"
+            self._primary.query(q, commit=True)
+        else:
+            return
+        self._primary.table_schemas = self._primary._build_table_schemas()
+        self._primary._inserters = {}
+
+    def _get_export_mark(self, table):
+        # Gets the highest row id already exported for a given table (or None)
+        q = "SELECT MAX(last_row_id) FROM export_history WHERE table_name = ?"
+        return self._primary.query(q, q_vars=[table])[0][0]
+
+    def _get_exported(self, table):
+        # Gets the ids of all participants already exported for a given table
         if not 'export_history' in self._primary.tables:
-            return False
-        this_id = {'participant_id': pid, 'table_name': table}
-        matches = self._primary.select('export_history', where=this_id)
-        return len(matches) > 0
+            return set()
+        q = "SELECT DISTINCT participant_id FROM export_history WHERE table_name = ?"
+        return set(row[0] for row in self._primary.query(q, q_vars=[table]))
     
 
     def get_unique_ids(self):
@@ -699,51 +1548,95 @@ class DatabaseManager(EnvAgent):
         return [row[0] for row in id_rows]
     
 
+    def _merge_local(self, local_path):
+        # Merges a local database into the master database, removing the local copy
+        # if successful. Returns the mapping of local to master participant ids, or
+        # None if the merge failed.
+        try:
+            id_map = merge_database(
+                local_path, self._path, P.db_merge_retries, P.db_merge_backoff,
+                P.db_merge_timeout
+            )
+        except sqlite3.Error as e:
+            msg = "\n<red>Unable to merge local database '{0}' into master: {1}</red>"
+            cso(msg.format(local_path, e))
+            cso("<red>Its data has been kept, and will be merged in a later session.</red>")
+            return None
+        try:
+            os.remove(local_path)
+        except OSError:
+            pass # already merged & removed by another session
+        return id_map
+
+
+    def merge_spooled(self):
+        """Merges any finished multi-user session databases waiting in the spool
+        into the master database.
+
+        In multi-user mode, each session's local database is moved to the spool
+        when the session ends and then merged into the master database. If the
+        merge fails (e.g. if the master database stays locked by other machines),
+        the session's data is kept in the spool and the merge is retried the next
+        time this method is called, which is done automatically at the start of
+        each multi-user session.
+
+        Returns:
+            int: The number of spooled databases successfully merged.
+
+        """
+        if not self._spool_dir or not os.path.isdir(self._spool_dir):
+            return 0
+        merged = 0
+        for spooled in sorted(glob(os.path.join(self._spool_dir, "*.db"))):
+            if self._merge_local(spooled) is not None:
+                merged += 1
+        return merged
+
+
     def write_local_to_master(self):
-        attach_q = 'ATTACH `{0}` AS master'.format(self._path)
-        self._local.cursor.execute(attach_q)
-        self.copy_columns(table='participants', ignore=['id'])
+        """Merges the session's local database into the master database in
+        multi-user mode, updating ``P.participant_id`` to the participant's id
+        in the master database.
+
+        If a spool folder was provided, the local database is moved there before
+        merging so that its data is kept even if the merge fails. See
+        :meth:`merge_spooled` for more info.
+
+        """
+        self._local.close()
+        local_path = self._local_path
+        try:
+            if self._spool_dir:
+                if not os.path.isdir(self._spool_dir):
+                    os.makedirs(self._spool_dir)
+                spool_path = os.path.join(self._spool_dir, os.path.basename(local_path))
+                shutil.move(local_path, spool_path)
+                local_path = spool_path
+        except (IOError, OSError):
+            # If the spool isn't writable, try merging from the original location
+            pass
+        id_map = self._merge_local(local_path)
+        if id_map:
+            P.participant_id = list(id_map.values())[-1]
 
-        master_p_id = self._local.cursor.lastrowid
-        update_p_id = {'participant_id': master_p_id, 'user_id': master_p_id}
-        P.participant_id = master_p_id
-        
-        for table in self._local.tables:
-            if table == 'participants': continue
-            self.copy_columns(table, ignore=['id'], sub=update_p_id)
-        
-        self._local.cursor.execute('DETACH DATABASE `master`')
-            
 
-    def copy_columns(self, table, ignore=[], sub={}):
-        colnames = []
-        for colname in self._local.get_columns(table):
-            if colname not in ignore:
-                colnames.append(colname)
-        columns = ", ".join(colnames)
-        
-        col_data = columns
-        for colname in sub.keys():
-            col_data = col_data.replace(colname, "\'{0}\'".format(sub[colname]))
-            
-        q = "INSERT INTO master.{0} ({1}) SELECT {2} FROM {0}".format(table, columns, col_data)
-        self._local.cursor.execute(q)
-        self._local.db.commit()
-    
-    
     def close(self):
+        self.commit()
         self._primary.close()
         if self.multi_user:
-            # TODO: Retry some number of times on write failure (locked db)
             self.write_local_to_master()
-            self._local.close()
-
+            self.merge_spooled()
 
-    def collect_export_data(self, base_table, multi_file=True, join_tables=[]):
-        uid = P.unique_identifier
-        participant_ids = self._primary.query("SELECT `id`, `{0}` FROM `participants`".format(uid))
 
+    def _export_query(self, base_table, multi_file=True, join_tables=[], id_range=False,
+            row_range=False):
+        # Builds the column names, column types, and SQL query for exporting data from
+        # the database, with rows ordered by participant and each row prefixed by its
+        # participant id. If id_range is True, the query takes a min and max participant
+        # id, and if row_range is True it takes an exclusive min and inclusive max row
+        # id for the base table (in that order).
         colnames = []
+        coltypes = []
         sub = {P.unique_identifier: 'participant'}
 
         # if P.default_participant_fields(_sf) is defined use that, but otherwise use
@@ -760,40 +1653,73 @@ class DatabaseManager(EnvAgent):
             for colname in self._primary.get_columns('participants'):
                 if colname not in ['id'] + P.exclude_data_cols:
                     colnames.append(colname)
+        schema = self._primary.table_schemas['participants']
+        for colname in colnames:
+            coltypes.append(schema[colname]['type'] if colname in schema else PY_STR)
         for colname in P.append_info_cols:
             if colname not in self._primary.get_columns('session_info'):
                 err = "Column '{0}' does not exist in the session_info table."
                 raise RuntimeError(err.format(colname))
             colnames.append(colname)
+            coltypes.append(self._primary.table_schemas['session_info'][colname]['type'])
         for t in [base_table] + join_tables:
-            for colname in self._primary.get_columns(t):
+            for colname, info in self._primary.table_schemas[t].items():
                 if colname not in ['id', P.id_field_name] + P.exclude_data_cols:
                     colnames.append(colname)
+                    coltypes.append(info['type'])
         column_names = TAB.join(colnames)
         for colname in sub.keys():
             column_names = column_names.replace(colname, sub[colname])
-        
+
+        selected_cols = ",".join(["participants.id"] + ["`"+col+"`" for col in colnames])
+        q = "SELECT " + selected_cols + " FROM participants "
+        if len(P.append_info_cols) and 'session_info' in self._primary.table_schemas:
+            info_cols = ",".join(['participant_id'] + P.append_info_cols)
+            q += "JOIN (SELECT " + info_cols + " FROM session_info) AS info "
+            q += "ON participants.id = info.participant_id "
+        for t in [base_table] + join_tables:
+            q += "JOIN {0} ON participants.id = {0}.participant_id ".format(t)
+        filters = []
+        if id_range:
+            filters.append("participants.id BETWEEN ? AND ?")
+        if row_range:
+            filters.append("{0}.id > ? AND {0}.id <= ?".format(base_table))
+        if len(filters):
+            q += "WHERE " + " AND ".join(filters) + " "
+        # NOTE: Ordering by the base table's participant_id (instead of the equivalent
+        # participants.id) lets SQLite use its participant_id index for sorting
+        if 'id' in self._primary.get_columns(base_table):
+            q += "ORDER BY {0}.participant_id, {0}.id".format(base_table)
+        else:
+            q += "ORDER BY participants.id"
+
+        return column_names.split(TAB), coltypes, q
+
+
+    def _iter_export_data(self, base_table, multi_file=True, join_tables=[], row_range=None):
+        # Streams the export data for each participant in the database, yielding the
+        # id of each participant along with an iterator over their rows of data.
+        # If a row range is given, only rows of the base table within it are exported.
+        colnames, coltypes, q = self._export_query(
+            base_table, multi_file, join_tables, row_range=(row_range is not None)
+        )
+        p_ids = self._primary.query("SELECT `id` FROM `participants` ORDER BY `id`")
+        rows = _iter_export_rows(self._primary.db, q, row_range or ())
+        return colnames, coltypes, _group_by_participant(rows, [p[0] for p in p_ids])
+
+
+    def collect_export_data(self, base_table, multi_file=True, join_tables=[]):
+        colnames, _, participants = self._iter_export_data(
+            base_table, multi_file, join_tables
+        )
         data = []
-        for p in participant_ids:
-            selected_cols = ",".join(["`"+col+"`" for col in colnames])
-            q = "SELECT " + selected_cols + " FROM participants "
-            if len(P.append_info_cols) and 'session_info' in self._primary.table_schemas:
-                info_cols = ",".join(['participant_id'] + P.append_info_cols)
-                q += "JOIN (SELECT " + info_cols + " FROM session_info) AS info "
-                q += "ON participants.id = info.participant_id "
-            for t in [base_table] + join_tables:
-                q += "JOIN {0} ON participants.id = {0}.participant_id ".format(t)
-            q += " WHERE participants.id = ?"
-            p_data = [] 
-            for trial in self._primary.query(q, q_vars=tuple([p[0]])):
-                row_str = TAB.join(utf8(col) for col in trial)
-                p_data.append(row_str)
-            data.append([p[0], p_data])
-
-        return [column_names, data]
-
-
-    def export(self, table=None, multi_file=True, join_tables=None):
+        for pid, p_data in participants:
+            data.append([pid, [TAB.join(utf8(col) for col in row) for row in p_data]])
+        return [TAB.join(colnames), data]
+
+
+    def export(self, table=None, multi_file=True, join_tables=None, jobs=1, fmt='txt',
+            incremental=False):
         #TODO: make option for exporting non-devmode/complete participants only
         table = P.primary_table if not table else table
         try:
@@ -801,48 +1727,168 @@ class DatabaseManager(EnvAgent):
         except TypeError:
             join_tables = []
 
-        _set_type_conversions(export=True)
-        column_names, data = self.collect_export_data(table, multi_file, join_tables)
+        if incremental:
+            if multi_file or fmt != 'txt':
+                e = "Incremental export is only supported for combined text files."
+                raise ValueError(e)
+            if not 'id' in self._primary.get_columns(table):
+                e = "Incremental export requires an 'id' column in the '{0}' table."
+                raise ValueError(e.format(table))
+
+        # Validate the export format, falling back to .npz if pyarrow is missing
+        if fmt not in _export_formats.keys():
+            e = "Unsupported export format '{0}' (must be one of {1})."
+            raise ValueError(e.format(fmt, ", ".join(_export_formats.keys())))
+        if fmt in ('parquet', 'arrow') and not package_available('pyarrow'):
+            print("    - pyarrow is not installed, exporting to .npz format instead.")
+            fmt = 'npz'
+        ext = _export_formats[fmt]
+
+        # Typed formats get booleans as True/False instead of R-style strings
+        _set_type_conversions(export=(fmt == 'txt'))
 
         if multi_file:
-            for p_id, trials in data:
-                header = _build_export_header(self._primary, p_id)
-                incomplete = (self._is_complete(p_id) == False)
-                created = self._primary.select(
-                    'participants', ['created'], where={'id': p_id}
-                )[0][0]
-                id_info = (p_id, created, incomplete)
-                file_path = _build_filepath(True, id_info, table, join_tables)
+            # Gather export info for all participants up front
+            runtime_info = _collect_runtime_info(self._primary)
+            completion = self._get_completion()
+            exported = self._get_exported(table)
+            created = dict(self._primary.query("SELECT id, created FROM participants"))
+            files = []
+            for p_id in sorted(created.keys()):
+                header = _build_export_header(self._primary, p_id, runtime_info)
+                id_info = (p_id, created[p_id], not completion[p_id])
+                file_path = _build_filepath(True, id_info, table, join_tables, ext=ext)
                 # If file already exists at path and id/table was already exported, skip
                 if os.path.exists(file_path):
-                    if self._already_exported(p_id, table):
+                    if p_id in exported:
                         continue
                     file_path = _build_filepath(
-                        True, id_info, table, join_tables, duplicate=True
+                        True, id_info, table, join_tables, duplicate=True, ext=ext
                     )
-                # Actually write out the file
-                with io.open(file_path, 'w+', encoding='utf-8') as out:
-                    out.write(u"\n".join([header, column_names, "\n".join(trials)]))
-                self._log_export(p_id, table) # Log successful export in database
-                print("    - Participant {0} successfully exported.".format(p_id))
+                files.append((p_id, header, file_path))
+
+            # Split participants into ranges and write out their files, using
+            # multiple worker processes if requested
+            colnames, coltypes, q = self._export_query(table, multi_file, join_tables, True)
+            n_chunks = min(len(files), max(1, jobs) * 4)
+            chunks = _split_contiguous(files, n_chunks)
+            tasks = [(self._path, q, colnames, coltypes, fmt, c) for c in chunks]
+            done = []
+            if jobs > 1 and len(tasks) > 1:
+                pool = multiprocessing.Pool(min(jobs, len(tasks)))
+                results = pool.imap_unordered(_export_participants, tasks)
+            else:
+                pool = None
+                results = map(_export_participants, tasks)
+            try:
+                for p_ids in results:
+                    for p_id in p_ids:
+                        print("    - Participant {0} successfully exported.".format(p_id))
+                    done += p_ids
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
+                # Log successful exports in database
+                self._log_export(sorted(done), table)
         else:
-            combined_data = []
-            p_count = 0
-            for data_set in data:
-                p_count += 1
-                combined_data += data_set[1]
-            header = _build_export_header(self._primary)
-            # If file already exists, add numeric suffix
-            file_path = _build_filepath(multi=False, base=table, joined=join_tables)
-            if os.path.exists(file_path):
+            file_path = _build_filepath(
+                multi=False, base=table, joined=join_tables, ext=ext, incremental=incremental
+            )
+            row_range = None
+            append = False
+            if incremental:
+                # Only export rows added to the base table since the last export,
+                # appending them to a dedicated file for incremental exports. Marks
+                # are logged separately from regular exports so that they don't
+                # affect which participants are skipped by per-participant exports.
+                key = "+".join([table] + join_tables) + ":incremental"
+                self._ensure_export_marks()
+                last_id = self._get_export_mark(key)
+                append = last_id is not None and os.path.exists(file_path)
+                max_id = self._primary.last_row_id(table)
+                row_range = (last_id if append else 0, max_id or 0)
+            colnames, coltypes, participants = self._iter_export_data(
+                table, multi_file, join_tables, row_range
+            )
+            # If file already exists (and not appending to it), add numeric suffix
+            if os.path.exists(file_path) and not (append or incremental):
                 file_path = _build_filepath(
-                    multi=False, base=table, joined=join_tables, duplicate=True
+                    multi=False, base=table, joined=join_tables, duplicate=True, ext=ext
                 )
-            # Actually write out the file
-            with io.open(file_path, 'w+', encoding='utf-8') as out:
-                out.write(u"\n".join([header, column_names, "\n".join(combined_data)]))
-            msg = "    - Data for {0} participant{1} successfully exported."
-            print(msg.format(p_count, "" if p_count == 1 else "s"))
+            # Actually write out the file, streaming each participant's data to it
+            p_count = 0
+            row_count = 0
+            exported = []
+            def _combined_rows():
+                nonlocal p_count, row_count
+                for p_id, trials in participants:
+                    p_count += 1
+                    for row in trials:
+                        if not len(exported) or exported[-1] != p_id:
+                            exported.append(p_id)
+                        row_count += 1
+                        yield row
+            if append:
+                _append_export_file(file_path, _combined_rows())
+                msg = "    - {0} new row{1} of data successfully exported."
+                print(msg.format(row_count, "" if row_count == 1 else "s"))
+            else:
+                header = _build_export_header(self._primary)
+                _write_export_file(
+                    file_path, fmt, header, colnames, coltypes, _combined_rows()
+                )
+                msg = "    - Data for {0} participant{1} successfully exported."
+                print(msg.format(p_count, "" if p_count == 1 else "s"))
+            if incremental:
+                self._log_export(exported, key, last_row_id=row_range[1])
+
+
+    def analyze(self):
+        """Updates the database's query planner statistics and checks the query plans
+        of common data lookups for any slow steps.
+
+        For databases from older projects, this also adds any missing internal
+        tables (e.g. 'frame_stats') and indexes for the 'participant_id' column of
+        each table, which are otherwise only created when the database is built.
+
+        Query plan steps are considered slow if they scan through the entire
+        contents of a data table or need to build a temporary index to sort
+        results.
+
+        Returns:
+            list: A list of ``(query, plan, slow)`` tuples for each checked query,
+            where ``plan`` is a list of the query's plan steps and ``slow`` is
+            a list of any slow steps in the plan.
+
+        """
+        # Add any missing internal tables and participant_id indexes
+        if not 'frame_stats' in self._primary.tables:
+            self._primary.query(frame_stats_schema)
+            self._primary.table_schemas = self._primary._build_table_schemas()
+        _create_indexes(self._primary.cursor)
+        self._primary.query("ANALYZE", commit=True)
+
+        # Gather per-participant lookups for each table, along with the export query
+        queries = []
+        for table in self._primary.tables:
+            if 'participant_id' in self._primary.get_columns(table):
+                q = "SELECT * FROM `{0}` WHERE participant_id = ?".format(table)
+                queries.append(q)
+        queries.append(self._export_query(P.primary_table, id_range=True)[2])
+
+        results = []
+        for q in queries:
+            q_vars = [1] * q.count("?")
+            plan = [row[-1] for row in self._primary.query("EXPLAIN QUERY PLAN " + q, q_vars)]
+            slow = []
+            for step in plan:
+                scan = re.match(r"SCAN (?:TABLE )?(\w+)", step)
+                if (scan and scan.group(1) != 'participants') or "TEMP B-TREE" in step:
+                    slow.append(step)
+            results.append((q, plan, slow))
+
+        return results
 
 
     def num_data_rows(self, unique_id):
@@ -912,6 +1958,7 @@ class DatabaseManager(EnvAgent):
     ## Convenience methods that all pass to corresponding method of current DB ##
 
     def commit(self):
+        self._current.flush_deferred()
         self._current.db.commit()
 
     def exists(self, *args, **kwargs):
@@ -109,6 +109,14 @@ class EventManager(object):
             raise ValueError(err.format(label))
 
 
+    def _time_until_next(self):
+        # Gets the time (in ms) until the onset of the next event that hasn't
+        # occurred yet, or None if there are no upcoming events
+        now = self.time_elapsed
+        pending = [t - now for t in self.events.values() if t >= now]
+        return min(pending) if pending else None
+
+
     def add_event(self, label, onset, after=None):
         """Adds an event to the event manager.
         
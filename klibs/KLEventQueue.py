@@ -18,7 +18,8 @@ or pass the queue contents to a function that processes input events (e.g.
 
 # TODO: Consider whether additional functions/objects would be useful
 
-from sdl2 import SDL_PumpEvents, SDL_FlushEvents, SDL_FIRSTEVENT, SDL_LASTEVENT
+from sdl2 import (SDL_PumpEvents, SDL_FlushEvents, SDL_WaitEventTimeout,
+    SDL_FIRSTEVENT, SDL_LASTEVENT)
 from sdl2.ext import get_events
 
 
@@ -54,6 +55,39 @@ def pump(return_events=True):
     return get_events()
 
 
+def wait(timeout):
+    """Waits for new input events, then retrieves the contents of the input
+    event queue.
+
+    Unlike repeatedly calling :func:`pump` in a loop, this lets the process sleep
+    until an input event arrives (or the timeout expires), leaving the CPU idle
+    between events. Because SDL timestamps input events when they arrive rather
+    than when they are retrieved, waiting does not affect the timing of events
+    read from the queue::
+
+        q = wait(0.5) # Wait up to 500 ms for input
+        if key_pressed('space', queue=q):
+            response = True
+
+    Note that the timeout is rounded down to the nearest millisecond, so that
+    waiting never extends past it. If the queue already contains events, this
+    returns immediately.
+
+    Args:
+        timeout (float or None): The maximum time (in seconds) to wait for new
+            input. If None, this will wait indefinitely.
+
+    Returns:
+        list: A list of ``SDL_Event`` objects, which may be empty if the wait timed
+        out.
+
+    """
+    # With a null event pointer, SDL leaves the next event in the queue
+    timeout_ms = -1 if timeout is None else max(0, int(timeout * 1000))
+    SDL_WaitEventTimeout(None, timeout_ms)
+    return get_events()
+
+
 def flush():
     """Clears all unprocessed events from the input event queue.
     
@@ -38,6 +38,9 @@ class Experiment(EnvAgent):
         if P.manual_trial_generation is False:
             self.trial_factory.generate()
         self.event_code_generator = None
+        self.prerendered = {} # stimuli pre-rendered for the current trial
+        self._render_pool = None
+        self._next_render = None # (trial, future) for the upcoming trial
 
 
     def __execute_experiment__(self, *args, **kwargs):
@@ -49,6 +52,13 @@ class Experiment(EnvAgent):
         if self.blocks == None:
             self.blocks = self.trial_factory.export_trials()
 
+        # If the experiment defines a prerender method, use a pool of background
+        # threads to render each trial's stimuli during the previous trial
+        prerender = type(self).prerender is not Experiment.prerender
+        if prerender and P.prerender_workers > 0:
+            from klibs.KLGraphics import RenderPool
+            self._render_pool = RenderPool(P.prerender_workers)
+
         P.block_number = 0
         P.trial_id = 0
         for block in self.blocks:
@@ -60,6 +70,8 @@ class Experiment(EnvAgent):
             for trial in block:  # ie. list of trials
                 try:
                     P.trial_id += 1 # Increments regardless of recycling
+                    if prerender:
+                        self.__prerender__(trial, block.peek())
                     self.__trial__(trial, block.practice)
                     P.trial_number += 1
                 except TrialException:
@@ -67,6 +79,11 @@ class Experiment(EnvAgent):
                     P.recycle_count += 1
                     clear() # NOTE: is this actually wanted?
                 self.rc.reset()
+            # Write out any deferred trial data between blocks
+            self.database.commit()
+        if self._render_pool:
+            self._render_pool.shutdown()
+            self._render_pool = None
         self.clean_up()
 
         self.incomplete = False
@@ -81,6 +98,7 @@ class Experiment(EnvAgent):
         """
         from klibs.KLEventQueue import pump
         from klibs.KLUserInterface import show_cursor, hide_cursor
+        from klibs.KLGraphics import reset_frame_stats
 
         # At start of every trial, before setup_response_collector or trial_prep are run, retrieve
         # the values of the independent variables (factors) for that trial (as generated earlier by
@@ -99,8 +117,10 @@ class Experiment(EnvAgent):
             if P.eye_tracking and not P.manual_eyelink_recording:
                 self.el.start(P.trial_number)
             P.in_trial = True
+            reset_frame_stats()
             self.__log_trial__(self.trial())
             P.in_trial = False
+            self.__log_frame_stats__()
             if P.eye_tracking and not P.manual_eyelink_recording:
                 self.el.stop()
             if P.development_mode and (P.dm_trial_show_mouse or (P.eye_tracking and not P.eye_tracker_available)):
@@ -118,6 +138,30 @@ class Experiment(EnvAgent):
             raise tx
 
 
+    def __prerender__(self, trial, next_trial):
+        """Internal method, gets the pre-rendered stimuli for the current trial and starts
+        rendering the stimuli for the next one in the background.
+
+        """
+        from klibs.KLGraphics import render_stimuli
+
+        # If the current trial's stimuli weren't rendered during the last trial (e.g. at
+        # the start of a block, or if the trial order changed due to recycling), render
+        # them now. Discarded renders are waited on so they can't overlap with this one,
+        # ignoring any errors since their stimuli are no longer needed.
+        pending, self._next_render = self._next_render, None
+        if pending and pending[0] is trial:
+            self.prerendered = pending[1].result()
+        else:
+            if pending:
+                pending[1].exception()
+            self.prerendered = render_stimuli(self.prerender(trial))
+
+        if self._render_pool and next_trial is not None:
+            future = self._render_pool.submit(self.prerender, next_trial)
+            self._next_render = (next_trial, future)
+
+
     def __log_trial__(self, trial_data):
         """Internal method, logs trial data to database.
 
@@ -129,7 +173,23 @@ class Experiment(EnvAgent):
         for attr in trial_data:
             trial_template.log(attr, trial_data[attr])
 
-        return self.database.insert(trial_template)
+        return self.database.insert(trial_template, defer=P.deferred_trial_logging)
+
+
+    def __log_frame_stats__(self):
+        """Internal method, logs the frame timing stats for the trial to the database.
+
+        """
+        from klibs.KLGraphics import frame_stats
+
+        if not P.log_frame_stats or not 'frame_stats' in self.database.tables:
+            return
+        stats = frame_stats()
+        stats.update({
+            'participant_id': P.participant_id, 'trial_id': P.trial_id,
+            'block_num': P.block_number, 'trial_num': P.trial_number,
+        })
+        self.database.insert(stats, table='frame_stats', defer=P.deferred_trial_logging)
 
 
     ## Define abstract methods to be overridden in experiment.py ##
@@ -160,6 +220,33 @@ class Experiment(EnvAgent):
         """
         pass
     
+    def prerender(self, trial):
+        """Optional, creates the stimuli for a given trial so that they can be rendered
+        ahead of time. If defined, this is run in a background thread during each trial to
+        prepare the stimuli for the next one, with the rendered stimuli available as NumPy
+        arrays in ``self.prerendered`` during :meth:`trial_prep` and :meth:`trial`.
+
+        Because it runs during a different trial, this method must only use the factor
+        values in ``trial`` (not the ones set as attributes of the experiment) and must not
+        draw anything to the screen. For example::
+
+           def prerender(self, trial):
+               cue = message(trial['cue_word'], "cue", blit_txt=False)
+               target = kld.Annulus(self.target_size, 10, fill=trial['target_color'])
+               return {'cue': cue, 'target': target}
+
+        Valid stimulus types are listed in :func:`~klibs.KLGraphics.render_stimuli`.
+        Set ``P.prerender_workers`` to 0 to render stimuli just before each trial instead.
+
+        Args:
+            trial (dict): The factor values for the trial, with factor names as keys.
+
+        Returns:
+            dict: The stimuli to render for the trial, with names as keys.
+
+        """
+        return None
+
     @abstractmethod
     def trial_prep(self):
         """Run immediately before the start of every trial. All trial preparation unrelated to
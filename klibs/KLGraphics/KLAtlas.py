@@ -0,0 +1,308 @@
+__author__ = 'Austin Hurst'
+
+import ctypes
+from collections import OrderedDict
+
+import numpy as np
+import OpenGL.GL as gl
+from OpenGL.raw.GL.VERSION import GL_1_1 as rawgl
+from PIL import Image
+
+from klibs import P
+from .utils import _build_registrations, add_alpha
+
+
+def _pack_shelves(sizes, max_size, padding=0):
+    # Packs a list of (width, height) rectangles into as few max_size x max_size
+    # pages as possible using a first-fit shelf packing algorithm, placing the
+    # tallest rectangles first. Returns a list of (page, x, y) positions in the
+    # same order as the input sizes.
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i][1], sizes[i][0]), reverse=True)
+    positions = [None] * len(sizes)
+    pages = [] # a list of [shelf_y, shelf_height, next_x] shelves for each page
+    for i in order:
+        w, h = (sizes[i][0] + padding, sizes[i][1] + padding)
+        if w > max_size or h > max_size:
+            e = "Stimulus of size {0}x{1} is too large for an atlas of size {2}x{2}."
+            raise ValueError(e.format(sizes[i][0], sizes[i][1], max_size))
+        placed = False
+        for page, shelves in enumerate(pages):
+            # Try fitting the rectangle on an existing shelf
+            for shelf in shelves:
+                if h <= shelf[1] and shelf[2] + w <= max_size:
+                    positions[i] = (page, shelf[2], shelf[0])
+                    shelf[2] += w
+                    placed = True
+                    break
+            if placed:
+                break
+            # Otherwise, try starting a new shelf on the page
+            shelf_y = shelves[-1][0] + shelves[-1][1]
+            if shelf_y + h <= max_size:
+                shelves.append([shelf_y, h, w])
+                positions[i] = (page, 0, shelf_y)
+                placed = True
+                break
+        if not placed:
+            pages.append([[0, h, w]])
+            positions[i] = (len(pages) - 1, 0, 0)
+    return positions
+
+
+
+class AtlasRegion(object):
+    """A single stimulus packed into a :class:`TextureAtlas`.
+
+    Atlas regions can be drawn to the screen using :func:`~klibs.KLGraphics.blit`
+    or added to a :class:`~klibs.KLGraphics.KLScene.Scene` just like any other
+    stimulus. Regions should not be created directly, but instead retrieved from
+    their atlas by name (e.g. ``atlas['target']``).
+
+    Attributes:
+        name (str): The name of the stimulus in the atlas.
+        width (int): The width of the stimulus (in pixels).
+        height (int): The height of the stimulus (in pixels).
+
+    """
+    def __init__(self, atlas, name, page, x, y, width, height):
+        self.atlas = atlas
+        self.name = name
+        self.page = page
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.uv = None # texture coordinates of the region, set once the atlas is built
+
+    def __repr__(self):
+        s = "<klibs.KLGraphics.AtlasRegion(name={0}, width={1}, height={2})>"
+        return s.format(repr(self.name), self.width, self.height)
+
+    def _texture(self):
+        # Gets the id of the OpenGL texture containing the region
+        return self.atlas._get_texture(self.page)
+
+
+
+class TextureAtlas(object):
+    """A collection of stimuli packed together into a small number of large
+    textures.
+
+    Drawing a large number of small stimuli (e.g. the items in a visual search
+    array) normally requires binding a separate texture for each one. By packing
+    the stimuli together into a few large textures (pages), any number of them
+    can be drawn with a single draw call per page using :meth:`blit` or a
+    :class:`~klibs.KLGraphics.KLScene.Scene`.
+
+    For example, to draw a search array of randomly-placed T and L shapes, you
+    could do::
+
+       self.atlas = TextureAtlas()
+       self.atlas.add('T', t_shape)
+       self.atlas.add('L', l_shape)
+       self.atlas.build()
+
+       # and then, within a trial:
+       fill()
+       self.atlas.blit(self.item_names, self.item_locs, registration=5)
+       flip()
+
+    The contents of an atlas are copied when it is built, so any later changes
+    to the stimuli added to it will not be reflected in the atlas unless it is
+    rebuilt.
+
+    Args:
+        max_size (int, optional): The maximum width and height (in pixels) of each
+            texture page in the atlas. Defaults to 2048.
+        padding (int, optional): The number of transparent pixels to leave between
+            stimuli in the atlas. Defaults to 1.
+
+    """
+    def __init__(self, max_size=2048, padding=1):
+        self.max_size = max_size
+        self.padding = padding
+        self._stimuli = OrderedDict()
+        self._regions = {}
+        self._pages = []
+        self._textures = []
+
+
+    def __len__(self):
+        return len(self._stimuli)
+
+
+    def __contains__(self, name):
+        return name in self._stimuli
+
+
+    def __getitem__(self, name):
+        try:
+            return self._regions[name]
+        except KeyError:
+            if name in self._stimuli:
+                raise RuntimeError("The atlas must be built before its regions can be used.")
+            raise KeyError("No stimulus named '{0}' in the atlas.".format(name))
+
+
+    def add(self, name, stimulus):
+        """Adds a stimulus to the atlas.
+
+        Valid stimulus types are the same as for :func:`~klibs.KLGraphics.blit`.
+        Stimuli added after the atlas has been built will not be available until
+        :meth:`build` is called again.
+
+        Args:
+            name (str): The name to use for the stimulus in the atlas.
+            stimulus: The shape, image, or other texture to add to the atlas.
+
+        Raises:
+            TypeError: If the stimulus is not a supported type.
+
+        """
+        from .core import _get_content
+        if isinstance(stimulus, Image.Image):
+            stimulus = np.asarray(stimulus.convert('RGBA'))
+        elif isinstance(stimulus, np.ndarray):
+            stimulus = add_alpha(stimulus)
+        content, width, height, _ = _get_content(stimulus)
+        self._stimuli[name] = np.asarray(content, dtype=np.uint8)
+
+
+    def build(self):
+        """Packs all stimuli in the atlas into textures.
+
+        This only needs to be called once after all stimuli have been added to the
+        atlas. The textures will be uploaded to the GPU the first time the atlas
+        is drawn.
+
+        Returns:
+            int: The number of texture pages needed to contain all stimuli.
+
+        """
+        self.release()
+        names = list(self._stimuli.keys())
+        sizes = [(arr.shape[1], arr.shape[0]) for arr in self._stimuli.values()]
+        positions = _pack_shelves(sizes, self.max_size, self.padding)
+
+        # Determine the actual size needed for each page and copy in each stimulus
+        n_pages = max([pos[0] for pos in positions]) + 1 if len(positions) else 0
+        extents = [[1, 1] for i in range(n_pages)]
+        for (page, x, y), (w, h) in zip(positions, sizes):
+            extents[page][0] = max(extents[page][0], x + w)
+            extents[page][1] = max(extents[page][1], y + h)
+        self._pages = [np.zeros((h, w, 4), dtype=np.uint8) for w, h in extents]
+        self._regions = {}
+        for name, (page, x, y), (w, h) in zip(names, positions, sizes):
+            self._pages[page][y:y+h, x:x+w] = self._stimuli[name]
+            region = AtlasRegion(self, name, page, x, y, w, h)
+            page_h, page_w = self._pages[page].shape[:2]
+            region.uv = (
+                x / float(page_w), y / float(page_h),
+                (x + w) / float(page_w), (y + h) / float(page_h)
+            )
+            self._regions[name] = region
+        self._textures = [None] * n_pages
+        return n_pages
+
+
+    def _get_texture(self, page):
+        # Gets the OpenGL texture for a given page, uploading it first if needed
+        from .core import _create_texture
+        if self._textures[page] is None:
+            h, w = self._pages[page].shape[:2]
+            self._textures[page] = _create_texture(self._pages[page], w, h)
+        return self._textures[page]
+
+
+    def blit(self, names, locations, registration=7, flip_x=False):
+        """Draws multiple stimuli from the atlas to the display buffer at once.
+
+        All stimuli are drawn with a single draw call for each texture page they
+        are on, making this much faster than blitting each stimulus individually.
+        Stimuli are drawn in the order given (i.e. later ones on top).
+
+        Args:
+            names (list): The names of the stimuli to draw. The same stimulus can
+                be drawn more than once.
+            locations (list): The (x, y) pixel coordinates at which to draw each
+                stimulus.
+            registration (int or list, optional): An integer from 1 to 9 indicating
+                which point on the stimuli to align to their locations, or a list of
+                registrations for each stimulus. Defaults to 7 (top-left corner).
+            flip_x (bool, optional): If True, the stimuli will be flipped along their
+                x-axes when drawn. Defaults to False.
+
+        Raises:
+            ValueError: If the number of names and locations do not match.
+
+        """
+        if len(names) != len(locations):
+            raise ValueError("The number of stimulus names and locations must match.")
+        if isinstance(registration, int):
+            registration = [registration] * len(names)
+
+        # Build the vertex arrays for each page, keeping the drawing order
+        flipped = flip_x or P.blit_flip_x
+        quads = OrderedDict()
+        for name, loc, reg in zip(names, locations, registration):
+            region = self[name]
+            try:
+                x_offset, y_offset = _build_registrations(region.height, region.width)[reg]
+            except (IndexError, ValueError):
+                raise ValueError("Registration must be an integer between 1 and 9 inclusive")
+            x1, y1 = (loc[0] + int(x_offset), loc[1] + int(y_offset))
+            x2, y2 = (x1 + region.width, y1 + region.height)
+            u1, v1, u2, v2 = region.uv
+            if flipped:
+                u1, u2 = (u2, u1)
+            if not region.page in quads:
+                quads[region.page] = []
+            quads[region.page] += [
+                (x1, y1, u1, v1), (x1, y2, u1, v2), (x2, y2, u2, v2), (x2, y1, u2, v1)
+            ]
+        if not len(quads):
+            return
+
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glTexEnvi(gl.GL_TEXTURE_ENV, gl.GL_TEXTURE_ENV_MODE, gl.GL_REPLACE)
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        for page, verts in quads.items():
+            verts = np.array(verts, dtype=np.float32)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, self._get_texture(page))
+            rawgl.glVertexPointer(2, gl.GL_FLOAT, 16, ctypes.c_void_p(verts.ctypes.data))
+            rawgl.glTexCoordPointer(2, gl.GL_FLOAT, 16, ctypes.c_void_p(verts.ctypes.data + 8))
+            gl.glDrawArrays(gl.GL_QUADS, 0, len(verts))
+        gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glDisable(gl.GL_TEXTURE_2D)
+
+
+    def release(self):
+        """Frees the GPU memory used by the atlas' textures.
+
+        The atlas can still be drawn after being released, but its textures will
+        need to be uploaded to the GPU again.
+
+        """
+        textures = [t for t in self._textures if t is not None]
+        if len(textures):
+            gl.glDeleteTextures(textures)
+        self._textures = [None] * len(self._pages)
+
+
+    @property
+    def names(self):
+        """list: The names of all stimuli in the atlas.
+
+        """
+        return list(self._stimuli.keys())
+
+
+    @property
+    def pages(self):
+        """list: The packed RGBA texture pages of the atlas, as NumPy arrays.
+
+        """
+        return self._pages
@@ -1,7 +1,9 @@
 __author__ = 'Jonathan Mulle & Austin Hurst'
 
 import abc
+import threading
 from bisect import bisect
+from collections import OrderedDict
 from os.path import join
 from math import cos, sin, radians, ceil, sqrt
 
@@ -28,6 +30,63 @@ __all__ = [
 ]
 
 
+class _RenderCache(object):
+    # A process-wide LRU cache of rendered shapes, so that identical Drawbjects
+    # (e.g. a new fixation cross created every trial) share a single rendered array
+    # instead of each being drawn from scratch. Shapes are keyed by their class and
+    # drawing parameters, and the least-recently used shapes are dropped whenever
+    # the total size of the cache would exceed P.draw_cache_size. Since shapes can
+    # be rendered in background threads, all access is guarded by a lock. Textures
+    # for cached shapes stay on the GPU (within P.texture_cache_size) until their
+    # arrays are dropped from this cache.
+
+    def __init__(self):
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def get(self, key):
+        # Gets the rendered array for a given shape key, or None if not cached
+        with self._lock:
+            arr = self._arrays.get(key, None)
+            if arr is not None:
+                self._arrays.move_to_end(key)
+            return arr
+
+    def add(self, key, arr):
+        # Adds a rendered array to the cache, evicting the least-recently used
+        # arrays if needed. Returns False if the array is too large to be cached.
+        budget = P.draw_cache_size * 1024 * 1024
+        if arr.nbytes > budget:
+            return False
+        with self._lock:
+            if key in self._arrays:
+                self.size -= self._arrays.pop(key).nbytes
+            while len(self._arrays) and self.size + arr.nbytes > budget:
+                self.size -= self._arrays.popitem(last=False)[1].nbytes
+            self._arrays[key] = arr
+            self.size += arr.nbytes
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._arrays = OrderedDict()
+            self.size = 0
+
+
+_render_cache = _RenderCache()
+
+
+def _hashable(value):
+    # Converts any lists in a drawing parameter to tuples so it can be hashed
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
 def cursor(color=None):
     dc =  Draw("RGBA", [32, 32], (0, 0, 0, 0))
     if color is not None:
@@ -109,8 +168,9 @@ class Drawbject(object):
         surface (:obj:`aggdraw.Draw`): The aggdraw context on which the shape is drawn.
             When a shape is drawn to the surface, it is immediately applied to the canvas.
         canvas (:obj:`PIL.Image.Image`): The Image object that contains the shape of the
-            Drawbject before opacity has been applied. Initialized upon creation with a
-            size of (surface_width x surface_height).
+            Drawbject before opacity has been applied, with a size of (surface_width x
+            surface_height). If the shape's render was fetched from the cache, the
+            canvas is only drawn once it is accessed.
         rendered (None or :obj:`numpy.array`): The rendered surface containing the shape,
             which is created using the render() method. If the Drawbject has not yet been
             rendered, this attribute will be 'None'.
@@ -121,11 +181,18 @@ class Drawbject(object):
 
     transparent_brush = Brush((255, 0, 0), 0)
 
+    # Names of any shape-specific attributes that affect how the shape is drawn. Only
+    # Drawbject classes that define this themselves have their renders cached, since
+    # subclasses may add parameters that the cache wouldn't know about.
+    _cache_attrs = None
+
     def __init__(self, width, height, stroke, fill, rotation=0):
         super(Drawbject, self).__init__()
 
-        self.surface = None
-        self.canvas = None
+        self._surface = None
+        self._canvas = None
+        self._draw_pending = False
+        self._initialized = False
         self.rendered = None
 
         self.__stroke = None
@@ -144,6 +211,7 @@ class Drawbject(object):
         self.rotation = rotation
 
         self._init_surface()
+        self._initialized = True
 
 
     def __str__(self):
@@ -151,8 +219,15 @@ class Drawbject(object):
         return "klibs.Drawbject.{0} ({1} x {2}) at {3}".format(*properties)
 
     def _init_surface(self):
+        # Resets the shape's drawing surface, which is created once it's needed
         self._update_dimensions()
         self.rendered = None # Clear any existing rendered texture
+        self._canvas = None
+        self._surface = None
+        self._draw_pending = False
+
+    def _new_canvas(self):
+        # Creates a fresh canvas and drawing surface for the shape
         if self.fill_color:
             if self.stroke_color and self.fill_color[3] == 255:
                 col = self.stroke_color
@@ -162,9 +237,43 @@ class Drawbject(object):
             col = self.stroke_color
         else:
             col = (0, 0, 0)
-        self.canvas = Image.new("RGBA", self.dimensions, (col[0], col[1], col[2], 0))
-        self.surface = Draw(self.canvas)
-        self.surface.setantialias(True)
+        self._canvas = Image.new("RGBA", self.dimensions, (col[0], col[1], col[2], 0))
+        self._surface = Draw(self._canvas)
+        self._surface.setantialias(True)
+        if self._draw_pending:
+            # If the shape's render was fetched from the cache, draw it now
+            self._draw_pending = False
+            self.draw()
+
+    def _use_cached(self):
+        # Uses the cached render of an identical shape if one exists, leaving the
+        # canvas to be drawn later if it's needed. Returns False if not cached.
+        key = self._cache_key() if P.draw_cache_size > 0 else None
+        cached = _render_cache.get(key) if key is not None else None
+        if cached is None:
+            return False
+        self._init_surface()
+        self.rendered = cached
+        self._draw_pending = True
+        return True
+
+    def _auto_draw(self):
+        # Draws the shape on creation, unless an identical shape has already been
+        # rendered (in which case the canvas is drawn once it's accessed)
+        if not self._use_cached():
+            self.draw()
+
+    @property
+    def surface(self):
+        if self._surface is None:
+            self._new_canvas()
+        return self._surface
+
+    @property
+    def canvas(self):
+        if self._canvas is None:
+            self._new_canvas()
+        return self._canvas
 
     def render(self):
         """Pre-renders the shape so it can be drawn to the screen using
@@ -174,16 +283,44 @@ class Drawbject(object):
         
         Once a Drawbject has been rendered, it will not need to be rendered again unless
         any of its properties (e.g. stroke, fill, rotation) are changed.
+
+        Rendered shapes are cached (up to ``P.draw_cache_size`` MB), so that shapes with
+        the same type and drawing parameters share a single rendered array instead of each
+        being drawn separately. Since it may be shared, the returned array is read-only.
         
         Returns:
             :obj:`~numpy.ndarray`: A numpy array of the rendered shape.
 
         """
+        if self._use_cached():
+            return self.rendered
         self._init_surface()
         self.draw()
         self.rendered = asarray(self.canvas)
+        key = self._cache_key() if P.draw_cache_size > 0 else None
+        if key is not None:
+            self.rendered.flags.writeable = False
+            _render_cache.add(key, self.rendered)
         return self.rendered
 
+    def _cache_key(self):
+        # Gets a key identifying the rendered appearance of the shape, or None if
+        # the shape can't be cached
+        if not '_cache_attrs' in type(self).__dict__:
+            return None
+        params = [
+            type(self), self.dimensions, self.object_width, self.object_height,
+            self.stroke_width, self.stroke_color, self.stroke_alignment,
+            self.fill_color, self.rotation
+        ]
+        params += [getattr(self, attr) for attr in self._cache_attrs]
+        key = _hashable(params)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def _update_dimensions(self):
         pts = self._draw_points(outline=True)
         if pts != None:
@@ -251,7 +388,7 @@ class Drawbject(object):
         self.stroke_color = color
         self.stroke_width = width
         self.__stroke = Pen(tuple(color[:3]), width, color[3])
-        if self.surface: # don't call this when initializing the Drawbject for the first time
+        if self._initialized: # don't call this when initializing the Drawbject
             self._init_surface()
         return self
 
@@ -282,7 +419,7 @@ class Drawbject(object):
             color += [255]
         self.fill_color = color
         self.__fill = Brush(tuple(color[:3]), color[3])
-        if self.surface: # don't call this when initializing the Drawbject for the first time
+        if self._initialized: # don't call this when initializing the Drawbject
             self._init_surface()
         return self
 
@@ -325,13 +462,15 @@ class FixationCross(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified fixation cross.
 
     """
+    _cache_attrs = ('thickness',)
+
     def __init__(self, size, thickness, stroke=None, fill=None, rotation=0, auto_draw=True):
         self.thickness = thickness
         super(FixationCross, self).__init__(size, size, stroke, fill, rotation)
         if stroke == None:
             self._Drawbject__stroke = Pen((0, 0, 0), 0, 0)
         if auto_draw:
-            self.draw()
+            self._auto_draw()
 
     def _draw_points(self, outline=False):
         sw = self.stroke_width
@@ -369,13 +508,14 @@ class Ellipse(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified ellipse.
 
     """
+    _cache_attrs = ()
 
     def __init__(self, width, height=None, stroke=None, fill=None, auto_draw=True):
         if not height:
             height = width
         super(Ellipse, self).__init__(width, height, stroke, fill)
         if auto_draw:
-            self.draw()
+            self._auto_draw()
 
     def draw(self):
         surf_c = self.surface_width / 2.0 # center of the drawing surface
@@ -450,6 +590,7 @@ class Circle(Ellipse):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified circle.
 
     """
+    _cache_attrs = ()
 
     def __init__(self, diameter, stroke=None, fill=None, auto_draw=True):
         super(Circle, self).__init__(diameter, diameter, stroke, fill, auto_draw)
@@ -472,6 +613,7 @@ class Annulus(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified annulus.
 
     """
+    _cache_attrs = ('thickness',)
 
     def __init__(self, diameter, thickness, stroke=None, fill=None, auto_draw=True):
         self.thickness = thickness
@@ -485,7 +627,7 @@ class Annulus(Drawbject):
         if self.thickness > self.radius:
             raise ValueError("Thickness larger than radius; reduce thickness or increase diameter")
         if auto_draw:
-            self.draw()
+            self._auto_draw()
 
     def draw(self):
         surf_c = self.surface_width / 2.0 # center of the drawing surface
@@ -541,13 +683,14 @@ class Rectangle(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified rectangle.
 
     """
+    _cache_attrs = ()
 
     def __init__(self, width, height=None, stroke=None, fill=None, rotation=0, auto_draw=True):
         if not height:
             height = width
         super(Rectangle, self).__init__(width, height, stroke, fill, rotation)
         if auto_draw:
-            self.draw()
+            self._auto_draw()
     
     def _draw_points(self, outline=False):
         so = self.stroke_offset + self.stroke_width / 2.0 if outline else self.stroke_offset
@@ -582,6 +725,8 @@ class Asterisk(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified asterisk.
 
     """
+    _cache_attrs = ('size', 'thickness', 'spokes')
+
     def __init__(self, size, thickness, fill, spokes=6, rotation=0, auto_draw=True):
         self.size = size
         self.thickness = thickness
@@ -589,7 +734,7 @@ class Asterisk(Drawbject):
         super(Asterisk, self).__init__(size, size, None, fill, rotation)
         self._Drawbject__stroke = Pen((0, 0, 0), 0, 0)
         if auto_draw:
-            self.draw()
+            self._auto_draw()
 
     def _draw_points(self, outline=False):
         ht = self.thickness / 2.0 # half of the asterisk's thickness
@@ -636,13 +781,15 @@ class SquareAsterisk(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified asterisk.
 
     """
+    _cache_attrs = ('size', 'thickness')
+
     def __init__(self, size, thickness, fill, rotation=0, auto_draw=True):
         self.size = size
         self.thickness = thickness
         super(SquareAsterisk, self).__init__(size, size, None, fill, rotation)
         self._Drawbject__stroke = Pen((0, 0, 0), 0, 0)
         if auto_draw:
-            self.draw()
+            self._auto_draw()
     
     def _draw_points(self, outline=False):
         ht = self.thickness / 2.0 # half of the asterisk's thickness
@@ -686,6 +833,7 @@ class Line(Drawbject): # Now that Rectangle Drawbjects can be rotated, is this s
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified line.
 
     """
+    _cache_attrs = ('p1', 'p2', 'margin')
 
     def __init__(self, length, color, thickness, rotation=0, pts=None, auto_draw=True):
         if pts:
@@ -711,7 +859,7 @@ class Line(Drawbject): # Now that Rectangle Drawbjects can be rotated, is this s
             print(linestr.format(*f_vars))
 
         if auto_draw:
-            self.draw()
+            self._auto_draw()
 
     def __translate_to_positive__(self):
         """Translates line coordinates into aggdraw space (i.e. top-left corner becomes (0,0)) 
@@ -758,6 +906,8 @@ class Triangle(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified triangle.
 
     """
+    _cache_attrs = ('base', 'height')
+
     def __init__(self, base, height=None, stroke=None, fill=None, rotation=0):
         self.base = base
         if not height: # if no height given, draw equilateral
@@ -804,6 +954,8 @@ class Arrow(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified arrow.
 
     """
+    _cache_attrs = ('tail_w', 'tail_h', 'head_w', 'head_h')
+
     def __init__(self, tail_w, tail_h, head_w, head_h, rotation=0, stroke=None, fill=None):
         self.tail_w = tail_w
         self.tail_h = tail_h
@@ -858,6 +1010,7 @@ class ColorWheel(Drawbject):
         :obj:`KLDraw.Drawbject`: A Drawbject containing the specified color wheel.
         
     """
+    _cache_attrs = ('thickness', 'colors')
 
     def __init__(self, diameter, thickness=None, colors=None, rotation=0, auto_draw=True):
         if colors == None:
@@ -868,7 +1021,7 @@ class ColorWheel(Drawbject):
         self.thickness = 0.20 * diameter if not thickness else thickness
         super(ColorWheel, self).__init__(diameter, diameter, None, None, rotation)
         if auto_draw:
-            self.draw()
+            self._auto_draw()
 
     def draw(self):
         rotation = self.rotation
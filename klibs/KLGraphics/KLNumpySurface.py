@@ -1,15 +1,17 @@
 __author__ = 'Jonathan Mulle & Austin Hurst'
 
+import weakref
 from copy import copy
+from collections import OrderedDict
 
 import numpy as np
 from PIL import Image
-from PIL import ImageOps, ImageChops
+from PIL import ImageOps
 import aggdraw
 
 from klibs.KLConstants import NS_BACKGROUND, NS_FOREGROUND, BL_TOP_RIGHT, BL_TOP_LEFT
 from .utils import (_build_registrations, aggdraw_to_array, image_file_to_array, add_alpha,
-    rgb_to_rgba)
+    rgb_to_rgba, alpha_composite)
 
 
 
@@ -28,6 +30,81 @@ def aggdraw_to_numpy_surface(surface):
 
 
 
+class _MaskCache(object):
+    # A small LRU cache of the (optionally inverted) alpha layers of masks, so that
+    # masks applied repeatedly (e.g. a gaze-contingent aperture applied every frame)
+    # don't need to be extracted and inverted each time. Masks are keyed by their
+    # content array (plus a version number for surfaces modified in place), and only
+    # NumpySurface and Drawbject masks are cached since raw arrays and images can be
+    # modified without warning.
+
+    def __init__(self, max_entries=16):
+        self._masks = OrderedDict()
+        self.max_entries = max_entries
+
+    def __len__(self):
+        return len(self._masks)
+
+    def get(self, content, version, invert):
+        key = (id(content), version, invert)
+        entry = self._masks.get(key, None)
+        if entry is None:
+            return None
+        if entry[0]() is not content:
+            del self._masks[key]
+            return None
+        self._masks.move_to_end(key)
+        return entry[1]
+
+    def add(self, content, version, invert, alpha):
+        while len(self._masks) >= self.max_entries:
+            self._masks.popitem(last=False)
+        self._masks[(id(content), version, invert)] = (weakref.ref(content), alpha)
+
+    def clear(self):
+        self._masks = OrderedDict()
+
+
+_masks = _MaskCache()
+
+
+def _get_mask_alpha(mask, invert):
+    # Gets the 2D alpha array to use for a given mask, inverting it if requested
+    from .KLDraw import Drawbject
+
+    content, version = (None, None)
+    if type(mask) is NumpySurface:
+        content, version = (mask.render(), mask._version)
+    elif isinstance(mask, Drawbject):
+        content = mask.rendered if mask.rendered is not None else mask.render()
+        version = 0
+    if content is not None:
+        alpha = _masks.get(content, version, invert)
+        if alpha is not None:
+            return alpha
+        alpha = content[:, :, 3]
+
+    elif type(mask) is np.ndarray:
+        mask = mask.astype(np.uint8)
+        if mask.ndim == 2:
+            alpha = mask
+        else:
+            alpha = mask[:, :, 3] if mask.shape[2] == 4 else mask[:, :, 0]
+    elif isinstance(mask, Image.Image):
+        if mask.mode != 'L':
+            mask = mask.getchannel('A' if 'A' in mask.getbands() else 0)
+        alpha = np.asarray(mask)
+    else:
+        typename = type(mask).__name__
+        raise TypeError("'{0}' is not a valid mask type.".format(typename))
+
+    alpha = 255 - alpha if invert else np.ascontiguousarray(alpha)
+    if content is not None:
+        alpha.flags.writeable = False
+        _masks.add(content, version, invert, alpha)
+    return alpha
+
+
 class NumpySurface(object):
     """A flexible object for working with images and other textures. Can be used for loading
     image files, converting images into a :func:`~klibs.KLGraphics.blit`-able format, applying
@@ -61,6 +138,14 @@ class NumpySurface(object):
 
     * :obj:`NoneType` (initializes a new surface with a given width, height, and fill)
 
+    To avoid duplicating large images in memory, RGBA arrays (including read-only
+    memory-mapped arrays) and the contents of other surfaces are used directly instead
+    of being copied. Since the content may be shared, it is only copied once the surface
+    is modified in place (e.g. by :meth:`blit` or :meth:`mask`) or its :attr:`content` is
+    accessed directly (copy-on-write), so changes to a surface never affect the source.
+    However, changes to a source array made after the surface is created will affect
+    the surface, so arrays that will be modified later should be copied first.
+
     A list of supported formats for images loaded via file path can be found
     `here <https://pillow.readthedocs.io/en/5.1.x/handbook/image-file-formats.html>`_.
 
@@ -83,6 +168,8 @@ class NumpySurface(object):
             raise TypeError("Fill color must be a tuple of RGB or RGBA values.")
 
         self.__content = None
+        self.__shared = False # whether content may be shared with other objects
+        self._version = 0 # incremented whenever content is modified in place
         self.__height = height
         self.__width = width
         self.__fill = rgb_to_rgba(fill)
@@ -104,15 +191,18 @@ class NumpySurface(object):
     def __init_content(self, new):
         from .KLDraw import Drawbject
 
+        shared = False # whether the content array is owned by another object
         if new is None:
-            new = Image.new('RGBA', (self.width, self.height), self.__fill)
-            new_arr = np.asarray(new)
+            new_arr = np.full((self.height, self.width, 4), self.__fill, dtype=np.uint8)
         elif isinstance(new, np.ndarray):
             new_arr = add_alpha(new)
+            shared = new_arr is new
         elif isinstance(new, NumpySurface):
-            new_arr = new.content
+            new_arr = new.__content
+            new.__shared = shared = True
         elif isinstance(new, Drawbject):
             new_arr = new.render()
+            shared = True
         elif isinstance(new, Image.Image):
             if new.mode == 'RGB':
                 new_arr = add_alpha(np.array(new))
@@ -129,10 +219,21 @@ class NumpySurface(object):
             e = "Cannot create a NumpySurface from an object of type '{0}'."
             raise TypeError(e.format(typename))
 
-        self.__content = new_arr.astype(np.uint8)
+        self.__content = new_arr.astype(np.uint8, copy=False)
+        if not self.__content.flags.writeable:
+            shared = True # e.g. read-only memory-mapped arrays
+        self.__shared = shared and self.__content is new_arr
         self.__update_shape()
 
 
+    def __own_content(self):
+        # Copies the surface's content if it may be shared with other objects, so that
+        # it can be safely modified in place (i.e. copy-on-write)
+        if self.__shared:
+            self.__content = np.array(self.__content)
+            self.__shared = False
+
+
     def __update_shape(self):
         try:
             self.__width = self.__content.shape[1]
@@ -148,18 +249,21 @@ class NumpySurface(object):
             :obj:`numpy.ndarray`: A 3-dimensional RGBA array of the surface content.
 
         """
-        surftype = self.content.dtype
-        return self.content if surftype == np.uint8 else self.content.astype(np.uint8)
+        surftype = self.__content.dtype
+        return self.__content if surftype == np.uint8 else self.__content.astype(np.uint8)
 
 
     def copy(self):
         """Returns a copy of the current surface as a new NumpySurface object.
 
+        The content of the copy is shared with the original surface until either of them
+        is modified, making copies cheap even for very large surfaces.
+
         Returns:
             :obj:`~NumpySurface`: A copy of the current surface.
 
         """
-        return NumpySurface(self.content.astype(np.uint8))
+        return NumpySurface(self)
 
 
     def blit(self, source, registration=7, location=(0,0), clip=True, blend=True):
@@ -229,14 +333,14 @@ class NumpySurface(object):
                     "partially outside surface bounds.")
                 raise ValueError(e.format(cx1, cy1, registration))
 
-        # Add source to surface, optionally blending alpha channels
+        # Add source to surface, optionally blending alpha channels. Only the region
+        # of the surface covered by the source is modified.
+        self.__own_content()
         if blend == True:
-            img = Image.fromarray(self.content)
-            src = Image.fromarray(source[sy1:sy2, sx1:sx2, :])
-            img.alpha_composite(src, (cx1, cy1))
-            self.__content = np.array(img)
+            alpha_composite(self.__content[cy1:cy2, cx1:cx2, :], source[sy1:sy2, sx1:sx2, :])
         else:
             self.__content[cy1:cy2, cx1:cx2, :] = source[sy1:sy2, sx1:sx2, :]
+        self._version += 1
 
         return self
 
@@ -262,9 +366,11 @@ class NumpySurface(object):
         else:
             raise ValueError("At least one of 'height' or 'width' must be provided.")
 
-        img = Image.fromarray(self.content)
+        img = Image.fromarray(self.__content)
         self.__content = np.array(img.resize(size, Image.LANCZOS))
+        self.__shared = False
         self.__update_shape()
+        self._version += 1
 
         return self
 
@@ -296,17 +402,7 @@ class NumpySurface(object):
 
         """
         # TODO: Add reference to location/registration explanation in the docstring once it's written
-        from .KLDraw import Drawbject
-
-        if type(mask) is NumpySurface:
-            mask = Image.fromarray(mask.content)
-        elif type(mask) is np.ndarray:
-            mask = Image.fromarray(mask.astype(np.uint8))
-        elif isinstance(mask, Drawbject):
-            mask = mask.draw()
-        elif not isinstance(mask, Image.Image):
-            typename = type(mask).__name__
-            raise TypeError("'{0}' is not a valid mask type.".format(typename))
+        alpha = _get_mask_alpha(mask, invert)
 
         # For handling legacy code where location was second argument
         if hasattr(registration, '__iter__') and not isinstance(registration, str):
@@ -314,28 +410,28 @@ class NumpySurface(object):
             registration = 7
 
         # Calculate top-left corner for mask, using location, registration, & size
-        registration = _build_registrations(mask.height, mask.width)[registration]
-        location = (int(location[0] + registration[0]), int(location[1] + registration[1]))
-
-        # Initialize surface and mask
-        surface_content = Image.fromarray(self.content)
-        surface_alpha = surface_content.getchannel('A')
-        if mask.mode != 'L':
-            try:
-                mask = mask.getchannel('A')
-            except:
-                mask = mask.getchannel(0)
-        if invert == True:
-            mask = ImageChops.invert(mask)
-
-        # Create a new surface-sized alpha layer and place the mask on it
-        mask_alpha = Image.new('L', surface_content.size, 0 if complete else 255)
-        mask_alpha.paste(mask, location)
-
-        # Merge the surface/mask alpha layers and replace surface alpha with result
-        new_alpha = ImageChops.darker(surface_alpha, mask_alpha)
-        surface_content.putalpha(new_alpha)
-        self.__content = np.array(surface_content)
+        mask_h, mask_w = alpha.shape
+        registration = _build_registrations(mask_h, mask_w)[registration]
+        x1, y1 = (int(location[0] + registration[0]), int(location[1] + registration[1]))
+
+        # Clip the mask region to the bounds of the surface
+        cx1, cy1 = (min(max(x1, 0), self.width), min(max(y1, 0), self.height))
+        cx2, cy2 = (max(min(x1 + mask_w, self.width), cx1), max(min(y1 + mask_h, self.height), cy1))
+        sx1, sy1 = (cx1 - x1, cy1 - y1)
+        sx2, sy2 = (sx1 + (cx2 - cx1), sy1 + (cy2 - cy1))
+
+        # Merge the mask with the surface's alpha within the mask region, making the rest
+        # of the surface transparent if doing complete masking
+        self.__own_content()
+        surface_alpha = self.__content[:, :, 3]
+        if complete:
+            surface_alpha[:cy1, :] = 0
+            surface_alpha[cy2:, :] = 0
+            surface_alpha[cy1:cy2, :cx1] = 0
+            surface_alpha[cy1:cy2, cx2:] = 0
+        region = surface_alpha[cy1:cy2, cx1:cx2]
+        np.minimum(region, alpha[sy1:sy2, sx1:sx2], out=region)
+        self._version += 1
 
         return self
 
@@ -347,14 +443,15 @@ class NumpySurface(object):
             RuntimeError: If the entire surface is transparent.
 
         """
-        img = Image.fromarray(self.content)
+        img = Image.fromarray(self.__content)
         contentbounds = img.getbbox()
         if contentbounds == None:
             raise RuntimeError('Cannot trim transparent padding from a fully transparent surface.')
 
         x1, y1, x2, y2 = contentbounds
-        self.__content = self.content[y1:y2, x1:x2, :]
+        self.__content = self.__content[y1:y2, x1:x2, :]
         self.__update_shape()
+        self._version += 1
 
         return self
 
@@ -363,8 +460,9 @@ class NumpySurface(object):
         """Flips the surface 90 degrees to the left.
 
         """
-        self.__content = np.rot90(self.content)
+        self.__content = np.rot90(self.__content)
         self.__update_shape()
+        self._version += 1
         return self
 
 
@@ -372,8 +470,9 @@ class NumpySurface(object):
         """Flips the surface 90 degrees to the right.
 
         """
-        self.__content = np.rot90(self.content, k=3)
+        self.__content = np.rot90(self.__content, k=3)
         self.__update_shape()
+        self._version += 1
         return self
 
 
@@ -381,7 +480,8 @@ class NumpySurface(object):
         """Flips the surface contents along the x-axis.
 
         """
-        self.__content = np.fliplr(self.content)
+        self.__content = np.fliplr(self.__content)
+        self._version += 1
         return self
 
 
@@ -389,10 +489,27 @@ class NumpySurface(object):
         """Flips the surface contents along the y-axis.
 
         """
-        self.__content = np.flipud(self.content)
+        self.__content = np.flipud(self.__content)
+        self._version += 1
         return self
 
 
+    def invalidate(self):
+        """Marks the contents of the surface as modified.
+
+        Surfaces are only uploaded to the GPU again when drawn if they have changed
+        since they were last drawn, which is tracked automatically for changes made
+        using the surface's own methods (e.g. :meth:`blit` or :meth:`mask`). If you
+        modify the array returned by :attr:`content` directly, call this afterwards
+        so that the changes are shown the next time the surface is drawn::
+
+            surf.content[0:10, :, 3] = 0
+            surf.invalidate()
+
+        """
+        self._version += 1
+
+
     def get_pixel_value(self, coords):
         """Retrieves the RGBA colour value of a given pixel of the surface.
 
@@ -407,7 +524,7 @@ class NumpySurface(object):
 
         """
         try:
-            return tuple(self.content[coords[1]][coords[0]])
+            return tuple(self.__content[coords[1]][coords[0]])
         except IndexError:
             e = "Coordinates ({0}, {1}) do not correspond to a pixel on the surface."
             raise ValueError(e.format(coords[0], coords[1]))
@@ -447,17 +564,29 @@ class NumpySurface(object):
 
     @property
     def content(self):
-        """:obj:`numpy.ndarray`: The current contents of the surface.
+        """:obj:`numpy.ndarray`: The current contents of the surface. If the content was
+        shared with another object, it is copied first so that it can be safely modified.
+        If you modify the array directly, call :meth:`invalidate` afterwards so that the
+        changes are shown the next time the surface is drawn.
+
+        Can also be set to replace the contents of the surface with any of the types
+        of content the surface can be created from.
 
         """
+        self.__own_content()
         return self.__content
 
+    @content.setter
+    def content(self, new):
+        self.__init_content(new)
+        self._version += 1
+
 
     @property
     def average_color(self):
         """tuple(int, int, int, int): The average RGBA colour of the surface.
 
         """
-        img = Image.fromarray(self.content.astype(np.uint8))
+        img = Image.fromarray(self.__content.astype(np.uint8))
         return img.resize((1, 1), Image.LANCZOS).getpixel((0, 0))
 
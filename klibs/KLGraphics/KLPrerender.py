@@ -0,0 +1,104 @@
+__author__ = 'Austin Hurst'
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .KLNumpySurface import NumpySurface
+from .KLDraw import Drawbject
+
+
+def _render_stimulus(stim):
+    # Renders a single stimulus to an RGBA array that can be uploaded to the GPU
+    # directly, calling it first if it's a function that creates the stimulus
+    if callable(stim):
+        stim = stim()
+    if isinstance(stim, (NumpySurface, Drawbject)):
+        return stim.render()
+    elif isinstance(stim, Image.Image):
+        return np.asarray(stim.convert('RGBA'))
+    elif type(stim) is np.ndarray:
+        return stim
+    else:
+        e = "Pre-rendered stimuli must be NumpySurfaces, Drawbjects, images, or arrays."
+        raise TypeError(e)
+
+
+def render_stimuli(stimuli):
+    """Renders a set of stimuli to RGBA arrays that can be drawn to the screen with
+    :func:`~klibs.KLGraphics.blit`.
+
+    Valid stimuli are :obj:`~klibs.KLGraphics.KLNumpySurface.NumpySurface` objects
+    (e.g. rendered text), Drawbject shapes, Pillow images, and NumPy arrays, as well
+    as functions that take no arguments and return one of the above.
+
+    Args:
+        stimuli (dict or None): A dict of stimuli to render, with names as keys.
+
+    Returns:
+        dict: The rendered stimuli as :obj:`numpy.ndarray` objects, with the same
+        keys as the input dict (or an empty dict if no stimuli were given).
+
+    """
+    if not stimuli:
+        return {}
+    return {name: _render_stimulus(stim) for name, stim in stimuli.items()}
+
+
+class RenderPool(object):
+    """A pool of background threads for rendering stimuli ahead of time.
+
+    Shapes and text are rendered on the CPU before being uploaded to the GPU, which
+    can take a noticeable amount of time for complex displays. A RenderPool lets
+    this work happen in the background (e.g. during the previous trial), after
+    which the rendered arrays can be drawn immediately on the main thread::
+
+       pool = RenderPool()
+       pending = pool.submit(make_search_array, 12, (255, 0, 0))
+
+       # and then, once the stimuli are needed:
+       stimuli = pending.result() # waits for rendering to finish if needed
+       blit(stimuli['array'], 5, P.screen_c)
+
+    Because OpenGL calls can only be made from the main thread, functions passed
+    to the pool should only create and return stimuli (see :func:`render_stimuli`
+    for valid types), never draw them. Stimuli being rendered in the background
+    should also not be used on the main thread until their rendering is finished.
+
+    Args:
+        workers (int, optional): The number of threads to use for rendering.
+            Defaults to 1.
+
+    """
+    def __init__(self, workers=1):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='klibs-render')
+
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules a function that creates a set of stimuli to be run and rendered
+        in the background.
+
+        Args:
+            func (callable): A function that returns a dict of stimuli to render,
+                with names as keys.
+            *args: Positional arguments to pass to the function.
+            **kwargs: Keyword arguments to pass to the function.
+
+        Returns:
+            :obj:`concurrent.futures.Future`: A future that will contain the dict of
+            rendered stimuli (see :func:`render_stimuli`) once rendering is complete.
+
+        """
+        return self._executor.submit(lambda: render_stimuli(func(*args, **kwargs)))
+
+
+    def shutdown(self, wait=True):
+        """Shuts down the pool, freeing its threads.
+
+        Args:
+            wait (bool, optional): Whether to wait for any pending renders to finish
+                before returning. Defaults to True.
+
+        """
+        self._executor.shutdown(wait=wait)
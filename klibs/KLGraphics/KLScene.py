@@ -0,0 +1,335 @@
+__author__ = 'Austin Hurst'
+
+import ctypes
+from collections import OrderedDict
+
+import numpy as np
+import OpenGL.GL as gl
+from OpenGL.raw.GL.VERSION import GL_1_1 as rawgl
+from PIL import Image
+
+from klibs import P
+from .utils import _build_registrations
+from .core import _get_content, _create_texture
+from .KLAtlas import AtlasRegion
+
+
+class _SceneItem(object):
+    # A single stimulus in a Scene, along with its placement and GPU texture
+
+    def __init__(self, stimulus, location, registration, flip_x, visible):
+        self.stimulus = stimulus
+        self.location = location
+        self.registration = registration
+        self.flip_x = flip_x
+        self.visible = visible
+        self.t_id = None
+        self.content = None
+        self.version = None
+        self.size = None
+        self.uv = (0, 0, 1, 1)
+        self.owned = True # False if the texture belongs to a TextureAtlas
+
+
+class Scene(object):
+    """A retained set of stimuli that can be drawn to the screen all at once.
+
+    Drawing the same set of stimuli to the screen every frame (e.g. within a
+    response collection loop) with :func:`~klibs.KLGraphics.blit` requires
+    setting up and drawing each stimulus individually. With a Scene, stimuli are
+    added once along with their locations on the screen, after which they can be
+    shown or hidden as needed and drawn together with a handful of OpenGL calls,
+    regardless of the number of stimuli in the Scene.
+
+    For example, to draw a fixation cross and two placeholders with a target
+    that's only visible on some frames, you could do::
+
+       self.scene = Scene()
+       self.scene.add('fixation', self.fixation, P.screen_c, registration=5)
+       self.scene.add('left', self.box, self.left_loc, registration=5)
+       self.scene.add('right', self.box, self.right_loc, registration=5)
+       self.scene.add('target', self.target, self.left_loc, 5, visible=False)
+
+       # and then, within a trial:
+       self.scene.show('target') if target_on else self.scene.hide('target')
+       fill()
+       self.scene.draw()
+       flip()
+
+    Stimuli are drawn in the order they were added, with later stimuli drawn on
+    top of earlier ones. Valid stimulus types are the same as for
+    :func:`~klibs.KLGraphics.blit`. Consecutive stimuli from the same
+    :class:`~klibs.KLGraphics.KLAtlas.TextureAtlas` page are drawn together
+    with a single draw call, making atlases the fastest way to draw Scenes with
+    many small stimuli. Changes to the contents of NumpySurface or
+    Drawbject stimuli (e.g. changing the fill colour of a shape) are detected
+    automatically, but NumPy array and Pillow Image stimuli are assumed to stay
+    the same once added.
+
+    Because each Scene keeps the textures for its stimuli on the GPU, you should
+    call :meth:`release` once you're done using a Scene.
+
+    """
+    def __init__(self):
+        self._items = OrderedDict()
+        self._vbo = None
+        self._vertices = None
+        self._dirty = True
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def __contains__(self, name):
+        return name in self._items
+
+
+    def _get_item(self, name):
+        try:
+            return self._items[name]
+        except KeyError:
+            raise KeyError("No stimulus named '{0}' in the Scene.".format(name))
+
+
+    def add(self, name, stimulus, location=(0, 0), registration=7, visible=True,
+            flip_x=False):
+        """Adds a stimulus to the Scene.
+
+        If a stimulus with the same name already exists in the Scene, it will be
+        replaced with the new stimulus without changing its drawing order.
+
+        Args:
+            name (str): The name to use for the stimulus in the Scene.
+            stimulus: The shape, image, or other texture to add to the Scene.
+            location ([int, int], optional): The (x, y) pixel coordinates at which
+                to draw the stimulus. Defaults to (0, 0).
+            registration (int, optional): An integer from 1 to 9 indicating which
+                point on the stimulus to align to the location coordinates. Defaults
+                to 7 (top-left corner).
+            visible (bool, optional): Whether the stimulus should initially be
+                visible when the Scene is drawn. Defaults to True.
+            flip_x (bool, optional): If True, the stimulus will be flipped along its
+                x-axis when drawn. Defaults to False.
+
+        Raises:
+            TypeError: If the stimulus is not a supported type.
+            ValueError: If the registration is not an integer between 1 and 9.
+
+        """
+        if not registration in range(1, 10):
+            raise ValueError("Registration must be an integer between 1 and 9 inclusive")
+        if isinstance(stimulus, Image.Image):
+            # Convert images to arrays so their content only needs to be converted once
+            stimulus = np.asarray(stimulus.convert('RGBA'))
+        if not isinstance(stimulus, AtlasRegion):
+            _get_content(stimulus) # ensure stimulus is a valid type
+        item = _SceneItem(stimulus, tuple(location), registration, flip_x, visible)
+        if name in self._items:
+            self._release_item(self._items[name])
+        self._items[name] = item
+        self._dirty = True
+
+
+    def remove(self, name):
+        """Removes a stimulus from the Scene.
+
+        Args:
+            name (str): The name of the stimulus to remove.
+
+        """
+        self._release_item(self._get_item(name))
+        del self._items[name]
+        self._dirty = True
+
+
+    def move(self, name, location, registration=None):
+        """Changes the location (and optionally the registration) of a stimulus
+        in the Scene.
+
+        Args:
+            name (str): The name of the stimulus to move.
+            location ([int, int]): The new (x, y) pixel coordinates at which to draw
+                the stimulus.
+            registration (int, optional): The new registration for the stimulus.
+                Defaults to the stimulus' current registration.
+
+        """
+        item = self._get_item(name)
+        if registration is not None:
+            if not registration in range(1, 10):
+                raise ValueError("Registration must be an integer between 1 and 9 inclusive")
+            item.registration = registration
+        item.location = tuple(location)
+        self._dirty = True
+
+
+    def show(self, *names):
+        """Makes one or more stimuli in the Scene visible. If no names are
+        given, all stimuli in the Scene will be made visible.
+
+        Args:
+            *names: The names of the stimuli to show.
+
+        """
+        for name in (names if len(names) else self._items.keys()):
+            self._get_item(name).visible = True
+
+
+    def hide(self, *names):
+        """Hides one or more stimuli in the Scene. If no names are given, all
+        stimuli in the Scene will be hidden.
+
+        Args:
+            *names: The names of the stimuli to hide.
+
+        """
+        for name in (names if len(names) else self._items.keys()):
+            self._get_item(name).visible = False
+
+
+    def is_visible(self, name):
+        """Checks whether a given stimulus in the Scene is currently visible.
+
+        Args:
+            name (str): The name of the stimulus to check.
+
+        Returns:
+            bool: True if the stimulus is visible, otherwise False.
+
+        """
+        return self._get_item(name).visible
+
+
+    def _release_item(self, item):
+        # Deletes the texture for a stimulus from the GPU
+        if item.t_id is not None:
+            if item.owned:
+                gl.glDeleteTextures([item.t_id])
+            item.t_id = None
+            item.content = None
+
+
+    def _update_texture(self, item):
+        # Uploads the content of a stimulus to the GPU if it isn't uploaded already
+        # or if it has changed since the last upload
+        if isinstance(item.stimulus, AtlasRegion):
+            region = item.stimulus
+            item.t_id = region._texture()
+            item.owned = False
+            if item.size != (region.width, region.height) or item.uv != region.uv:
+                item.size = (region.width, region.height)
+                item.uv = region.uv
+                self._dirty = True
+            return
+        content, width, height, version = _get_content(item.stimulus)
+        if item.content is content and item.version == version:
+            return
+        self._release_item(item)
+        item.t_id = _create_texture(content, width, height)
+        item.content = content
+        item.version = version
+        if item.size != (width, height):
+            item.size = (width, height)
+            self._dirty = True
+
+
+    def _build_vertices(self):
+        # Builds the interleaved (x, y, u, v) vertex data for the quads of all
+        # stimuli in the Scene, in drawing order
+        verts = np.zeros((len(self._items) * 4, 4), dtype=np.float32)
+        for i, item in enumerate(self._items.values()):
+            width, height = item.size
+            x_offset, y_offset = _build_registrations(height, width)[item.registration]
+            x1 = item.location[0] + int(x_offset)
+            y1 = item.location[1] + int(y_offset)
+            x2, y2 = (x1 + width, y1 + height)
+            u1, v1, u2, v2 = item.uv
+            if item.flip_x or P.blit_flip_x:
+                u1, u2 = (u2, u1)
+            verts[i*4:(i+1)*4] = [
+                (x1, y1, u1, v1), (x1, y2, u1, v2), (x2, y2, u2, v2), (x2, y1, u2, v1)
+            ]
+        return verts
+
+
+    def _batches(self):
+        # Groups consecutive visible stimuli that share the same texture into
+        # (texture, first vertex, vertex count) batches for drawing
+        batches = []
+        for i, item in enumerate(self._items.values()):
+            if not item.visible:
+                continue
+            last = batches[-1] if len(batches) else None
+            if last and last[0] == item.t_id and last[1] + last[2] == i * 4:
+                last[2] += 4
+            else:
+                batches.append([item.t_id, i * 4, 4])
+        return batches
+
+
+    def draw(self):
+        """Draws all visible stimuli in the Scene to the display buffer.
+
+        Like :func:`~klibs.KLGraphics.blit`, this only draws the stimuli to the
+        display buffer, meaning that :func:`~klibs.KLGraphics.flip` needs to be
+        called afterwards for the stimuli to actually appear on the screen.
+
+        """
+        for item in self._items.values():
+            if item.visible or item.t_id is None:
+                self._update_texture(item)
+        batches = self._batches()
+        if not len(batches):
+            return
+
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glTexEnvi(gl.GL_TEXTURE_ENV, gl.GL_TEXTURE_ENV_MODE, gl.GL_REPLACE)
+        if self._vbo is None:
+            self._vbo = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self._vbo)
+        if self._dirty:
+            self._vertices = self._build_vertices()
+            gl.glBufferData(
+                gl.GL_ARRAY_BUFFER, self._vertices.nbytes, self._vertices, gl.GL_DYNAMIC_DRAW
+            )
+            self._dirty = False
+
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        # NOTE: Raw functions are used for buffer offsets since PyOpenGL's wrappers
+        # try to track the pointers per-context, which fails with some SDL contexts
+        rawgl.glVertexPointer(2, gl.GL_FLOAT, 16, ctypes.c_void_p(0))
+        rawgl.glTexCoordPointer(2, gl.GL_FLOAT, 16, ctypes.c_void_p(8))
+        for t_id, first, count in batches:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, t_id)
+            gl.glDrawArrays(gl.GL_QUADS, first, count)
+        gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glDisable(gl.GL_TEXTURE_2D)
+
+
+    def release(self):
+        """Frees the GPU memory used by the Scene's textures.
+
+        The Scene can still be drawn after being released, but the textures for
+        all its stimuli will need to be uploaded to the GPU again.
+
+        """
+        for item in self._items.values():
+            self._release_item(item)
+        if self._vbo is not None:
+            gl.glDeleteBuffers(1, [self._vbo])
+            self._vbo = None
+        self._dirty = True
+
+
+    @property
+    def names(self):
+        """list: The names of all stimuli in the Scene, in drawing order.
+
+        """
+        return list(self._items.keys())
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Jonathan Mulle & Austin Hurst'
 
-from .core import fill, clear, blit, flip
+from .core import (fill, clear, blit, flip, frame_stats, reset_frame_stats, frame_loop,
+    flip_times)
 from .colorspaces import COLORSPACE_RGB, COLORSPACE_CONST, COLORSPACE_CIELUV
-from .utils import rgb_to_rgba, image_file_to_array, add_alpha
+from .utils import rgb_to_rgba, image_file_to_array, add_alpha, alpha_composite
 from .KLNumpySurface import NumpySurface, aggdraw_to_numpy_surface
+from .KLScene import Scene
+from .KLAtlas import TextureAtlas
+from .KLPrerender import RenderPool, render_stimuli
 from .KLDraw import *
@@ -3,7 +3,10 @@ __author__ = 'Jonathan Mulle & Austin Hurst'
 
 import os
 import ctypes
+import weakref
 from time import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from math import sqrt, atan, degrees
 
 import sdl2
@@ -18,10 +21,220 @@ from klibs.KLTime import precise_time
 from .utils import _build_registrations, rgb_to_rgba, image_file_to_array, add_alpha
 from .KLNumpySurface import aggdraw_to_numpy_surface, NumpySurface
 from .KLDraw import Drawbject
+from .KLAtlas import AtlasRegion
 
 
 # This module contains the core functions for drawing things to the screen.
 
+
+class _TextureCache(object):
+    # An LRU cache of OpenGL textures for blitted content, so that static content
+    # (e.g. a pre-rendered fixation cross) only needs to be uploaded to the GPU once
+    # instead of on every blit. Textures are keyed by their content array (plus a
+    # version number for surfaces modified in place) and whether they're flipped,
+    # and the least-recently used textures are deleted whenever the total size of
+    # the cache would exceed P.texture_cache_size.
+
+    def __init__(self):
+        self._textures = OrderedDict()
+        self._dead = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self._textures)
+
+    def _release(self, key):
+        t_id, nbytes, _, _ = self._textures.pop(key)
+        gl.glDeleteTextures([t_id])
+        self.size -= nbytes
+
+    def _purge(self):
+        # Deletes the textures for any content that no longer exists. Since weakref
+        # callbacks can happen at any time, they only flag that this needs to run.
+        del self._dead[:]
+        for key in [k for k, entry in self._textures.items() if entry[2]() is None]:
+            self._release(key)
+
+    def get(self, content, version, flipped):
+        # Gets the cached texture for a given content array, or None if not cached
+        if len(self._dead):
+            self._purge()
+        key = (id(content), flipped)
+        entry = self._textures.get(key, None)
+        if entry is None:
+            return None
+        if entry[2]() is not content or entry[3] != version:
+            self._release(key)
+            return None
+        self._textures.move_to_end(key)
+        return entry[0]
+
+    def add(self, content, version, flipped, t_id, nbytes):
+        # Adds a texture to the cache, evicting the least-recently used textures if
+        # needed. Returns False if the texture is too large to be cached.
+        budget = P.texture_cache_size * 1024 * 1024
+        if nbytes > budget:
+            return False
+        while len(self._textures) and self.size + nbytes > budget:
+            self._release(next(iter(self._textures)))
+        ref = weakref.ref(content, self._dead.append)
+        self._textures[(id(content), flipped)] = (t_id, nbytes, ref, version)
+        self.size += nbytes
+        return True
+
+    def clear(self, release=True):
+        # Removes all textures from the cache, deleting them from the GPU unless
+        # their OpenGL context no longer exists
+        if release:
+            for key in list(self._textures.keys()):
+                self._release(key)
+        self._textures = OrderedDict()
+        del self._dead[:]
+        self.size = 0
+
+
+_textures = _TextureCache()
+
+
+class _FrameTimer(object):
+    # Records the time of every flip in a preallocated ring buffer, along with
+    # running statistics for the flips since the last reset (e.g. the start of the
+    # current trial) so that they can be logged without needing to scan the buffer.
+    # Within a frame loop (i.e. flips meant to happen on consecutive refreshes),
+    # frames are counted as dropped whenever the interval between two flips is more
+    # than 1.5 refreshes long, meaning that at least one vsync was missed (whether
+    # because the swap blocked or because the frame took too long to draw). Outside
+    # of frame loops, gaps between flips are expected (e.g. while waiting for a
+    # response), so frames are only counted as dropped if the swap itself overran.
+
+    def __init__(self, size):
+        self._in_loop = False
+        self._loop_last = None
+        self.resize(size)
+
+    def resize(self, size):
+        self._times = np.zeros(size, dtype=np.float64)
+        self._swaps = np.zeros(size, dtype=np.float32)
+        self._size = size
+        self._count = 0
+        self.reset()
+
+    def reset(self):
+        self._start = self._count
+        self._first = None
+        self._last = None
+        self._max_interval = 0.0
+        self._max_swap = 0.0
+        self._dropped = 0
+
+    def start_loop(self):
+        self._in_loop = True
+        self._loop_last = None
+
+    def stop_loop(self):
+        self._in_loop = False
+        self._loop_last = None
+
+    def record(self, timestamp, swap_time, refresh_time):
+        # Logs the completion time (in seconds) and swap duration (in ms) of a flip.
+        # If the refresh time (in ms) is unknown, dropped frames aren't counted.
+        i = self._count % self._size
+        self._times[i] = timestamp
+        self._swaps[i] = swap_time
+        self._count += 1
+        if self._last is None:
+            self._first = timestamp
+        else:
+            interval = timestamp - self._last
+            if interval > self._max_interval:
+                self._max_interval = interval
+        if refresh_time:
+            if self._loop_last is not None:
+                elapsed = (timestamp - self._loop_last) * 1000
+            else:
+                elapsed = swap_time
+            if elapsed > refresh_time * 1.5:
+                self._dropped += int(round(elapsed / refresh_time)) - 1
+        self._last = timestamp
+        if self._in_loop:
+            self._loop_last = timestamp
+        if swap_time > self._max_swap:
+            self._max_swap = swap_time
+
+    def stats(self):
+        flips = self._count - self._start
+        mean_interval = None
+        if flips > 1:
+            mean_interval = (self._last - self._first) / (flips - 1) * 1000
+        return {
+            'flips': flips,
+            'mean_interval': mean_interval,
+            'max_interval': self._max_interval * 1000 if flips > 1 else None,
+            'max_swap': float(self._max_swap) if flips else None,
+            'dropped': self._dropped,
+        }
+
+    def timestamps(self):
+        # Returns the buffered flip times in chronological order
+        n = min(self._count, self._size)
+        start = (self._count - n) % self._size
+        return np.roll(self._times, -start)[:n]
+
+
+_frames = _FrameTimer(P.frame_buffer_size)
+
+
+def _get_content(source):
+    # Gets the RGBA content, width, and height of a blittable object, along with
+    # a content version for sources that can be cached (None for other sources)
+    version = None # content versions are only tracked for cacheable sources
+    if isinstance(source, NumpySurface):
+        height = source.height
+        width = source.width
+        content = source.render()
+        version = source._version
+
+    elif isinstance(source, Image.Image):
+        # is this a good idea? will be slower in most cases than using np.asarray() on Image
+        # and rendering that, since you don't need to re-render every time.
+        height = source.size[1]
+        width = source.size[0]
+        content = source.tobytes("raw", "RGBA", 0, 1)
+
+    elif issubclass(type(source), Drawbject):
+        height = source.surface_height
+        width = source.surface_width
+        if source.rendered is None:
+            content = source.render()
+        else:
+            content = source.rendered
+        version = 0
+
+    elif type(source) is np.ndarray:
+        height = source.shape[0]
+        width = source.shape[1]
+        content = source
+
+    else:
+        raise TypeError("source must be an ndarray, NumpySurface, or be a KLibs Drawbject.")
+
+    return (content, width, height, version)
+
+
+def _create_texture(content, width, height):
+    # Creates a new OpenGL texture and uploads the given RGBA content to it
+    t_id = gl.glGenTextures(1)
+    gl.glBindTexture(gl.GL_TEXTURE_2D, t_id)
+    gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP)
+    gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP)
+    gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+    gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+    gl.glTexImage2D(
+        gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, width, height, 0, gl.GL_RGBA,
+        gl.GL_UNSIGNED_BYTE, content
+    )
+    return t_id
+
 def _init_fullscreen(display, hidpi=False):
 
     # Get the current non-HIDPI resolution and refresh rate of the display
@@ -107,7 +320,10 @@ def display_init(diagonal_in, hidpi):
     # Create a fullscreen window at the current resolution, get display info
     window, res, hz = _init_fullscreen(display=0, hidpi=hidpi)
 
-    # Set up the OpenGL context for the window
+    # Set up the OpenGL context for the window, discarding any textures cached for
+    # a previous context
+    _textures.clear(release=False)
+    _frames.resize(P.frame_buffer_size)
     ret = sdl2.SDL_GL_SetSwapInterval(1) # enforce vsync
     if ret != 0:
         print(" - Warning: Vsync unsupported, experiment timing may be off")
@@ -173,6 +389,11 @@ def blit(source, registration=7, location=(0,0), flip_x=False):
         Valid source content types include :obj:`NumpySurface` objects, :obj:`Drawbject` shapes,
         and :obj:`numpy.ndarray` or :obj:`Pillow.Image` objects in RGBA format.
 
+        The textures for NumpySurface and Drawbject content are cached on the GPU
+        (up to ``P.texture_cache_size`` MB), so blitting the same surface or shape
+        again is much faster than the first time. Because of this, NumpySurface
+        content should only be modified using the NumpySurface's own methods.
+
         Args:
             source: Image data to draw to the display buffer.
             registration (int): An integer from 1 to 9 indicating which location on the
@@ -187,51 +408,35 @@ def blit(source, registration=7, location=(0,0), flip_x=False):
 
         """
         # TODO: Add reference to location/registration explanation in the docstring once it's written
-        if isinstance(source, NumpySurface):
-            height = source.height
-            width = source.width
-            content = source.render()
-
-        elif isinstance(source, Image.Image):
-            # is this a good idea? will be slower in most cases than using np.asarray() on Image
-            # and rendering that, since you don't need to re-render every time.
-            height = source.size[1]
-            width = source.size[0]
-            content = source.tobytes("raw", "RGBA", 0, 1)
-
-        elif issubclass(type(source), Drawbject):
-            height = source.surface_height
-            width = source.surface_width
-            if source.rendered is None:
-                content = source.render()
-            else:
-                content = source.rendered
-
-        elif type(source) is np.ndarray:
-            height = source.shape[0]
-            width = source.shape[1]
-            content = source
+        flipped = any([not flip_x and P.blit_flip_x, flip_x])
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        if isinstance(source, AtlasRegion):
+            # Atlas regions are drawn from their atlas' texture, flipping if needed
+            # by swapping their horizontal texture coordinates
+            width, height = (source.width, source.height)
+            t_id = source._texture()
+            u1, v1, u2, v2 = source.uv
+            if flipped:
+                u1, u2 = (u2, u1)
+            cached = True
+            gl.glBindTexture(gl.GL_TEXTURE_2D, t_id)
 
         else:
-            raise TypeError("source must be an ndarray, NumpySurface, or be a KLibs Drawbject.")
-        
-        if any([not flip_x and P.blit_flip_x, flip_x]):
-            content = np.fliplr(content)
-
-        # Create and initialize OpenGL texture from source
-        # TODO: Add support for texture caching
-        gl.glEnable(gl.GL_TEXTURE_2D)
-        t_id = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, t_id)
+            content, width, height, version = _get_content(source)
+            u1, v1, u2, v2 = (0, 0, 1, 1)
+            # Use the cached texture for the content if there is one, otherwise
+            # upload the content to a new texture (caching it if possible)
+            cached = version is not None and P.texture_cache_size > 0
+            t_id = _textures.get(content, version, flipped) if cached else None
+            if t_id is None:
+                t_id = _create_texture(
+                    np.fliplr(content) if flipped else content, width, height
+                )
+                if cached:
+                    cached = _textures.add(content, version, flipped, t_id, width * height * 4)
+            else:
+                gl.glBindTexture(gl.GL_TEXTURE_2D, t_id)
         gl.glTexEnvi(gl.GL_TEXTURE_ENV, gl.GL_TEXTURE_ENV_MODE, gl.GL_REPLACE)
-        gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP)
-        gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP)
-        gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
-        gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-        gl.glTexImage2D(
-            gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, width, height, 0, gl.GL_RGBA,
-            gl.GL_UNSIGNED_BYTE, content
-        )
 
         # location[0] += P.screen_origin[0]
         # location[1] += P.screen_origin[1]
@@ -257,19 +462,19 @@ def blit(source, registration=7, location=(0,0), flip_x=False):
         y_bounds[1] += int(y_offset)
 
         gl.glBegin(gl.GL_TRIANGLE_STRIP)
-        gl.glTexCoord2f(0, 0)
+        gl.glTexCoord2f(u1, v1)
         gl.glVertex2f(x_bounds[0], y_bounds[0])
-        gl.glTexCoord2f(0, 1)
+        gl.glTexCoord2f(u1, v2)
         gl.glVertex2f(x_bounds[0], y_bounds[1])
-        gl.glTexCoord2f(1, 0)
+        gl.glTexCoord2f(u2, v1)
         gl.glVertex2f(x_bounds[1], y_bounds[0])
-        gl.glTexCoord2f(1, 1)
+        gl.glTexCoord2f(u2, v2)
         gl.glVertex2f(x_bounds[1], y_bounds[1])
         gl.glEnd()
 
         gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-        gl.glDeleteTextures([t_id])
-        del t_id
+        if not cached:
+            gl.glDeleteTextures([t_id])
         gl.glDisable(gl.GL_TEXTURE_2D)
 
 
@@ -281,7 +486,10 @@ def flip():
     When in development mode, this function will print a warning in the console if the 
     screen takes longer than a single refresh to redraw. If this occurs often, it might
     indicate an issue with your graphics driver or display computer and suggests that
-    you shouldn't rely on that setup for timing-sensitive experiments.
+    you shouldn't rely on that setup for timing-sensitive experiments. The timing of
+    every flip is also recorded, so that the number of dropped frames during each trial
+    can be logged to the database if ``P.log_frame_stats`` is True (see
+    :func:`frame_stats`).
 
     For more information on how drawing works in KLibs, please refer to the documentation
     page explaining the graphics system.
@@ -303,13 +511,80 @@ def flip():
     # (with a threshold of 1ms).
     flip_start = precise_time()
     sdl2.SDL_GL_SwapWindow(window)
-    flip_time = (precise_time() - flip_start) * 1000 # convert to ms
-    if P.development_mode:
+    flip_end = precise_time()
+    flip_time = (flip_end - flip_start) * 1000 # convert to ms
+    _frames.record(flip_end, flip_time, P.refresh_time)
+    if P.development_mode and P.refresh_time:
         if flip_time > (P.refresh_time + 1):
             warn = "Warning: Screen refresh took {0} ms (expected {1} ms)"
             print(warn.format("%.2f"%flip_time, "%.2f"%P.refresh_time))
 
 
+def frame_stats():
+    """Gets timing statistics for all screen flips since the start of the current
+    trial (or since the last call to :func:`reset_frame_stats`).
+
+    Within a :func:`frame_loop`, frames are counted as dropped whenever the interval
+    between two flips is longer than 1.5 refreshes, meaning that the screen missed
+    at least one redraw (e.g. because a frame took too long to draw, or because the
+    flip itself was slow). Outside of frame loops, frames are only counted as dropped
+    if a flip itself takes longer than 1.5 refreshes, since gaps between flips are
+    usually intentional (e.g. while waiting for a response). Note that the mean and
+    maximum intervals between flips include any such gaps.
+
+    Returns:
+        dict: The number of flips ('flips'), the mean and maximum intervals between
+        flips in ms ('mean_interval', 'max_interval'), the longest flip duration in
+        ms ('max_swap'), and the estimated number of dropped frames ('dropped').
+        Intervals and durations are None if there were too few flips to compute them.
+
+    """
+    return _frames.stats()
+
+
+def reset_frame_stats():
+    """Resets the statistics returned by :func:`frame_stats`.
+
+    This is called automatically at the start of every trial.
+
+    """
+    _frames.reset()
+
+
+@contextmanager
+def frame_loop():
+    """Marks a block of code in which the screen is meant to be flipped on every
+    refresh, so that any missed refreshes are counted as dropped frames (see
+    :func:`frame_stats`)::
+
+        with frame_loop():
+            while self.evm.before('target_off'):
+                fill()
+                blit(self.target, 5, P.screen_c)
+                flip()
+
+    """
+    _frames.start_loop()
+    try:
+        yield
+    finally:
+        _frames.stop_loop()
+
+
+def flip_times():
+    """Gets the times at which the most recent flips of the screen completed.
+
+    The times of up to ``P.frame_buffer_size`` flips are kept in memory, after
+    which the oldest are overwritten.
+
+    Returns:
+        :obj:`numpy.ndarray`: The completion times of the buffered flips, in seconds
+        (see :func:`~klibs.KLTime.precise_time`), from oldest to newest.
+
+    """
+    return _frames.timestamps()
+
+
 def clear(color=None):
         """
         Clears both current display and display buffer with a given color. If no color
@@ -67,6 +67,91 @@ def add_alpha(array, opacity=255):
     return array
 
 
+def alpha_composite(dest, source, premultiplied=False):
+    """Alpha-composites an RGBA texture over another of the same size, modifying the
+    destination array in place.
+
+    Since only the given arrays are touched, this can be used to blend content onto part
+    of a larger texture by passing the matching region (slice) of the larger array as the
+    destination. Both arrays must be 8-bit RGBA arrays, and can either have straight
+    (the default) or premultiplied alpha. Results match those of Pillow's
+    :meth:`~PIL.Image.Image.alpha_composite` to within 1 unit of rounding.
+
+    Args:
+        dest (:obj:`numpy.ndarray`): A writeable 3-dimensional RGBA array on which to
+            draw the source.
+        source (:obj:`numpy.ndarray`): A 3-dimensional RGBA array with the same size as
+            the destination.
+        premultiplied (bool, optional): Whether the colour values of both arrays are
+            premultiplied by their alpha values. Defaults to False.
+
+    Returns:
+        :obj:`numpy.ndarray`: The destination array.
+
+    """
+    if dest.shape != source.shape or dest.shape[-1] != 4 or dest.dtype != np.uint8:
+        raise ValueError("Source and destination must be RGBA arrays of the same size.")
+    if source.dtype != np.uint8:
+        source = source.astype(np.uint8)
+    src_a = source[:, :, 3]
+    opaque = src_a == 255
+    if opaque.all():
+        # If the source is fully opaque, it just replaces the destination
+        dest[:] = source
+        return dest
+
+    if premultiplied:
+        # out = src + dest * (1 - src_a), for all channels
+        inv_a = 255 - src_a[:, :, np.newaxis].astype(np.uint16)
+        dest[:] = source + (dest * inv_a + 127) // 255
+        return dest
+
+    # Most stimuli are largely made up of fully transparent and fully opaque pixels,
+    # so only the semi-transparent pixels (e.g. anti-aliased edges) need blending. If
+    # most pixels are semi-transparent, Pillow's blending loop is faster than NumPy.
+    partial = src_a != 0
+    partial ^= opaque
+    n = np.count_nonzero(partial)
+    if n > partial.size // 4:
+        img = Image.fromarray(np.ascontiguousarray(dest))
+        img.alpha_composite(Image.fromarray(np.ascontiguousarray(source)))
+        dest[:] = np.asarray(img)
+        return dest
+
+    # Work with whole pixels (as 32-bit ints) to avoid copying channels separately.
+    # Since only contiguous arrays can be viewed this way (in NumPy < 1.23), regions of
+    # larger arrays are blended in a contiguous copy and then written back.
+    region = dest
+    dest = np.ascontiguousarray(dest)
+    source = np.ascontiguousarray(source)
+    dest_px = dest.view(np.uint32)[:, :, 0]
+    src_px = source.view(np.uint32)[:, :, 0]
+    np.copyto(dest_px, src_px, where=opaque)
+    if n == 0:
+        if region is not dest:
+            region[:] = dest
+        return region
+    idx = np.nonzero(partial)
+    src = src_px[idx].view(np.uint8).reshape(-1, 4)
+    dst = dest_px[idx].view(np.uint8).reshape(-1, 4)
+
+    # out_a = src_a + dest_a * (1 - src_a), and out_rgb is the average of the source
+    # and destination colours weighted by their contributions to out_a
+    a = src[:, 3:4].astype(np.float32)
+    out_a = dst[:, 3:4] * (255 - a)
+    out_a *= 1 / 255.0
+    out_a += a
+    rgb = dst[:, :3].astype(np.float32)
+    rgb += (src[:, :3] - rgb) * (a / out_a)
+    out = np.empty_like(dst)
+    out[:, :3] = rgb + 0.5
+    out[:, 3:4] = out_a + 0.5
+    dest_px[idx] = out.view(np.uint32)[:, 0]
+    if region is not dest:
+        region[:] = dest
+    return region
+
+
 def aggdraw_to_array(surface, preserve_mode=False):
     """Converts an :obj:`aggdraw.Draw` object to a :obj:`numpy.ndarray` of the same size. By
     default, this will also convert the colour mode of the output to RGBA.
@@ -94,6 +179,8 @@ def image_file_to_array(path):
 
     For supported image file types, see 
     `here <https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html>`_.
+    Images can also be loaded from NumPy ``.npy`` files containing 8-bit RGB or RGBA arrays.
+    These are memory-mapped (read-only), so RGBA arrays are never fully read into memory.
 
     Args:
         path (:obj:`str`): A valid path to a supported image file type. Path can be absolute 
@@ -109,6 +196,9 @@ def image_file_to_array(path):
     elif not os.path.isfile(path):
         raise IOError("Unable to locate image file at ({0})".format(path))
 
+    if path.endswith('.npy'):
+        return add_alpha(np.load(path, mmap_mode='r'))
+
     img = Image.open(path)
     if img.mode != 'RGBA':
         if img.mode == 'RGB':
@@ -56,6 +56,7 @@ default_condition = None
 table_defaults = {} # default column values for db tables when using EntryTemplate
 run_practice_blocks = True # (not implemented in klibs itself)
 color_output = False # whether cso() outputs colorized text or not
+wait_for_input = False # sleep between input events during response collection instead of polling
 
 # Eye Tracking Settings
 eye_tracking = False
@@ -83,6 +84,11 @@ view_distance = 57  # in centimeters, 57m = in 1deg of visual angle per horizont
 additional_displays = [] # (not implemented)
 screen_origin = (0,0)  # (not implemented) always (0,0) unless multiple displays in use
 blit_flip_x = False
+texture_cache_size = 256 # max MB of GPU memory for caching blitted textures (0 = no cache)
+draw_cache_size = 64 # max MB of memory for caching rendered shapes (0 = no cache)
+text_cache_size = 16 # max MB of memory for caching rendered text (0 = no cache)
+frame_buffer_size = 36000 # number of flip times kept in memory (10 min at 60 Hz)
+prerender_workers = 1 # threads for pre-rendering the next trial's stimuli (0 = render in trial_prep)
 ignore_points_at = [] # For ignoring problematic pixel coordinates when using DrawResponse
 allow_hidpi = False
 
@@ -105,6 +111,23 @@ monitor_width = None
 refresh_rate = None # Number of times the display refreshes per second (in Hz)
 refresh_time = None # Expected time between display refreshes (in ms)
 
+# Database Settings
+deferred_trial_logging = False # queue trial data & write to the database in batches
+log_frame_stats = False # log dropped frames & flip intervals for each trial
+db_flush_rows = 500 # max number of deferred rows to queue before writing
+db_flush_interval = None # max seconds to queue deferred rows (None = no limit)
+db_connection_profile = {
+    'journal_mode': 'WAL', # allows exporting data while sessions are running (not used for
+                           # multi-user master databases, which may be on a network drive)
+    'synchronous': 'NORMAL', # only sync to disk on checkpoints instead of every commit
+    'cache_size': -16000, # size of the page cache (in KiB if negative, pages if positive)
+    'mmap_size': 67108864, # max bytes of the database file to memory-map for reads
+    'temp_store': 'MEMORY', # keep temporary tables and indices in memory
+} # SQLite pragmas for database connections (None = SQLite defaults)
+db_merge_retries = 8 # max retries when merging a multi-user session into a locked database
+db_merge_backoff = 0.05 # seconds to wait before the first merge retry (doubles each retry)
+db_merge_timeout = 5.0 # seconds each merge attempt waits for other sessions to release the database
+
 # Database Export Settings
 id_field_name = "participant_id"
 primary_table = "trials"
@@ -148,6 +171,7 @@ audio_dir = join(resources_dir, "audio")
 code_dir = join(resources_dir, "code")
 image_dir = join(resources_dir, "image")
 logs_dir = join(local_dir, "logs")
+spool_dir = join(local_dir, "spool") # multi-user session databases waiting to be merged
 exp_font_dir = join(resources_dir, "font")
 version_dir = None  # Dynamically set at runtime
 font_dirs = None  # Dynamically set at runtime
@@ -13,7 +13,7 @@ from klibs.KLConstants import (RC_AUDIO, RC_COLORSELECT, RC_DRAW, RC_KEYPRESS,
     NO_RESPONSE, TIMEOUT, TK_S, TK_MS)
 from klibs import P
 from klibs.KLKeyMap import KeyMap
-from klibs.KLEventQueue import pump, flush
+from klibs.KLEventQueue import pump, flush, wait
 from klibs.KLUtilities import iterable, angle_between
 from klibs.KLUserInterface import ui_request, hide_cursor, show_cursor, mouse_pos
 from klibs.KLBoundary import BoundarySet, AnnulusBoundary
@@ -24,6 +24,9 @@ from klibs.KLAudio import PYAUDIO_AVAILABLE
 
 # NOTE: This module is deprecated, KLResponseListeners should be used for all future projects
 
+# The longest time (in seconds) to wait for input between display callbacks
+_CALLBACK_WAIT = 0.001
+
 
 class Response(namedtuple('Response', ['value', 'rt'])):
     """A response returned from a :class:`ResponseListener` subclass. Contains two elements: the
@@ -89,6 +92,10 @@ class ResponseListener(NamedObject, EnvAgent):
 
     """
 
+    # Whether listen() only checks the event queue for responses, meaning the
+    # collection loop can safely sleep until new events arrive
+    _event_driven = False
+
     def __init__(self, name):
         super(ResponseListener, self).__init__(name)
         self.responses = []
@@ -248,6 +255,8 @@ class KeyPressResponse(ResponseListener):
 
     """
 
+    _event_driven = True
+
     def __init__(self):
         super(KeyPressResponse, self).__init__(RC_KEYPRESS)
         self.__key_map = None
@@ -438,6 +447,8 @@ class MouseButtonResponse(ResponseListener):
 
     """
 
+    _event_driven = True
+
     def __init__(self):
         super(MouseButtonResponse, self).__init__('mousebutton_listener')
         self.__event_type = SDL_MOUSEBUTTONDOWN
@@ -550,6 +561,8 @@ class CursorResponse(ResponseListener, BoundarySet):
 
     """
 
+    _event_driven = True
+
     def __init__(self):
         super(CursorResponse, self).__init__('cursor_listener')
         BoundarySet.__init__(self)
@@ -652,6 +665,8 @@ class ColorWheelResponse(ResponseListener):
 
     """
 
+    _event_driven = True
+
     def __init__(self):
         super(ColorWheelResponse, self).__init__(RC_COLORSELECT)
         self.__wheel = None
@@ -978,6 +993,15 @@ class ResponseCollector(EnvAgent):
         end_collection_event (str): The label of a scheduled :obj:`EventManager` event that signals
             the end of the collection loop. Defaluts to None.
 
+    If ``P.wait_for_input`` is True and all listeners in use respond only to input events (e.g.
+    keypress and mouse click listeners), the :meth:`collect` loop will sleep between events instead
+    of constantly checking for new input, waking up early for timeouts and scheduled trial events.
+    Note that response times here are taken from the trial clock when the loop wakes up, not from
+    the input events' own timestamps, so they include however long the system takes to wake the
+    loop after an event arrives. This delay depends on the platform and SDL version (e.g. older
+    SDL2 releases only check for new events every millisecond while waiting). For response times
+    based on event timestamps, use the listeners in :mod:`klibs.KLResponseListeners` instead.
+
     """
 
     def __init__(self, uses=[], display_callback=None, terminate_after=[10, 0], flip_screen=False):
@@ -1179,12 +1203,34 @@ class ResponseCollector(EnvAgent):
             self.listeners[l].cleanup()
 
 
+    def __get_events(self):
+        # Fetches the input event queue, sleeping until new input arrives (or until
+        # the next trial event or timeout) if possible and waiting is enabled
+        if not P.wait_for_input or self.__fetch_eye_events:
+            return pump()
+        for l in self.using():
+            if not self.listeners[l]._event_driven:
+                return pump()
+
+        # Wake up for the next trial event, the next display callback, or timeout
+        waits = [self.exp.evm._time_until_next()]
+        if callable(self.display_callback):
+            waits.append(_CALLBACK_WAIT * 1000)
+        if not self.end_collection_event:
+            timeout = self.terminate_after[0]
+            if self.terminate_after[1] == TK_S: timeout *= 1000.0
+            elapsed = self.exp.evm.trial_time_ms - self.rc_start_time
+            waits.append(timeout - elapsed)
+        waits = [t for t in waits if t is not None]
+        return wait(min(waits) / 1000.0 if waits else None)
+
+
     def __collect(self):
 
         collecting = True
         while collecting:
 
-            e_queue = pump(True) # Fetch input event queue
+            e_queue = self.__get_events() # Fetch input event queue
             el_queue = self.el.get_event_queue() if self.__fetch_eye_events else None
 
             # Check if response collection has timed out or end collection event has occurred
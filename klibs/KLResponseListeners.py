@@ -107,12 +107,15 @@ import sdl2
 
 from klibs import P
 from klibs.KLTime import precise_time
-from klibs.KLEventQueue import pump, flush
+from klibs.KLEventQueue import pump, flush, wait
 from klibs.KLUserInterface import ui_request, mouse_pos
 
 from klibs.KLBoundary import AnnulusBoundary
 from klibs.KLUtilities import angle_between
 
+# The longest time (in seconds) to wait for input between loop callbacks
+_CALLBACK_WAIT = 0.001
+
 
 class BaseResponseListener(object):
     """An abstract base class for creating response listeners.
@@ -122,6 +125,12 @@ class BaseResponseListener(object):
     There are a number of built-in ResponseListener classes for common use cases, but
     this base class is provided so that you can create your own.
 
+    If ``P.wait_for_input`` is True, listeners that only respond to input events
+    (e.g. key presses, mouse clicks) will sleep between events during the
+    :meth:`collect` loop instead of constantly checking for new input, leaving the
+    CPU idle. Custom listeners that check other sources of input (e.g. the current
+    cursor position) are unaffected.
+
     Args:
         timeout (float, optional): The maximum duration (in seconds) to wait for a
             valid response. Defaults to None (no timeout).
@@ -129,6 +138,10 @@ class BaseResponseListener(object):
             called every time the collection loop checks for new input.
 
     """
+    # Whether listen() only checks the event queue for responses, meaning the
+    # collection loop can safely sleep until new events arrive
+    _event_driven = False
+
     def __init__(self, timeout=None, loop_callback=None):
         self._loop_start = None
         self._callback = loop_callback
@@ -139,6 +152,17 @@ class BaseResponseListener(object):
         # The timestamp (in milliseconds) to use as the start time for the loop.
         return precise_time() * 1000
 
+    def _get_events(self):
+        # Fetches the event queue, sleeping until new input arrives (or until the
+        # listener times out) if waiting for input is enabled
+        if not (P.wait_for_input and self._event_driven):
+            return pump()
+        timeout = _CALLBACK_WAIT if self._callback else None
+        if self.timeout_ms:
+            remaining = (self.timeout_ms - self.elapsed) / 1000.0
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return wait(timeout)
+
     def collect(self):
         """Collects a single response from the participant.
 
@@ -158,7 +182,7 @@ class BaseResponseListener(object):
                 if self.elapsed > self.timeout_ms:
                     break
             # Fetch event queue and check for valid responses
-            events = pump()
+            events = self._get_events()
             resp = self.listen(events)
             ui_request(queue=events)
             # If a callback is provided, call it once per loop
@@ -277,6 +301,8 @@ class KeypressListener(BaseResponseListener):
             called every time the collection loop checks for new input.
 
     """
+    _event_driven = True
+
     def __init__(self, keymap, timeout=None, loop_callback=None):
         super(KeypressListener, self).__init__(timeout, loop_callback)
         self._keymap = self._parse_keymap(keymap)
@@ -391,6 +417,8 @@ class MouseButtonListener(BaseResponseListener):
             called every time the collection loop checks for new input.
 
     """
+    _event_driven = True
+
     def __init__(self, buttonmap, timeout=None, loop_callback=None):
         super(MouseButtonListener, self).__init__(timeout, loop_callback)
         self._buttonmap = self._parse_buttonmap(buttonmap)
@@ -505,6 +533,8 @@ class ColorWheelListener(BaseResponseListener):
             called every time the collection loop checks for new input.
 
     """
+    _event_driven = True
+
     def __init__(self, wheel, center=None, timeout=None, loop_callback=None):
         super(ColorWheelListener, self).__init__(timeout, loop_callback)
         self.default_response = (None, None, -1)
@@ -4,11 +4,13 @@ import os
 import re
 from os.path import isfile, join, basename
 import ctypes
+import threading
+from collections import OrderedDict
 from ctypes import byref, c_int
 
 from sdl2.sdlttf import (TTF_OpenFont, TTF_CloseFont, TTF_RenderUTF8_Blended,
     TTF_SizeUTF8, TTF_GlyphMetrics, TTF_FontLineSkip)
-from sdl2 import SDL_Color
+from sdl2 import SDL_Color, SDL_FreeSurface
 from sdl2.ext.compat import byteify
 from sdl2.ext import surface_to_ndarray, raise_sdl_err
 from sdl2.ext.ttf import _ttf_init
@@ -22,6 +24,71 @@ from klibs.KLGraphics.KLNumpySurface import NumpySurface as NpS
 
 
 
+_ttf_lock = threading.RLock()
+
+
+class _TextCache(object):
+    # A process-wide LRU cache of rendered strings, so that text rendered repeatedly
+    # (e.g. the same feedback message every trial, or a query prompt every frame)
+    # only needs to be rendered once. Strings are keyed by their style, text, and
+    # layout options, and the least-recently used strings are dropped whenever the
+    # total size of the cache would exceed P.text_cache_size. Strings can also be
+    # pinned (e.g. messages preloaded during setup) so they're never dropped. Since all
+    # rendering happens while holding the SDL_ttf lock, the cache doesn't need its own.
+
+    def __init__(self):
+        self._arrays = OrderedDict()
+        self._pinned = set()
+        self.pinned_size = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def get(self, key):
+        # Gets the rendered array for a given string key, or None if not cached
+        arr = self._arrays.get(key, None)
+        if arr is not None:
+            self._arrays.move_to_end(key)
+        return arr
+
+    def add(self, key, arr):
+        # Adds a rendered array to the cache, evicting the least-recently used
+        # arrays if needed. Returns False if the array is too large to be cached.
+        budget = P.text_cache_size * 1024 * 1024
+        if key in self._pinned or self.pinned_size + arr.nbytes > budget:
+            return False
+        if key in self._arrays:
+            self.size -= self._arrays.pop(key).nbytes
+        if self.size + arr.nbytes > budget:
+            for k in [k for k in self._arrays.keys() if k not in self._pinned]:
+                self.size -= self._arrays.pop(k).nbytes
+                if self.size + arr.nbytes <= budget:
+                    break
+        self._arrays[key] = arr
+        self.size += arr.nbytes
+        return True
+
+    def pin(self, key):
+        # Prevents a cached string from being dropped from the cache. Returns False
+        # if the string isn't in the cache.
+        if key not in self._arrays:
+            return False
+        if key not in self._pinned:
+            self._pinned.add(key)
+            self.pinned_size += self._arrays[key].nbytes
+        return True
+
+    def clear(self):
+        self._arrays = OrderedDict()
+        self._pinned = set()
+        self.pinned_size = 0
+        self.size = 0
+
+
+_text_cache = _TextCache()
+
+
 def _split_units(s):
     # Extracts the size and unit from a given size string (e.g. '0.6deg')
     found = re.search(r"^([\d\.]+)([a-z]*)", s.lower())
@@ -65,6 +132,123 @@ def _load_font(fontpath, size_pt):
     return font
 
 
+class _FontRegistry(object):
+    # A process-wide registry of open fonts, so that text styles using the same font
+    # at the same size share a single SDL_ttf font handle, which is only opened the
+    # first time it's needed. Font metrics used for sizing text styles are also only
+    # computed once per font file. Must be used with the SDL_ttf lock held.
+
+    def __init__(self):
+        self._fonts = {}
+        self._scale_factors = {}
+
+    def __len__(self):
+        return len(self._fonts)
+
+    def get_font(self, fontpath, size_pt):
+        # Gets the font handle for a given font file and size, opening it if needed
+        key = (fontpath, int(size_pt))
+        if key not in self._fonts:
+            self._fonts[key] = _load_font(fontpath, size_pt)
+        return self._fonts[key]
+
+    def get_scale_factor(self, fontpath):
+        # Determines the pt-to-pixels scale factor for a given font, with height
+        # in px defined as the maximum ASCII character height from baseline
+        # (ignoring punctuation). Allows fonts to be easily specified in px or deg.
+        if fontpath not in self._scale_factors:
+            caps = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+            chars = caps + caps.lower() + "0123456789"
+            testfont = _load_font(fontpath, 40)
+            max_ascent = _get_max_ascent(testfont, chars)
+            TTF_CloseFont(testfont)
+            self._scale_factors[fontpath] = 40 / float(max_ascent)
+        return self._scale_factors[fontpath]
+
+
+_fonts = _FontRegistry()
+
+
+def _get_text_width(font, text):
+    # Gets the width (in px) of a UTF-8 string when rendered with a given font
+    w, h = c_int(0), c_int(0)
+    TTF_SizeUTF8(font, text, byref(w), byref(h))
+    return w.value
+
+
+def _split_word(font, word, width):
+    # Splits a word too wide to fit on a single line into chunks no wider than the
+    # given width (or a single character each, if even that doesn't fit)
+    chars = word.decode('utf-8')
+    chunks = []
+    while len(chars):
+        # Find the longest prefix that fits using a binary search
+        lo, hi = (1, len(chars))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if _get_text_width(font, chars[:mid].encode('utf-8')) <= width:
+                lo = mid
+            else:
+                hi = mid - 1
+        chunks.append(chars[:lo].encode('utf-8'))
+        chars = chars[lo:]
+    return chunks
+
+
+def _wrap_line(font, line, width, widths):
+    # Breaks a line of UTF-8 text into lines no wider than the given width, filling
+    # each line with as many words as will fit. Each word is measured once, with
+    # the widths of previously-measured words stored in the given dict.
+    if _get_text_width(font, line) <= width:
+        return [line]
+
+    def measure(word):
+        if word not in widths:
+            widths[word] = _get_text_width(font, word)
+        return widths[word]
+
+    space_w = measure(b" ")
+    words = []
+    for word in line.split(b" "):
+        if measure(word) > width:
+            words += _split_word(font, word, width)
+        else:
+            words.append(word)
+
+    wrapped = []
+    start, n = (0, len(words))
+    while start < n:
+        # Add words to the line until the next one won't fit
+        end = start + 1
+        line_w = measure(words[start])
+        while end < n and line_w + space_w + measure(words[end]) <= width:
+            line_w += space_w + widths[words[end]]
+            end += 1
+        # Since kerning can make the actual width of a line differ slightly from the
+        # sum of its word widths, make sure the line actually fits
+        segment = b" ".join(words[start:end])
+        while end - start > 1 and _get_text_width(font, segment.rstrip(b" ")) > width:
+            end -= 1
+            segment = b" ".join(words[start:end])
+        wrapped.append(segment if end == n else segment.rstrip(b" "))
+        # Skip any spaces at the start of the next line
+        start = end
+        while start < n and not len(words[start]):
+            start += 1
+    return wrapped
+
+
+def _render_ttf(font, text, color):
+    # Renders a UTF-8 string with a given font and RGBA color to an RGBA array
+    bgra_color = SDL_Color(color[2], color[1], color[0], color[3])
+    surf = TTF_RenderUTF8_Blended(font, text, bgra_color)
+    if not surf:
+        raise_sdl_err("rendering the text '{0}'".format(text.decode('utf-8')))
+    arr = surface_to_ndarray(surf.contents)
+    SDL_FreeSurface(surf)
+    return arr
+
+
 
 class TextStyle(EnvAgent):
     """A custom style to use for rendering text.
@@ -111,14 +295,17 @@ class TextStyle(EnvAgent):
         self._fontpath = byteify(self.txtm.fonts[self._fontname])
 
         # Initialize font size and size units
-        self._scale_factor = self._get_scale_factor(self._fontpath)
+        with _ttf_lock:
+            self._scale_factor = _fonts.get_scale_factor(self._fontpath)
         self._size, self._size_units = self._validate_size(self._size)
         self._size_pt = _size_to_pt(
             self._size, self._size_units, self._scale_factor
         )
 
-        # Load in font
-        self._font_ttf = _load_font(self._fontpath, self._size_pt)
+        # Styles with the same font, size, and colour render text identically, so
+        # they can share the same font handle and rendered text
+        self._font = None # loaded on first use
+        self._key = (self._fontpath, self._size_pt, self.color, self._line_h)
         self._initialized = True
 
     def __repr__(self):
@@ -127,16 +314,13 @@ class TextStyle(EnvAgent):
             info = "{0}, {1}{2}".format(self._fontname, self._size, self._size_units)
         return "klibs.TextStyle({0})".format(info)
     
-    def _get_scale_factor(self, fontpath):
-        # Determines the pt-to-pixels scale factor for the current font, with height
-        # in px defined as the maximum ASCII character height from baseline
-        # (ignoring punctuation). Allows fonts to be easily specified in px or deg.
-        caps = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        chars = caps + caps.lower() + "0123456789"
-        testfont = _load_font(fontpath, 40)
-        max_ascent = _get_max_ascent(testfont, chars)
-        TTF_CloseFont(testfont)
-        return 40 / float(max_ascent)
+    @property
+    def _font_ttf(self):
+        # The SDL_ttf font for the style, opened the first time it's needed
+        if self._font is None:
+            with _ttf_lock:
+                self._font = _fonts.get_font(self._fontpath, self._size_pt)
+        return self._font
 
     def _validate_size(self, size):
         # Determine font size and units
@@ -229,26 +413,9 @@ class TextManager(object):
         if width:
             surface_width = width
             wrapped_lines = []
-            w, segment_w, h = ctypes.c_int(0), ctypes.c_int(0), ctypes.c_int(0)
+            word_widths = {}
             for line in lines:
-                if len(line):
-                    # Get width of rendered string in pixels. If wider than surface, get character
-                    # position in string at position nearest cutoff, move backwards until space
-                    # character is encountered, and then trim string up to this point, adding it
-                    # to wrapped_lines.
-                    TTF_SizeUTF8(rendering_font, line, byref(w), byref(h))
-                    while w.value > surface_width:
-                        pos = int(surface_width/float(w.value) * len(line))
-                        segment = line[:pos].rstrip()
-                        TTF_SizeUTF8(rendering_font, segment, byref(segment_w), byref(h))
-                        while line.decode('utf-8')[pos] != ' ' or segment_w.value > surface_width:
-                            pos = pos - 1
-                            segment = line[:pos].rstrip()
-                            TTF_SizeUTF8(rendering_font, segment, byref(segment_w), byref(h))
-                        wrapped_lines.append(segment)
-                        line = line[pos:].lstrip()
-                        TTF_SizeUTF8(rendering_font, line, byref(w), byref(h))
-                wrapped_lines.append(line)
+                wrapped_lines += _wrap_line(rendering_font, line, width, word_widths)
             lines = wrapped_lines
         else:
             surface_width = 1
@@ -305,6 +472,61 @@ class TextManager(object):
         if not isinstance(text, bytes):
             text = utf8(text).encode('utf-8')
 
+        # SDL_ttf fonts aren't thread-safe, so text can only be rendered on one thread
+        # at a time (e.g. when pre-rendering stimuli in the background)
+        with _ttf_lock:
+            # If the string has been rendered recently with the same style and layout,
+            # reuse the cached array (copied only if the surface is modified)
+            key = (stl._key, text, align, max_width) if P.text_cache_size > 0 else None
+            if key is not None:
+                cached = _text_cache.get(key)
+                if cached is not None:
+                    return NpS(cached)
+            surface = self.__render(text, stl, align, max_width)
+            if key is not None:
+                arr = surface.render()
+                if _text_cache.add(key, arr):
+                    arr.flags.writeable = False
+                    surface = NpS(arr)
+            return surface
+
+
+    def preload(self, texts, style="default", align="left", max_width=None):
+        """Renders a list of strings ahead of time and keeps them cached, so that
+        rendering them again later (e.g. during a trial) only requires a cache lookup.
+
+        Unlike other cached text, preloaded strings are never dropped from the cache to
+        make room for new text. However, they still count towards the total size of the
+        cache (``P.text_cache_size``), and strings that don't fit are not preloaded.
+
+        Args:
+            texts (list): The strings (or numbers) to preload.
+            style (str, optional): The label of the text style with which the strings
+                should be rendered. Defaults to the "default" text style.
+            align (str, optional): The text justification to use when rendering
+                multi-line text. Can be 'left', 'right', or 'center' (defaults to 'left').
+            max_width (int, optional): The maximum line width for the rendered text.
+                Defaults to None.
+
+        Returns:
+            int: The number of strings that were successfully preloaded.
+
+        """
+        stl = style if isinstance(style, TextStyle) else self.styles[style]
+        if P.text_cache_size <= 0:
+            return 0
+        loaded = 0
+        with _ttf_lock:
+            for text in texts:
+                if not isinstance(text, bytes):
+                    text = utf8(text).encode('utf-8')
+                self.render(text, stl, align, max_width)
+                if _text_cache.pin((stl._key, text, align, max_width)):
+                    loaded += 1
+        return loaded
+
+
+    def __render(self, text, stl, align, max_width):
         rendering_font = stl._font_ttf
         if max_width != None:
             w, h = ctypes.c_int(0), ctypes.c_int(0)
@@ -319,13 +541,9 @@ class TextManager(object):
             return self.__wrap__(text, stl, rendering_font, align, max_width)
 
         if len(text) == 0:
-            text = " "
-        
-        bgra_color = SDL_Color(stl.color[2], stl.color[1], stl.color[0], stl.color[3])
-        rendered_text = TTF_RenderUTF8_Blended(rendering_font, text, bgra_color).contents
-        surface_array = surface_to_ndarray(rendered_text)
-        surface = NpS(surface_array)
-        return surface
+            text = b" "
+
+        return NpS(_render_ttf(rendering_font, text, stl.color))
 
 
     def add_font(self, name, filename=None):
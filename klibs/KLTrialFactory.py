@@ -120,6 +120,11 @@ class TrialIterator(BlockIterator):
             self.i += 1
             return self.trials[self.i - 1]
 
+    def peek(self):
+        # Returns the next trial in the block without advancing, or None if
+        # there are no more trials left in the block
+        return self.trials[self.i] if self.i < self.length else None
+
     def recycle(self):
         self.trials.append(self.trials[self.i - 1])
         temp = self.trials[self.i:]
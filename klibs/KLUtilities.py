@@ -6,6 +6,8 @@ import base64
 from hashlib import sha512
 from math import sin, cos, acos, atan2, radians, degrees, ceil
 
+import numpy as np
+
 from klibs import P
 from klibs.KLInternal import (
     boolean_to_logical, colored_stdout, full_trace, log, now, iterable, utf8,
@@ -18,6 +20,19 @@ from klibs.KLUserInterface import hide_cursor as hide_mouse_cursor
 
 
 
+# The number of points at which rotating a list of points is faster with NumPy than
+# with plain Python (for other list functions, converting to an array costs more than
+# it saves, so only array inputs use NumPy)
+_ROTATE_ARRAY_MIN = 16
+
+
+def _as_points(points, flat=False, dtype=np.float64):
+    # Converts a nested or flat list of x,y points (or an existing array of points)
+    # to an (N, 2) array (float by default, or the input's own type if dtype is None)
+    arr = np.asarray(points, dtype=dtype)
+    return arr.reshape(-1, 2) if (flat or arr.ndim == 1) else arr
+
+
 def acute_angle(vertex, p1, p2):
     # this is poorly named: acute angle is any angle under 90 degrees, but this function
     # calculates the angle between the two lines (vertex -> p1) and (vertex -> p2).
@@ -46,7 +61,8 @@ def canvas_size_from_points(points, flat=False):
     shape defined by a list of x,y points. 
 
     Args:
-        points (:obj:`List`): A list of points that make up the shape to determine canvas size for.
+        points (:obj:`List` or :obj:`numpy.ndarray`): A list or (N, 2) array of points that
+            make up the shape to determine canvas size for.
         flat (bool): Indicates whether the list of points is nested (e.g. [(x,y), (x,y), ...]) or 
             flat (e.g. [x, y, x, y, ...]). Defaults to False (nested).
 
@@ -55,6 +71,10 @@ def canvas_size_from_points(points, flat=False):
         the shape defined by the points.
 
     """
+    if isinstance(points, np.ndarray):
+        pts = _as_points(points, flat)
+        w, h = pts.max(axis=0) - pts.min(axis=0)
+        return [int(w) + 2, int(h) + 2]
     x_points = []
     y_points = []
     if flat: # aggdraw takes flat xy lists
@@ -117,18 +137,23 @@ def deg_to_px(deg, even=False):
 
 
 def interpolated_path_len(points):
-    # where points is a list of coordinate tuples
-    path_len = 0
-    for i in range(0, len(points)):
-        try:
-            p1 = [1.0 * points[i][0], 1.0 * points[i][1]]
-            p2 = [1.0 * points[i + 1][0], 1.0 * points[i + 1][1]]
-            path_len += line_segment_len(p1, p2)
-        except IndexError:
-            p1 = [1.0 * points[i][0], 1.0 * points[i][1]]
-            p2 = [1.0 * points[0][0], 1.0 * points[0][1]]
-            path_len += line_segment_len(p1, p2)
-    return path_len
+    """Determines the total length of a closed path through a set of points (i.e. the sum
+    of the distances between each point and the next, including the distance from the
+    last point back to the first).
+
+    Args:
+        points (:obj:`List` or :obj:`numpy.ndarray`): A list of (x, y) coordinate tuples or
+            an (N, 2) array of points.
+
+    Returns:
+        float: The length of the closed path through the points.
+
+    """
+    pts = _as_points(points)
+    if not len(pts):
+        return 0
+    deltas = np.diff(pts, axis=0, append=pts[:1])
+    return float(np.hypot(deltas[:, 0], deltas[:, 1]).sum())
 
 
 def linear_intersection(line_1, line_2):
@@ -274,6 +299,37 @@ def point_pos(origin, amplitude, angle, rotation=0, clockwise=False, return_int=
         raise
 
 
+def point_pos_array(origin, amplitudes, angles, rotation=0, clockwise=False, return_int=True):
+    """Determines the locations of multiple points on a 2D surface given an origin point
+    and their distances and angles from it. A vectorized version of :func:`point_pos`.
+
+    Args:
+        origin (:obj:`Tuple`): The origin point that the returned points will be relative to.
+        amplitudes (numeric or :obj:`numpy.ndarray`): The distance(s) between the origin
+            point and the points to be returned.
+        angles (numeric or :obj:`numpy.ndarray`): The angle(s) between the origin point and
+            the points to be returned.
+        rotation (float, optional): An additional angle to add to all the given angles.
+            Defaults to 0.
+        clockwise (bool, optional): Whether the angles are clockwise or not. Defaults to
+            False.
+        return_int (bool, optional): Whether the returned coordinates should be ints (useful
+            for pixels) or floats (most other use-cases). Defaults to True.
+
+    Returns:
+        :obj:`numpy.ndarray`: An (N, 2) array of the (x, y) coordinates of the points.
+
+    """
+    angles = np.asarray(angles, dtype=np.float64) + rotation
+    theta_rad = np.radians((angles if clockwise else -angles) % 360)
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    pts = np.empty(np.broadcast(amplitudes, theta_rad).shape + (2, ))
+    pts[..., 0] = origin[0] + amplitudes * np.cos(theta_rad)
+    pts[..., 1] = origin[1] + amplitudes * np.sin(theta_rad)
+    pts = pts.reshape(-1, 2)
+    return pts.astype(np.int64) if return_int else pts
+
+
 def pretty_list(items, sep=',', space=' ', before_last='or', brackets='[]', pad=True):
     """Takes an iterable (e.g. a :obj:`List`) and creates a nicely-formatted string from its
     contents. Useful for creating a list of possible options or responses to show to participants.
@@ -348,26 +404,55 @@ def rotate_points(points, origin, angle, clockwise=True, flat=False):
         points will be nested if flat=False and flat if flat=True).
 
     """
+    n = len(points) // 2 if flat else len(points)
+    if isinstance(points, np.ndarray) or n >= _ROTATE_ARRAY_MIN:
+        rotated = rotate_points_array(_as_points(points, flat), origin, angle, clockwise)
+        if flat: # aggdraw takes flat xy lists
+            return rotated.ravel().tolist()
+        return [tuple(p) for p in rotated.tolist()]
+
     rad_angle = radians((angle if clockwise else -angle) % 360)
+    c, s = (cos(rad_angle), sin(rad_angle))
+    ox, oy = origin[0], origin[1]
     rotated = []
+    pairs = zip(points[0::2], points[1::2]) if flat else points
+    for point in pairs:
+        dx = point[0] - ox
+        dy = point[1] - oy
+        # values rounded to 12 decimal places to avoid 0.99999999999...
+        rotated.append((round(ox + c * dx - s * dy, 12), round(oy + s * dx + c * dy, 12)))
     if flat: # aggdraw takes flat xy lists
-        for i in range(0, len(points), 2):
-            dx = points[i] - origin[0]
-            dy = points[i+1] - origin[1]
-            rx = origin[0] + cos(rad_angle) * dx - sin(rad_angle) * dy
-            ry = origin[1] + sin(rad_angle) * dx + cos(rad_angle) * dy
-            # values rounded to 12 decimal places to avoid 0.99999999999...
-            rotated += [round(rx, 12), round(ry, 12)]
-    else:
-        for point in points:
-            dx = point[0] - origin[0]
-            dy = point[1] - origin[1]
-            rx = origin[0] + cos(rad_angle) * dx - sin(rad_angle) * dy
-            ry = origin[1] + sin(rad_angle) * dx + cos(rad_angle) * dy
-            rotated.append((round(rx, 12), round(ry, 12)))
+        return [v for point in rotated for v in point]
     return rotated
 
 
+def rotate_points_array(points, origin, angle, clockwise=True):
+    """Rotates an array of x,y points around an origin point in 2d coordinate space. A
+    vectorized version of :func:`rotate_points`.
+
+    Args:
+        points (:obj:`numpy.ndarray`): An (N, 2) array of points to rotate.
+        origin (iter(x, y)): The x,y coordinates of the point to rotate the given points around.
+        angle (numeric): The angle in degrees by which to rotate the points around the origin.
+        clockwise(bool): Whether to rotate the points clockwise or counterclockwise. Defaults to
+            True (clockwise).
+
+    Returns:
+        :obj:`numpy.ndarray`: A new (N, 2) array of the rotated points.
+
+    """
+    rad_angle = radians((angle if clockwise else -angle) % 360)
+    c, s = (cos(rad_angle), sin(rad_angle))
+    pts = _as_points(points)
+    dx = pts[:, 0] - origin[0]
+    dy = pts[:, 1] - origin[1]
+    rotated = np.empty_like(pts)
+    rotated[:, 0] = origin[0] + c * dx - s * dy
+    rotated[:, 1] = origin[1] + s * dx + c * dy
+    # values rounded to 12 decimal places to avoid 0.99999999999...
+    return np.round(rotated, 12, out=rotated)
+
+
 def scale(coords, canvas_size, target_size=None, scale=True, center=True):
     """Scales and/or centers pixel coordinates intended for use at a given resolution to a
     smaller or larger resolution, maintaining aspect ratio.
@@ -396,9 +481,9 @@ def scale(coords, canvas_size, target_size=None, scale=True, center=True):
         tuple: The scaled (x,y) coordinates.
 
     """
-    x,y = coords
     if tuple(canvas_size) == P.screen_x_y:
         return coords
+    x, y = coords
     if not target_size:
         target_size = P.screen_x_y if scale else canvas_size
     if scale:
@@ -412,13 +497,57 @@ def scale(coords, canvas_size, target_size=None, scale=True, center=True):
             target_size[1] = target_size[0]/canvas_ratio
         x = int( (x/canvas_size[0])*target_size[0] )
         y = int( (y/canvas_size[1])*target_size[1] )
-    
+
     if center:
         x = x + int(P.screen_x/2 - (target_size[0]/2))
         y = y + int(P.screen_y/2 - (target_size[1]/2))
     return (x,y)
 
 
+def scale_array(coords, canvas_size, target_size=None, scale=True, center=True):
+    """Scales and/or centers an array of pixel coordinates intended for use at a given
+    resolution to a smaller or larger resolution, maintaining aspect ratio. A vectorized
+    version of :func:`scale` (see that function for more details).
+
+    Args:
+        coords (:obj:`numpy.ndarray`): An (N, 2) array of the (x, y) coordinates to scale.
+        canvas_size (tuple): The size in pixels of the original surface.
+        target_size (tuple, optional): The size in pixels of the intended output surface. Defaults
+            to the current screen resolution (P.screen_x_y).
+        scale (bool, optional): If True, the input coordinates will be scaled to target_size.
+        center (bool, optional): If True, and target_size is larger canvas_size or has a different
+            aspect ratio, the input coordinates will be translated so that the they are aligned to
+            the center of the target surface and not the upper-left corner.
+
+    Returns:
+        :obj:`numpy.ndarray`: An (N, 2) array of the scaled (x, y) coordinates.
+
+    """
+    coords = np.asarray(coords)
+    if tuple(canvas_size) == P.screen_x_y:
+        return coords.copy()
+    if not target_size:
+        target_size = P.screen_x_y if scale else canvas_size
+    if scale:
+        canvas_size = [float(i) for i in canvas_size]
+        target_size = [float(i) for i in target_size]
+        canvas_ratio = canvas_size[0]/canvas_size[1]
+        target_ratio = target_size[0]/target_size[1]
+        if target_ratio > canvas_ratio:
+            target_size[0] = target_size[1]*canvas_ratio
+        elif target_ratio < canvas_ratio:
+            target_size[1] = target_size[0]/canvas_ratio
+        coords = ((coords / canvas_size) * target_size).astype(np.int64)
+    else:
+        coords = coords.copy()
+
+    if center:
+        coords += [
+            int(P.screen_x/2 - (target_size[0]/2)), int(P.screen_y/2 - (target_size[1]/2))
+        ]
+    return coords
+
+
 def translate_points(points, delta, flat=False):
     """Translates a list of x,y points in 2d coordinate space.
 
@@ -434,15 +563,35 @@ def translate_points(points, delta, flat=False):
         points will be nested if flat=False and flat if flat=True).
 
     """
-    translated = []
+    if isinstance(points, np.ndarray):
+        translated = translate_points_array(_as_points(points, flat, dtype=None), delta)
+        if flat: # aggdraw takes flat xy lists
+            return translated.ravel().tolist()
+        return [tuple(p) for p in translated.tolist()]
+
+    dx, dy = delta[0], delta[1]
     if flat: # aggdraw takes flat xy lists
+        translated = []
         for i in range(0, len(points), 2):
-            dx = points[i] + delta[0]
-            dy = points[i+1] + delta[1]
-            translated += [dx, dy]
-    else:
-        for point in points:
-            dx = point[0] + delta[0]
-            dy = point[1] + delta[1]
-            translated.append((dx, dy))
-    return translated
+            translated += [points[i] + dx, points[i+1] + dy]
+        return translated
+    return [(point[0] + dx, point[1] + dy) for point in points]
+
+
+def translate_points_array(points, delta):
+    """Translates an array of x,y points in 2d coordinate space. A vectorized version of
+    :func:`translate_points`.
+
+    Args:
+        points (:obj:`numpy.ndarray`): An (N, 2) array of points to translate.
+        delta (iter(dx, dy)): An iterable containing the dx and dy values to translate all
+            points by.
+
+    Returns:
+        :obj:`numpy.ndarray`: A new (N, 2) array of the translated points. The array
+        will be integer if both the points and delta are integers, otherwise float.
+
+    """
+    points = _as_points(points, dtype=None)
+    delta = np.asarray(delta)
+    return points.astype(np.result_type(points, delta, np.int64)) + delta
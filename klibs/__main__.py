@@ -66,7 +66,7 @@ def klibs_main():
 
     parser = argparse.ArgumentParser(
         description='The command-line interface for the KLibs framework.',
-        usage='klibs (create | run | export | update | db-rebuild | hard-reset) [-h]',
+        usage='klibs (create | run | export | update | db-rebuild | db-analyze | hard-reset) [-h]',
         formatter_class=CustomHelpFormatter,
         epilog="For help on how to use a specific command, try 'klibs (command) --help'."
     )
@@ -125,7 +125,7 @@ def klibs_main():
 
     export_parser = subparsers.add_parser('export', formatter_class=CustomHelpFormatter,
         help='Export data to ExpAssets/Data/',
-        usage='klibs export [path] [-c] [-t <primary_table>] [-j <table1,...>] [--help]'
+        usage='klibs export [path] [-c] [-t <primary_table>] [-j <table1,...>] [-f <format>] [-i] [--jobs <n>] [--help]'
     )
     export_parser.add_argument('path', default=os.getcwd(), nargs="?", type=str, metavar="path",
         help=("Path to the directory containing the KLibs project. "
@@ -143,6 +143,20 @@ def klibs_main():
         help=("Additional tables to be joined to the data output. "
         "Only 'participant' and 'data' tables are joined by default.")
     )
+    export_parser.add_argument('-f', '--format', dest='fmt', default='txt', metavar="format",
+        choices=['txt', 'parquet', 'arrow', 'npz'],
+        help=("The file format to export data to. Can be 'txt' (TAB-delimited text), "
+        "'parquet', 'arrow' (Arrow IPC), or 'npz' (NumPy). Parquet and Arrow require "
+        "pyarrow to be installed. Defaults to 'txt'.")
+    )
+    export_parser.add_argument('-i', '--incremental', action="store_true",
+        help=("Only export rows added since the last incremental export, appending them "
+        "to a separate combined data file. Implies --combined.")
+    )
+    export_parser.add_argument('--jobs', type=int, default=1, metavar="n",
+        help=("The number of worker processes to use when exporting data to individual "
+        "participant files. Defaults to 1.")
+    )
 
     update_parser = subparsers.add_parser('update', formatter_class=CustomHelpFormatter,
         help='Update KLibs to the latest available version',
@@ -162,6 +176,15 @@ def klibs_main():
         "Defaults to current working directory.")
     )
 
+    analyze_parser = subparsers.add_parser('db-analyze',
+        help='Optimize the database and check for slow queries',
+        usage='klibs db-analyze [path] [-h]'
+    )
+    analyze_parser.add_argument('path', default=os.getcwd(), nargs="?", type=str,
+        help=("Path to the directory containing the KLibs project. "
+        "Defaults to current working directory.")
+    )
+
     reset_parser = subparsers.add_parser('hard-reset',
         help='Delete all collected data',
         usage='klibs hard-reset [path] [-h]'
@@ -184,6 +207,7 @@ def klibs_main():
         "run": cli.run,
         "export": cli.export,
         "db-rebuild": cli.rebuild_db,
+        "db-analyze": cli.analyze_db,
         "hard-reset": cli.hard_reset,
         "update": cli.update,
     }
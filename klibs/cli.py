@@ -245,7 +245,6 @@ def run(screen_size, path, condition, devmode, no_tracker, seed):
     cso("\n<green>*** Now Loading KLibs Environment ***</green>\n")
 
     # Suppresses possible pysdl2-dll warning message on import
-    import shutil
     import warnings
     with warnings.catch_warnings():	
         warnings.simplefilter("ignore")
@@ -254,7 +253,7 @@ def run(screen_size, path, condition, devmode, no_tracker, seed):
     from klibs import P
     from klibs import env
     from klibs.KLGraphics.core import display_init
-    from klibs.KLDatabase import DatabaseManager
+    from klibs.KLDatabase import DatabaseManager, backup_database
     from klibs.KLText import TextManager
     from klibs.KLCommunication import init_messaging, collect_demographics, init_default_textstyles
 
@@ -330,7 +329,7 @@ def run(screen_size, path, condition, devmode, no_tracker, seed):
     #TODO: check if current commit matches experiment.py and warn user if not
 
     # Back up database before starting the session
-    shutil.copy(P.database_path, P.database_backup_path)
+    backup_database(P.database_path, P.database_backup_path)
 
     # create runtime environment
     env.txtm = TextManager()
@@ -345,7 +344,7 @@ def run(screen_size, path, condition, devmode, no_tracker, seed):
         except RuntimeError:
             return
     env.db = DatabaseManager(
-        P.database_path, P.database_local_path if P.multi_user else None
+        P.database_path, P.database_local_path if P.multi_user else None, P.spool_dir
     )
 
     try:
@@ -377,7 +376,7 @@ def run(screen_size, path, condition, devmode, no_tracker, seed):
         ))
 
 
-def export(path, table=None, combined=False, join=None):
+def export(path, table=None, combined=False, join=None, jobs=1, fmt='txt', incremental=False):
     from klibs import P
     from klibs.KLDatabase import DatabaseManager
 
@@ -395,11 +394,13 @@ def export(path, table=None, combined=False, join=None):
     # import params defined in project's local params file in ExpAssets/Config
     for k, v in load_source(P.params_file_path).items():
         setattr(P, k, v)
-    multi_file = combined != True
+    multi_file = combined != True and incremental != True
 
     # Validate database path and export
     P.database_path = validate_database_path(P.database_path)
-    DatabaseManager(P.database_path).export(table, multi_file, join)
+    DatabaseManager(P.database_path).export(
+        table, multi_file, join, jobs, fmt, incremental
+    )
 
 
 def rebuild_db(path):
@@ -433,6 +434,40 @@ def rebuild_db(path):
         cso(err.format(schema_filename, exc_txt))
 
 
+def analyze_db(path):
+    from klibs import P
+    from klibs.KLDatabase import DatabaseManager
+
+    # Sanitize and switch to path, exiting with error if not a KLibs project directory
+    project_name = initialize_path(path)
+
+    # set initial param values for project's context
+    P.initialize_paths(project_name)
+
+    # import params defined in project's local params file in ExpAssets/Config
+    for k, v in load_source(P.params_file_path).items():
+        setattr(P, k, v)
+
+    # Validate database path, then update query statistics and check query plans
+    P.database_path = validate_database_path(P.database_path)
+    db = DatabaseManager(P.database_path)
+    results = db.analyze()
+    db.close()
+
+    cso("<green_d>Database statistics updated successfully!</green_d>\n")
+    for q, plan, slow in results:
+        status = "<red>(slow)</red>" if len(slow) else "<green_d>(ok)</green_d>"
+        cso("<cyan>Query:</cyan> {0} {1}".format(q, status))
+        for step in plan:
+            step_str = "<red>{0}</red>".format(step) if step in slow else step
+            cso("  > " + step_str)
+        print("")
+    n_slow = len([r for r in results if len(r[2])])
+    if n_slow:
+        cso("<red>{0} of {1} queries have slow query plans.</red> Adding indexes for the "
+            "columns used in these queries may help.".format(n_slow, len(results)))
+
+
 def hard_reset(path):
     import shutil
 
@@ -443,7 +478,8 @@ def hard_reset(path):
     P.initialize_paths(project_name)
     reset_files = [P.database_path, P.database_backup_path]
     reset_dirs = [
-        P.incomplete_data_dir, P.incomplete_edf_dir, P.logs_dir, P.versions_dir
+        P.incomplete_data_dir, P.incomplete_edf_dir, P.logs_dir, P.versions_dir,
+        P.spool_dir
     ]
 
     reset_prompt = cso(
@@ -461,10 +497,13 @@ def hard_reset(path):
             shutil.rmtree(d)
     ensure_directory_structure(path, create_missing=True)
 
-    # Remove (but don't replace) files to reset
+    # Remove (but don't replace) files to reset, along with any write-ahead log and
+    # deferred-insert journal files for the databases (which would otherwise be
+    # applied to new ones)
     for f in reset_files:
-        if os.path.isfile(f):
-            os.remove(f)
+        for suffix in ["", "-wal", "-shm", ".journal"]:
+            if os.path.isfile(f + suffix):
+                os.remove(f + suffix)
     
     cso("\nProject reset successfully.")
 
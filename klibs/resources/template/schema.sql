@@ -33,6 +33,16 @@ while within the root of your project folder. This will export all participant a
 data in the database to text files found in PROJECT_NAME/ExpAssets/Data.
 
 
+Indexes on the 'participant_id' column of each table are created automatically when the
+database is built. If you frequently look up rows in a table by some other column, you
+can add an index for it with a 'CREATE INDEX' statement at the end of this file. To check
+for slow queries and update the database's query statistics, you can run:
+
+  klibs db-analyze
+
+while within the root of your project folder.
+
+
 Note that you *really* do not need to be concerned about datatypes when adding columns;
 in the end, everything will be a string when the data is exported. The *only* reason you
 would use a datatype other than 'text' would be to ensure that the program will throw an
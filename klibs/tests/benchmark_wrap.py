@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks word wrapping for long, multi-paragraph instruction text.
+
+Not collected by pytest. Run directly from the root of the repository with::
+
+    PYTHONPATH=. python klibs/tests/benchmark_wrap.py
+
+"""
+
+import os
+import timeit
+from ctypes import byref, c_int
+
+from sdl2.ext.ttf import _ttf_init
+from sdl2.sdlttf import TTF_SizeUTF8
+
+from klibs.KLText import _fonts, _wrap_line
+
+
+FONT = os.path.join(os.path.dirname(__file__), '..', 'resources', 'font', 'Hind-Medium.otf')
+SIZE_PX = 24
+WIDTHS = (1600, 800, 400)
+
+PARAGRAPH = (
+    "In this task, you will see a series of shapes appear on the screen. On each "
+    "trial, a small cross will appear in the middle of the screen, followed shortly "
+    "after by a target to either the left or the right of it. As soon as you see the "
+    "target, press the key on the side where it appeared as quickly and accurately as "
+    "you can. Try to keep your eyes on the cross in the middle of the screen for the "
+    "whole trial, even when a target appears. "
+)
+INSTRUCTIONS = "\n\n".join([PARAGRAPH] * 4).encode('utf-8')
+LONG_PARAGRAPH = (PARAGRAPH * 16).encode('utf-8')
+
+
+def _wrap_old(font, text, width):
+    # The previous wrapping loop from TextManager.__wrap__, kept for comparison
+    wrapped_lines = []
+    w, segment_w, h = c_int(0), c_int(0), c_int(0)
+    for line in text.split(b"\n"):
+        if len(line):
+            TTF_SizeUTF8(font, line, byref(w), byref(h))
+            while w.value > width:
+                pos = int(width/float(w.value) * len(line))
+                segment = line[:pos].rstrip()
+                TTF_SizeUTF8(font, segment, byref(segment_w), byref(h))
+                while line.decode('utf-8')[pos] != ' ' or segment_w.value > width:
+                    pos = pos - 1
+                    segment = line[:pos].rstrip()
+                    TTF_SizeUTF8(font, segment, byref(segment_w), byref(h))
+                wrapped_lines.append(segment)
+                line = line[pos:].lstrip()
+                TTF_SizeUTF8(font, line, byref(w), byref(h))
+        wrapped_lines.append(line)
+    return wrapped_lines
+
+
+def _wrap(font, text, width):
+    # Wraps each paragraph of a message, as TextManager does when rendering
+    widths = {}
+    return [_wrap_line(font, line, width, widths) for line in text.split(b"\n")]
+
+
+def _best_ms(func, font, text, repeats):
+    # Gets the fastest time (in ms) for wrapping a given text at each wrap width
+    times = []
+    for width in WIDTHS:
+        t = min(timeit.repeat(lambda: func(font, text, width), number=1, repeat=repeats))
+        times.append("{0:.1f}".format(t * 1000))
+    return " / ".join(times)
+
+
+def main(repeats=20):
+    _ttf_init()
+    scale = _fonts.get_scale_factor(FONT.encode('utf-8'))
+    font = _fonts.get_font(FONT.encode('utf-8'), SIZE_PX * scale)
+
+    print("Line breaking, Hind-Medium at {0}px (best of {1}):".format(SIZE_PX, repeats))
+    for label, text in [("4 paragraphs", INSTRUCTIONS), ("1 long paragraph", LONG_PARAGRAPH)]:
+        old = _best_ms(_wrap_old, font, text, repeats)
+        new = _best_ms(_wrap, font, text, repeats)
+        info = "{0} (~{1:.1f}k chars):".format(label, len(text) / 1000.0)
+        print("  {0:<32} {1} ms -> {2} ms".format(info, old, new))
+    print("  (wrap widths {0} px)".format(" / ".join(str(w) for w in WIDTHS)))
+
+
+if __name__ == '__main__':
+    main()
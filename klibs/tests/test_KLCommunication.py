@@ -5,7 +5,7 @@ from PIL import Image
 from klibs import P
 from klibs.KLGraphics import NumpySurface
 from klibs.KLText import TextStyle
-from klibs.KLCommunication import message
+from klibs.KLCommunication import message, cache_messages
 
 
 def test_message(with_text_init):
@@ -45,3 +45,18 @@ def test_message(with_text_init):
         x_offset[align] = img.getbbox()[0]
     assert x_offset["center"] > x_offset["left"]
     assert x_offset["right"] > x_offset["center"]
+
+
+def test_cache_messages(with_text_init):
+    from klibs.KLText import _text_cache
+
+    # Test that cached messages are reused when rendered with the same parameters
+    assert cache_messages(["Press space to continue.", "Too slow!"], style="alert") == 2
+    msg = message("Too slow!", style="alert")
+    assert msg.render() is message("Too slow!", style="alert").render()
+    assert msg.render() is not message("Too slow!").render()
+    _text_cache.clear()
+
+    # Test exception for nonexistent text styles
+    with pytest.raises(RuntimeError):
+        cache_messages(["Hello!"], style="nonexistent")
@@ -1,8 +1,13 @@
 import os
+import shutil
+import sqlite3
 import tempfile
+import threading
 import pytest
+import numpy as np
 
 import klibs
+from klibs import P
 from klibs import KLDatabase as kldb
 from klibs.KLRuntimeInfo import runtime_info_init
 
@@ -20,6 +25,14 @@ def db_test_path():
     yield testpath
     os.remove(testpath)
 
+@pytest.fixture
+def export_dirs(tmpdir):
+    P.project_name = "test"
+    P.data_dir = str(tmpdir)
+    P.incomplete_data_dir = os.path.join(str(tmpdir), "incomplete")
+    os.mkdir(P.incomplete_data_dir)
+    yield str(tmpdir)
+
 @pytest.fixture
 def db(db_test_path):
     tmp = kldb.Database(db_test_path)
@@ -46,6 +59,22 @@ def generate_data_row(pid=1, block=1, trial=1):
     }
     return dat
 
+def add_export_test_data(dat, trials=(3, 2, 0)):
+    # Add participants, session info, and trials to a database for export tests
+    _init_params_pytest()
+    for pid, row in enumerate(build_test_data(), 1):
+        dat.insert(row, table='participants')
+        P.participant_id = pid
+        dat.insert(runtime_info_init(), table='session_info')
+        for trial in range(trials[pid - 1]):
+            dat.insert(generate_data_row(pid, trial=trial+1), table='trials')
+
+def read_export(path):
+    # Read the column names and data rows from an exported file
+    with open(path, 'r') as f:
+        lines = [l for l in f.read().split("\n") if len(l) and l[0] != "#"]
+    return lines[0].split("\t"), [l.split("\t") for l in lines[1:]]
+
 def build_test_data():
     rows = [
         generate_id_row(uid="P01"),
@@ -64,6 +93,29 @@ def test_rebuild_database():
     # Test that the old database gets backed up on rebuild
     kldb.rebuild_database(testpath, schema_path)
     assert os.path.exists(testpath + ".backup")
+    # Test that participant_id indexes are created automatically
+    dat = kldb.Database(testpath)
+    indexes = dat.query("SELECT tbl_name FROM sqlite_master WHERE type = 'index'")
+    for table in ['trials', 'session_info', 'export_history', 'frame_stats']:
+        assert (table, ) in indexes
+    dat.close()
+
+
+def test_backup_database(tmpdir):
+    testpath = os.path.join(str(tmpdir), "test.db")
+    backup_path = testpath + ".backup"
+    kldb.rebuild_database(testpath, schema_path)
+    # Test that backups include changes that are still in the write-ahead log
+    dat = kldb.Database(testpath)
+    dat.insert(generate_id_row(uid="P01"), table='participants')
+    assert os.path.getsize(testpath + "-wal") > 0
+    open(backup_path + "-wal", "w").close()
+    kldb.backup_database(testpath, backup_path)
+    dat.close()
+    assert not os.path.exists(backup_path + "-wal")
+    backup = kldb.Database(backup_path)
+    assert len(backup.select('participants')) == 1
+    backup.close()
 
 
 
@@ -76,6 +128,36 @@ class TestDatabase(object):
         assert dat.table_schemas['participants']['age']['type'] == klibs.PY_INT
         dat.close()
 
+    def test_frame_stats_table(self, db_test_path):
+        # Test that the frame_stats table is created as an internal table
+        dat = kldb.DatabaseManager(db_test_path)
+        assert "frame_stats" in dat.tables
+        assert not "frame_stats" in kldb._get_user_tables(dat._primary)
+        dat.close()
+
+    def test_connection_profile(self, db_test_path):
+        dat = kldb.Database(db_test_path)
+        assert dat.query("PRAGMA journal_mode")[0][0] == "wal"
+        assert dat.query("PRAGMA temp_store")[0][0] == 2
+        # Test that the database can be read while a session has it open
+        dat.insert(build_test_data()[0], table='participants')
+        reader = sqlite3.connect("file:{0}?mode=ro".format(db_test_path), uri=True)
+        assert reader.execute("SELECT COUNT(*) FROM participants").fetchone()[0] == 1
+        reader.close()
+        dat.close()
+        # Test disabling the connection profile and invalid settings
+        profile = P.db_connection_profile
+        try:
+            P.db_connection_profile = None
+            dat = kldb.Database(db_test_path)
+            assert dat.query("PRAGMA temp_store")[0][0] == 0
+            dat.close()
+            P.db_connection_profile = {'cache_size': '1; DROP TABLE trials'}
+            with pytest.raises(ValueError):
+                kldb.Database(db_test_path)
+        finally:
+            P.db_connection_profile = profile
+
     def test_tables(self, db):
         assert "participants" in db.tables
         assert "trials" in db.tables
@@ -138,6 +220,129 @@ class TestDatabase(object):
         with pytest.raises(ValueError):
             db.insert(data, table='participants')
 
+    def test_insert_rows(self, db):
+        # Test inserting rows as tuples in table order
+        rows = [(1, 1, i + 1) for i in range(3)]
+        assert db.insert_rows(rows, 'trials') == 3
+        assert db.select('trials', columns=['trial_num']) == [(1,), (2,), (3,)]
+        # Test inserting rows with a different column order & coercion
+        cols = ['trial_num', 'participant_id', 'block_num']
+        db.insert_rows([("4", 1, 2), (5.0, 1, 2)], 'trials', columns=cols)
+        assert db.select('trials', where={'trial_num': 5})[0] == (5, 1, 2, 5)
+        # Test inserting rows from a NumPy structured array
+        arr = np.zeros(4, dtype=[('participant_id', 'i4'), ('block_num', 'i8'), ('trial_num', 'f8')])
+        arr['participant_id'] = 1
+        arr['block_num'] = 3
+        arr['trial_num'] = np.arange(4) + 6
+        assert db.insert_rows(arr, 'trials') == 9
+        assert db.select('trials', where={'block_num': 3})[-1] == (9, 1, 3, 9)
+        # Test exception on non-structured arrays
+        with pytest.raises(TypeError):
+            db.insert_rows(np.zeros((2, 3)), 'trials')
+        # Test exception on wrong number of values per row
+        with pytest.raises(ValueError):
+            db.insert_rows([(1, 1)], 'trials')
+        # Test exception when unable to coerce a value to the column type
+        with pytest.raises(ValueError):
+            db.insert_rows([(1, 1, "hello")], 'trials')
+        # Test exception on missing columns
+        with pytest.raises(ValueError):
+            db.insert_rows([(1, 1)], 'trials', columns=['participant_id', 'block_num'])
+
+    def test_insert_columns(self, db):
+        db.insert(build_test_data()[0], table='participants')
+        # Test inserting NumPy arrays, lists, and single values
+        last = db.insert_columns('trials', {
+            'participant_id': 1,
+            'block_num': np.array([1, 1, 2], dtype=np.int32),
+            'trial_num': ["1", 2.0, 3],
+        })
+        assert last == 3
+        rows = db.select('trials', ['participant_id', 'block_num', 'trial_num'])
+        assert rows == [(1, 1, 1), (1, 1, 2), (1, 2, 3)]
+        assert all(type(v) == int for row in rows for v in row)
+        # Test inserting a single row and deferring inserts
+        db.insert_columns('trials', {'participant_id': 1, 'block_num': 3, 'trial_num': 1})
+        assert db.insert_columns('trials', {
+            'participant_id': 1, 'block_num': 3, 'trial_num': np.arange(2, 4)
+        }, defer=True) is None
+        assert db.last_row_id('trials') == 6
+        # Test errors for mismatched lengths, bad values, and multidimensional arrays
+        with pytest.raises(ValueError):
+            db.insert_columns('trials', {
+                'participant_id': [1, 1], 'block_num': [1, 1], 'trial_num': [1, 2, 3]
+            })
+        with pytest.raises(ValueError, match="trial_num"):
+            db.insert_columns('trials', {
+                'participant_id': 1, 'block_num': 1, 'trial_num': [1, "two"]
+            })
+        with pytest.raises(ValueError):
+            db.insert_columns('trials', {
+                'participant_id': 1, 'block_num': 1, 'trial_num': np.ones((2, 2))
+            })
+        assert db.last_row_id('trials') == 6
+
+    def test_insert_deferred(self, db_test_path):
+        db = kldb.Database(db_test_path)
+        journal_path = db_test_path + ".journal"
+        # Test that deferred rows are queued & journaled instead of written
+        rows = [generate_data_row(trial=i+1) for i in range(3)]
+        assert db.insert(rows, table='trials', defer=True) == None
+        assert len(db._deferred) == 3
+        assert os.path.exists(journal_path)
+        # Test that deferred rows are written out before reading the database
+        assert len(db.select('trials')) == 3
+        assert len(db._deferred) == 0
+        assert not os.path.exists(journal_path)
+        # Test that validation errors are raised immediately for deferred rows
+        data = generate_data_row(trial=4)
+        data["trial_num"] = "hello"
+        with pytest.raises(ValueError):
+            db.insert(data, table='trials', defer=True)
+        # Test that deferred rows are written out automatically once the limit is hit
+        klibs.P.db_flush_rows = 2
+        db.insert(generate_data_row(trial=4), table='trials', defer=True)
+        assert len(db._deferred) == 1
+        db.insert(generate_data_row(trial=5), table='trials', defer=True)
+        assert len(db._deferred) == 0
+        klibs.P.db_flush_rows = 500
+        # Test that journaled rows are recovered if the session crashes
+        db.insert(generate_data_row(trial=6), table='trials', defer=True)
+        db._journal.close()
+        db.cursor.close()
+        db.db.close()
+        db = kldb.Database(db_test_path)
+        assert not os.path.exists(journal_path)
+        assert db.last_row_id('trials') == 6
+        # Test that batches committed just before a crash aren't recovered twice
+        db.insert(generate_data_row(trial=7), table='trials', defer=True)
+        shutil.copy(journal_path, journal_path + ".bak")
+        db.flush_deferred()
+        db.close()
+        os.rename(journal_path + ".bak", journal_path)
+        db = kldb.Database(db_test_path)
+        assert not os.path.exists(journal_path)
+        assert db.last_row_id('trials') == 7
+        assert len(db.select('trials')) == 7
+        db.close()
+        # Test that journals aren't recovered into a rebuilt database at the same path,
+        # but are kept with the backup of the old database
+        db = kldb.Database(db_test_path)
+        db.insert(generate_data_row(trial=8), table='trials', defer=True)
+        db._journal.close()
+        db.cursor.close()
+        db.db.close()
+        kldb.rebuild_database(db_test_path, schema_path)
+        assert not os.path.exists(journal_path)
+        shutil.copy(db_test_path + ".backup.journal", journal_path)
+        db = kldb.Database(db_test_path)
+        assert not os.path.exists(journal_path)
+        assert len(db.select('trials')) == 0
+        db.close()
+        db = kldb.Database(db_test_path + ".backup")
+        assert len(db.select('trials')) == 8
+        db.close()
+
     def test_flush(self, db):
         # Insert test data into the database
         data = build_test_data()
@@ -224,11 +429,104 @@ class TestDatabaseManager(object):
         localpath = os.path.join(tmpdir, "tmp_local.db")
         dat = kldb.DatabaseManager(db_test_path, localpath)
         assert os.path.exists(localpath)
+        # Make sure the shared master database doesn't use WAL mode
+        assert dat._primary.query("PRAGMA journal_mode")[0][0] == "delete"
+        assert dat._local.query("PRAGMA journal_mode")[0][0] == "wal"
         assert "participants" in list(dat.table_schemas.keys())
         assert "age" in list(dat.table_schemas['participants'].keys())
         assert dat.table_schemas['participants']['age']['type'] == klibs.PY_INT
         dat.close()
 
+    def test_merge_multi_user(self, db_test_path, tmpdir):
+        localpath = os.path.join(str(tmpdir), "tmp_local.db")
+        spool = os.path.join(str(tmpdir), "spool")
+        # Add an existing participant to the master database
+        dat = kldb.Database(db_test_path)
+        dat.insert(generate_id_row(uid="P00"), table='participants')
+        dat.close()
+        retries, backoff, p_id = (P.db_merge_retries, P.db_merge_backoff, P.participant_id)
+        timeout = P.db_merge_timeout
+        try:
+            # Test merging a session's data into the master database
+            dat = kldb.DatabaseManager(db_test_path, localpath, spool)
+            add_export_test_data(dat, trials=(2, 1, 0))
+            dat.close()
+            assert P.participant_id == 4
+            assert not os.path.exists(localpath)
+            assert len(os.listdir(spool)) == 0
+            dat = kldb.Database(db_test_path)
+            assert len(dat.select('participants')) == 4
+            assert dat.select('trials', ['participant_id']) == [(2, ), (2, ), (3, )]
+            assert len(dat.select('session_info', where={'participant_id': 4})) == 1
+            dat.close()
+            # Test that a session is kept in the spool if the master is locked
+            P.db_merge_retries, P.db_merge_backoff, P.db_merge_timeout = (2, 0.01, 0.01)
+            dat = kldb.DatabaseManager(db_test_path, localpath, spool)
+            dat.insert(generate_id_row(uid="P04"), table='participants')
+            lock = sqlite3.connect(db_test_path, isolation_level=None)
+            lock.execute("BEGIN IMMEDIATE")
+            dat.close()
+            assert os.listdir(spool) == ["tmp_local.db"]
+            spooled = os.path.join(spool, "tmp_local.db")
+            with pytest.raises(sqlite3.OperationalError):
+                kldb.merge_database(spooled, db_test_path, retries=0, timeout=0.01)
+            lock.execute("ROLLBACK")
+            lock.close()
+            # Test that spooled sessions are merged when the next session starts,
+            # and that re-merging already-merged data does nothing
+            shutil.copy(spooled, spooled + ".copy")
+            dat = kldb.DatabaseManager(db_test_path, localpath, spool)
+            assert len(os.listdir(spool)) == 1
+            assert kldb.merge_database(spooled + ".copy", db_test_path) == {}
+            assert dat._primary.select('participants', ['userhash'])[-1] == ("P04", )
+            assert len(dat._primary.select('participants')) == 5
+            dat.close()
+            # Test that partially re-merging a database doesn't duplicate the rows
+            # of tables without participant ids
+            q = "CREATE TABLE notes (id integer primary key autoincrement not null, note text)"
+            dat = kldb.Database(db_test_path)
+            dat.query(q, commit=True)
+            dat.query("INSERT INTO notes (note) VALUES ('hello')", commit=True)
+            dat.close()
+            partial = os.path.join(str(tmpdir), "partial.db")
+            shutil.copy(db_test_path, partial)
+            dat = kldb.Database(partial)
+            dat.insert(generate_id_row(uid="P05"), table='participants')
+            dat.close()
+            id_map = kldb.merge_database(partial, db_test_path)
+            assert list(id_map.keys()) == [6]
+            dat = kldb.Database(db_test_path)
+            assert len(dat.select('participants')) == 6
+            assert len(dat.select('notes')) == 1
+            assert len(dat.select('trials')) == 3
+            dat.close()
+            # Test that merges are retried if the master is locked while committing
+            # (e.g. by another session reading from it)
+            later = os.path.join(str(tmpdir), "later.db")
+            shutil.copy(partial, later)
+            dat = kldb.Database(later)
+            dat.insert(generate_id_row(uid="P06"), table='participants')
+            dat.close()
+            reader = sqlite3.connect(
+                db_test_path, isolation_level=None, check_same_thread=False
+            )
+            reader.execute("BEGIN")
+            reader.execute("SELECT * FROM participants").fetchall()
+            release = threading.Timer(0.3, lambda: reader.execute("COMMIT"))
+            release.start()
+            try:
+                id_map = kldb.merge_database(later, db_test_path, backoff=0.02, timeout=0.01)
+            finally:
+                release.join()
+                reader.close()
+            assert list(id_map.keys()) == [7]
+            dat = kldb.Database(db_test_path)
+            assert len(dat.select('participants')) == 7
+            dat.close()
+        finally:
+            P.db_merge_retries, P.db_merge_backoff, P.participant_id = (retries, backoff, p_id)
+            P.db_merge_timeout = timeout
+
     def test_get_unique_ids(self, db_test_path):
         dat = kldb.DatabaseManager(db_test_path)
         # Add test data
@@ -282,3 +580,150 @@ class TestDatabaseManager(object):
         with pytest.raises(ValueError):
             dat.remove_data("P011001010101")
         dat.close()
+
+    def test_export(self, db_test_path, export_dirs):
+        dat = kldb.DatabaseManager(db_test_path)
+        add_export_test_data(dat)
+        # Test exporting data to individual participant files
+        dat.export()
+        outfiles = sorted(os.listdir(P.incomplete_data_dir))
+        assert len(outfiles) == 3
+        assert outfiles[0].startswith("p1.")
+        colnames, rows = read_export(os.path.join(P.incomplete_data_dir, outfiles[0]))
+        assert colnames == ["participant", "gender", "age", "handedness", "block_num", "trial_num"]
+        assert len(rows) == 3
+        assert rows[0] == ["P01", "f", "24", "r", "1", "1"]
+        assert [r[-1] for r in rows] == ["1", "2", "3"]
+        _, rows = read_export(os.path.join(P.incomplete_data_dir, outfiles[2]))
+        assert len(rows) == 0
+        # Test that already-exported participants are skipped on re-export
+        dat.export()
+        assert len(os.listdir(P.incomplete_data_dir)) == 3
+        # Test exporting data to a single combined file
+        dat.export(multi_file=False)
+        outfile = os.path.join(export_dirs, "test_all_trials.txt")
+        assert os.path.isfile(outfile)
+        colnames, rows = read_export(outfile)
+        assert len(rows) == 5
+        assert [r[0] for r in rows] == ["P01"] * 3 + ["P02"] * 2
+        dat.close()
+
+    def test_export_parallel(self, db_test_path, export_dirs):
+        dat = kldb.DatabaseManager(db_test_path)
+        add_export_test_data(dat)
+        # Test exporting participant files using multiple worker processes
+        dat.export(jobs=2)
+        outfiles = sorted(os.listdir(P.incomplete_data_dir))
+        assert len(outfiles) == 3
+        _, rows = read_export(os.path.join(P.incomplete_data_dir, outfiles[1]))
+        assert [r[0] for r in rows] == ["P02"] * 2
+        # Test that exports from worker processes are logged in the database
+        assert len(dat.select('export_history')) == 3
+        dat.close()
+
+    def test_export_npz(self, db_test_path, export_dirs):
+        dat = kldb.DatabaseManager(db_test_path)
+        add_export_test_data(dat)
+        # Test exporting typed columns to a NumPy .npz file
+        dat.export(multi_file=False, fmt='npz')
+        outfile = os.path.join(export_dirs, "test_all_trials.npz")
+        data = np.load(outfile)
+        assert list(data.keys())[0] == "participant"
+        assert list(data['participant']) == ["P01"] * 3 + ["P02"] * 2
+        assert data['trial_num'].dtype == np.int64
+        assert list(data['trial_num']) == [1, 2, 3, 1, 2]
+        assert list(data.keys())[-1] == "klibs_header"
+        assert str(data['klibs_header']).startswith("#")
+        # Test that repeated column names are kept as separate arrays
+        outfile = os.path.join(export_dirs, "dupes.npz")
+        kldb._write_columnar_file(
+            outfile, 'npz', "#test", ["a", "b", "a", "klibs_header"],
+            [klibs.PY_INT, klibs.PY_STR, klibs.PY_FLOAT, klibs.PY_INT], [(1, "x", 0.5, 2)]
+        )
+        data = np.load(outfile)
+        assert list(data.keys()) == ["a", "b", "a_2", "klibs_header_2", "klibs_header"]
+        assert data['a_2'][0] == 0.5 and str(data['klibs_header']) == "#test"
+        # Test exception on invalid export format
+        with pytest.raises(ValueError):
+            dat.export(fmt='xlsx')
+        dat.close()
+
+    def test_export_arrow(self, db_test_path, export_dirs):
+        pa = pytest.importorskip("pyarrow")
+        import pyarrow.parquet as pq
+        dat = kldb.DatabaseManager(db_test_path)
+        add_export_test_data(dat)
+        # Test exporting typed columns to Parquet files
+        dat.export(fmt='parquet')
+        outfiles = sorted(os.listdir(P.incomplete_data_dir))
+        assert outfiles[0] == "p1.now_incomplete.parquet"
+        tbl = pq.read_table(os.path.join(P.incomplete_data_dir, outfiles[0]))
+        assert tbl.column_names[0] == "participant"
+        assert tbl.schema.field('age').type == pa.int64()
+        assert tbl.column('trial_num').to_pylist() == [1, 2, 3]
+        assert b'klibs_header' in tbl.schema.metadata
+        # Test exporting typed columns to an Arrow IPC file
+        dat.export(multi_file=False, fmt='arrow')
+        outfile = os.path.join(export_dirs, "test_all_trials.arrow")
+        with pa.ipc.open_file(outfile) as f:
+            tbl = f.read_all()
+        assert tbl.num_rows == 5
+        dat.close()
+
+    def test_export_incremental(self, db_test_path, export_dirs):
+        dat = kldb.DatabaseManager(db_test_path)
+        add_export_test_data(dat)
+        outfile = os.path.join(export_dirs, "test_all_trials_incremental.txt")
+        # Make sure an existing combined export doesn't affect incremental exports
+        dat.export(multi_file=False)
+        # Test that the first incremental export writes all data & logs the last row
+        dat.export(multi_file=False, incremental=True)
+        _, rows = read_export(outfile)
+        assert len(rows) == 5
+        assert dat._get_export_mark('trials:incremental') == 5
+        assert len(dat._get_exported('trials')) == 0
+        # Test that subsequent exports only append new rows to the same file
+        dat.insert(generate_data_row(2, trial=3), table='trials')
+        dat.insert(generate_data_row(3, trial=1), table='trials')
+        dat.export(multi_file=False, incremental=True)
+        assert not os.path.exists(outfile.replace(".txt", "_1.txt"))
+        _, rows = read_export(outfile)
+        assert len(rows) == 7
+        assert [r[0] for r in rows[-2:]] == ["P02", "P03"]
+        assert dat._get_export_mark('trials:incremental') == 7
+        _, rows = read_export(os.path.join(export_dirs, "test_all_trials.txt"))
+        assert len(rows) == 5
+        # Test that nothing is appended if there are no new rows
+        dat.export(multi_file=False, incremental=True)
+        _, rows = read_export(outfile)
+        assert len(rows) == 7
+        # Test that all data is re-exported if the incremental file is missing
+        os.remove(outfile)
+        dat.export(multi_file=False, incremental=True)
+        _, rows = read_export(outfile)
+        assert len(rows) == 7
+        # Test exception on incremental export to individual files
+        with pytest.raises(ValueError):
+            dat.export(incremental=True)
+        dat.close()
+
+    def test_indexes(self, db_test_path):
+        # Test that opening an older database doesn't modify its structure
+        dat = kldb.Database(db_test_path)
+        dat.query("DROP INDEX trials_participant_id_idx", commit=True)
+        dat.query("DROP TABLE frame_stats", commit=True)
+        dat.close()
+        dat = kldb.DatabaseManager(db_test_path)
+        q = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'trials'"
+        assert len(dat.query(q)) == 0
+        assert not 'frame_stats' in dat.tables
+        # Test that missing indexes and tables are added when analyzing
+        add_export_test_data(dat)
+        results = dat.analyze()
+        assert len(dat.query(q)) == 1
+        assert 'frame_stats' in dat.tables
+        assert len(results) == 5
+        for q, plan, slow in results:
+            assert len(plan) > 0
+        assert len(results[-1][2]) == 0 # export query shouldn't need a temp index
+        dat.close()
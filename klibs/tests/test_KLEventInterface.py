@@ -96,3 +96,12 @@ class TestEventManager(object):
             assert evm.before('not_an_event')
         with pytest.raises(ValueError):
             assert evm.after('not_an_event')
+
+    def test_time_until_next(self, evm):
+        with mock.patch("klibs.KLEventInterface.time", wraps=mock_time):
+            evm.start()
+            assert evm._time_until_next() == pytest.approx(1000)
+            add_time(1.05)
+            assert evm._time_until_next() == pytest.approx(50)
+            add_time(0.5)
+            assert evm._time_until_next() is None
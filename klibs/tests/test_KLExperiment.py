@@ -1,8 +1,10 @@
 import os
 import mock
 import pytest
+import numpy as np
 
 import klibs
+from klibs import P
 from klibs.KLJSON_Object import AttributeDict
 
 from conftest import get_resource_path
@@ -25,3 +27,35 @@ def test_Experiment(experiment):
         experiment.blocks = []
         experiment.database = AttributeDict({'tables': []})
         experiment.run()
+
+
+def test_prerender(experiment):
+    from klibs.KLTrialFactory import TrialIterator
+    P.prerender_workers = 1
+    trials = TrialIterator([{'size': 10}, {'size': 20}])
+    rendered = []
+    def prerender(trial):
+        rendered.append(trial['size'])
+        return {'arr': lambda: np.zeros((trial['size'], 1, 4), dtype=np.uint8)}
+
+    with mock.patch.object(experiment, 'prerender', side_effect=prerender):
+        from klibs.KLGraphics import RenderPool
+        experiment._render_pool = RenderPool()
+        # Test that the next trial's stimuli are rendered in the background
+        trial = next(trials)
+        experiment.__prerender__(trial, trials.peek())
+        assert experiment.prerendered['arr'].shape[0] == 10
+        trial = next(trials)
+        assert trials.peek() is None
+        experiment.__prerender__(trial, trials.peek())
+        assert experiment.prerendered['arr'].shape[0] == 20
+        assert rendered == [10, 20]
+        # Test that stale renders are discarded if the trial order changes
+        experiment.__prerender__({'size': 20}, {'size': 30})
+        experiment.__prerender__({'size': 40}, None)
+        assert experiment.prerendered['arr'].shape[0] == 40
+        # Test that errors from discarded renders are ignored
+        experiment.__prerender__({'size': 40}, {'size': -1})
+        experiment.__prerender__({'size': 50}, None)
+        assert experiment.prerendered['arr'].shape[0] == 50
+        experiment._render_pool.shutdown()
@@ -0,0 +1,358 @@
+import gc
+import mock
+import pytest
+import numpy as np
+
+from klibs import P
+from klibs.KLGraphics import core, NumpySurface, Scene, TextureAtlas
+from klibs.KLGraphics import KLScene, KLAtlas, KLDraw
+from klibs.KLGraphics.KLDraw import Rectangle
+
+
+@pytest.fixture
+def mock_gl():
+    cache_size = P.texture_cache_size
+    draw_cache_size = P.draw_cache_size
+    with mock.patch.object(core, 'gl') as gl, mock.patch.object(KLScene, 'gl', gl), \
+            mock.patch.object(KLScene, 'rawgl', gl), mock.patch.object(KLAtlas, 'gl', gl), \
+            mock.patch.object(KLAtlas, 'rawgl', gl):
+        gl.glGenTextures.side_effect = range(1, 1000)
+        core._textures.clear(release=False)
+        yield gl
+        core._textures.clear(release=False)
+    P.texture_cache_size = cache_size
+    P.draw_cache_size = draw_cache_size
+
+
+def test_blit_texture_cache(mock_gl):
+    KLDraw._render_cache.clear()
+    # Test that surfaces and shapes are only uploaded once
+    surf = NumpySurface(width=10, height=10, fill=(255, 0, 0))
+    rect = Rectangle(10, fill=(0, 255, 0))
+    for i in range(3):
+        core.blit(surf)
+        core.blit(rect)
+    assert mock_gl.glTexImage2D.call_count == 2
+    assert len(core._textures) == 2
+    assert core._textures.size == (10 * 10 + rect.surface_width * rect.surface_height) * 4
+
+    # Test that modified and flipped content gets uploaded again
+    surf.blit(np.zeros((2, 2, 4), dtype=np.uint8), blend=False)
+    core.blit(surf)
+    assert mock_gl.glTexImage2D.call_count == 3
+    surf.scale(20, 20)
+    core.blit(surf)
+    core.blit(surf, flip_x=True)
+    assert mock_gl.glTexImage2D.call_count == 5
+    rect.fill = (0, 0, 255)
+    core.blit(rect)
+    assert mock_gl.glTexImage2D.call_count == 6
+
+    # Test that raw arrays aren't cached
+    arr = surf.render().copy()
+    core.blit(arr)
+    core.blit(arr)
+    assert mock_gl.glTexImage2D.call_count == 8
+    assert mock_gl.glDeleteTextures.call_count >= 2
+
+    # Test that textures for deleted or replaced content are released
+    mock_gl.reset_mock() # the mock holds references to uploaded content
+    gc.collect()
+    core.blit(surf)
+    textures = len(core._textures)
+    assert textures == 4
+    # Shape textures are kept while the render cache holds their content, and are
+    # released once it's dropped from the render cache
+    del rect
+    gc.collect()
+    core.blit(surf)
+    assert len(core._textures) == textures
+    KLDraw._render_cache.clear()
+    gc.collect()
+    core.blit(surf)
+    assert len(core._textures) == textures - 2
+
+    # Test that least-recently-used textures are evicted when over budget
+    core._textures.clear()
+    P.texture_cache_size = 1
+    big1 = NumpySurface(width=400, height=400)
+    big2 = NumpySurface(width=400, height=400)
+    core.blit(big1)
+    core.blit(big2)
+    assert len(core._textures) == 1
+    assert core._textures.size == 400 * 400 * 4
+    huge = NumpySurface(width=1000, height=1000)
+    core.blit(huge)
+    assert len(core._textures) == 1
+    P.texture_cache_size = 0
+    core.blit(surf)
+    assert len(core._textures) == 1
+
+
+def test_blit_modified_content(mock_gl):
+    # Test that changes made directly to a surface's content are uploaded once the
+    # surface is invalidated, even if the array was fetched before the last blit
+    surf = NumpySurface(width=10, height=10, fill=(255, 0, 0))
+    content = surf.content
+    core.blit(surf)
+    content[0:5, :] = (0, 0, 255, 255)
+    surf.invalidate()
+    core.blit(surf)
+    assert mock_gl.glTexImage2D.call_count == 2
+    uploaded = mock_gl.glTexImage2D.call_args[0][-1]
+    assert tuple(np.asarray(uploaded)[0, 0]) == (0, 0, 255, 255)
+    core.blit(surf)
+    assert surf.content is content
+    core.blit(surf)
+    assert mock_gl.glTexImage2D.call_count == 2
+
+    # Test that replacing or transforming a surface's content is uploaded
+    surf.content = np.zeros((10, 10, 4), dtype=np.uint8)
+    core.blit(surf)
+    assert mock_gl.glTexImage2D.call_count == 3
+    surf.flip_x()
+    core.blit(surf)
+    assert mock_gl.glTexImage2D.call_count == 4
+
+
+def test_scene(mock_gl):
+    surf = NumpySurface(width=10, height=20, fill=(255, 0, 0))
+    rect = Rectangle(10, fill=(0, 255, 0))
+    scene = Scene()
+    scene.add('surf', surf, (50, 50), registration=5)
+    scene.add('rect', rect, (0, 0), visible=False)
+    scene.add('arr', surf.render().copy(), (100, 0), flip_x=True)
+    assert scene.names == ['surf', 'rect', 'arr']
+    with pytest.raises(TypeError):
+        scene.add('bad', 1)
+    with pytest.raises(ValueError):
+        scene.add('bad', surf, registration=10)
+
+    # Test that textures are uploaded once and vertices are only rebuilt as needed
+    scene.draw()
+    scene.draw()
+    assert mock_gl.glTexImage2D.call_count == 3
+    assert mock_gl.glBufferData.call_count == 1
+    assert mock_gl.glDrawArrays.call_count == 4
+    verts = scene._vertices
+    assert verts.shape == (12, 4)
+    assert tuple(verts[0]) == (45, 40, 0, 0) and tuple(verts[2]) == (55, 60, 1, 1)
+    assert tuple(verts[8]) == (100, 0, 1, 0)
+
+    # Test showing, hiding, moving, and modifying stimuli
+    scene.show('rect')
+    scene.hide('surf', 'arr')
+    assert scene.is_visible('rect') and not scene.is_visible('surf')
+    scene.move('rect', (5, 5))
+    mock_gl.reset_mock()
+    scene.draw()
+    assert mock_gl.glBufferData.call_count == 1
+    assert mock_gl.glDrawArrays.call_count == 1
+    assert tuple(scene._vertices[4][:2]) == (5, 5)
+    rect.fill = (0, 0, 255)
+    surf.scale(20, 40)
+    scene.show('surf')
+    scene.draw()
+    assert mock_gl.glTexImage2D.call_count == 2
+    assert mock_gl.glBufferData.call_count == 2
+    assert tuple(scene._vertices[2][:2]) == (60, 70)
+
+    # Test removing stimuli and releasing the scene
+    scene.remove('rect')
+    assert not 'rect' in scene and len(scene) == 2
+    with pytest.raises(KeyError):
+        scene.hide('rect')
+    scene.hide()
+    mock_gl.reset_mock()
+    scene.draw()
+    assert mock_gl.glDrawArrays.call_count == 0
+    scene.release()
+    assert mock_gl.glDeleteTextures.call_count == 2
+    assert mock_gl.glDeleteBuffers.call_count == 1
+
+
+def test_pack_shelves():
+    sizes = [(10, 10), (30, 20), (20, 20), (50, 5), (64, 64)]
+    positions = KLAtlas._pack_shelves(sizes, 64)
+    assert positions[4] == (0, 0, 0)
+    # Make sure no packed rectangles overlap or exceed their page
+    boxes = [(p, x, y, x + w, y + h) for (p, x, y), (w, h) in zip(positions, sizes)]
+    for i, (p, x1, y1, x2, y2) in enumerate(boxes):
+        assert x2 <= 64 and y2 <= 64
+        for p2, ox1, oy1, ox2, oy2 in boxes[i+1:]:
+            assert p != p2 or x2 <= ox1 or ox2 <= x1 or y2 <= oy1 or oy2 <= y1
+    assert max([p[0] for p in positions]) == 1
+    with pytest.raises(ValueError):
+        KLAtlas._pack_shelves([(65, 10)], 64)
+
+
+def test_texture_atlas(mock_gl):
+    surf = NumpySurface(width=10, height=20, fill=(255, 0, 0))
+    rect = Rectangle(10, fill=(0, 255, 0))
+    atlas = TextureAtlas(max_size=64)
+    atlas.add('surf', surf)
+    atlas.add('rect', rect)
+    atlas.add('arr', np.full((5, 5, 3), 255, dtype=np.uint8))
+    with pytest.raises(RuntimeError):
+        atlas['surf']
+    assert atlas.build() == 1
+    assert len(atlas) == 3 and 'rect' in atlas
+    with pytest.raises(KeyError):
+        atlas['nope']
+
+    # Test that the stimuli were copied into the atlas correctly
+    region = atlas['surf']
+    page = atlas.pages[region.page]
+    assert region.width == 10 and region.height == 20
+    assert np.array_equal(page[region.y:region.y+20, region.x:region.x+10], surf.content)
+    x1, y1, x2, y2 = region.uv
+    assert x1 * page.shape[1] == region.x and y2 * page.shape[0] == region.y + 20
+
+    # Test blitting regions individually and in batches
+    core.blit(atlas['surf'])
+    core.blit(atlas['rect'], 5, (50, 50))
+    assert mock_gl.glTexImage2D.call_count == 1
+    atlas.blit(['surf', 'rect', 'surf'], [(0, 0), (10, 10), (20, 20)], registration=5)
+    assert mock_gl.glDrawArrays.call_count == 1
+    assert mock_gl.glDrawArrays.call_args[0][2] == 12
+    with pytest.raises(ValueError):
+        atlas.blit(['surf'], [])
+
+    # Test that consecutive atlas regions in a scene are drawn together
+    scene = Scene()
+    scene.add('a', atlas['surf'], (0, 0))
+    scene.add('b', atlas['rect'], (20, 0))
+    scene.add('c', surf, (40, 0))
+    scene.add('d', atlas['arr'], (60, 0))
+    mock_gl.reset_mock()
+    scene.draw()
+    assert mock_gl.glDrawArrays.call_count == 3
+    assert tuple(scene._vertices[0][2:]) == region.uv[:2]
+    scene.release()
+    assert mock_gl.glDeleteTextures.call_count == 1
+    atlas.release()
+    assert mock_gl.glDeleteTextures.call_count == 2
+
+
+def test_frame_timer():
+    timer = core._FrameTimer(5)
+    assert timer.stats()['flips'] == 0 and timer.stats()['mean_interval'] is None
+    # Simulate flips at 60 Hz with one frame dropped during a slow swap
+    t = 10.0
+    for swap in [5.0, 16.0, 20.0, 36.0, 2.0]:
+        t += max(swap, 16.0) / 1000
+        timer.record(t, swap, 16.0)
+    stats = timer.stats()
+    assert stats['flips'] == 5 and stats['dropped'] == 1
+    assert stats['max_swap'] == 36.0
+    assert abs(stats['max_interval'] - 36.0) < 1e-6
+    assert abs(stats['mean_interval'] - (16 + 20 + 36 + 16) / 4.0) < 1e-6
+
+    # Test that gaps between flips outside of frame loops aren't counted as dropped
+    timer.reset()
+    for interval in [0.016, 0.050, 1.0]:
+        t += interval
+        timer.record(t, 1.0, 16.0)
+    assert timer.stats()['dropped'] == 0
+
+    # Test that frames in a frame loop are counted as dropped if drawing was slow but
+    # the swap wasn't, and that the gap before the loop isn't counted
+    timer.start_loop()
+    for interval in [0.5, 0.016, 0.050, 0.016]:
+        t += interval
+        timer.record(t, 1.0, 16.0)
+    timer.stop_loop()
+    assert timer.stats()['dropped'] == 2
+    # Test that dropped frames aren't counted if the refresh time is unknown
+    timer.record(t + 0.1, 100.0, None)
+    assert timer.stats()['dropped'] == 2
+
+    # Test that the buffer wraps around and that stats are reset per trial
+    timer.reset()
+    t += 1.0
+    for i in range(3):
+        timer.record(t + (i + 1) * 0.016, 1.0, 16.0)
+    assert timer.stats()['flips'] == 3 and timer.stats()['dropped'] == 0
+    times = timer.timestamps()
+    assert len(times) == 5 and list(times[-3:]) == [t + 0.016, t + 0.032, t + 0.048]
+    assert np.all(np.diff(times) > 0)
+
+    # Test the public frame loop and reset functions
+    core._frames.record(t + 1.0, 1.0, 16.0)
+    with core.frame_loop():
+        assert core._frames._in_loop
+    assert not core._frames._in_loop
+    core.reset_frame_stats()
+    assert core.frame_stats()['flips'] == 0
+
+
+def test_render_pool():
+    from PIL import Image
+    from klibs.KLGraphics import RenderPool, render_stimuli
+
+    # Test rendering different stimulus types to arrays
+    stimuli = {
+        'rect': Rectangle(10, fill=(0, 255, 0)),
+        'surf': lambda: NumpySurface(width=5, height=5, fill=(255, 0, 0)),
+        'img': Image.new('RGB', (4, 3)),
+        'arr': np.zeros((2, 2, 4), dtype=np.uint8),
+    }
+    rendered = render_stimuli(stimuli)
+    assert list(rendered.keys()) == list(stimuli.keys())
+    assert all(type(arr) is np.ndarray for arr in rendered.values())
+    assert rendered['surf'].shape == (5, 5, 4)
+    assert rendered['img'].shape == (3, 4, 4)
+    assert render_stimuli(None) == {}
+    with pytest.raises(TypeError):
+        render_stimuli({'bad': "text"})
+
+    # Test rendering stimuli in the background
+    pool = RenderPool()
+    future = pool.submit(lambda size: {'rect': Rectangle(size, fill=(0, 0, 255))}, 20)
+    assert future.result()['rect'].shape[0] >= 20
+    future = pool.submit(lambda: {'bad': 5})
+    with pytest.raises(TypeError):
+        future.result()
+    pool.shutdown()
+
+
+def test_draw_render_cache():
+    cache_size = P.draw_cache_size
+    KLDraw._render_cache.clear()
+
+    # Test that identical shapes share a single rendered array
+    a = Rectangle(10, fill=(255, 0, 0)).render()
+    b = Rectangle(10, fill=(255, 0, 0)).render()
+    assert a is b and not a.flags.writeable
+    assert len(KLDraw._render_cache) == 1
+    # Test that shapes using cached renders still draw their canvases when needed
+    c = Rectangle(10, fill=(255, 0, 0))
+    assert c.rendered is a
+    assert np.array_equal(np.asarray(c.canvas), a)
+    c.fill = (0, 255, 0)
+    assert not np.array_equal(c.render(), a)
+    # Test that shapes with different parameters are rendered separately
+    assert Rectangle(10, fill=(0, 255, 0)).render() is not a
+    assert Rectangle(10, fill=(255, 0, 0), rotation=45).render() is not a
+    assert KLDraw.Circle(10, fill=(255, 0, 0)).render() is not a
+    assert KLDraw.Annulus(20, 2, fill=(0, 0, 255)).render() is not \
+        KLDraw.Annulus(20, 4, fill=(0, 0, 255)).render()
+    assert len(KLDraw._render_cache) == 6
+
+    # Test that subclasses without their own cache attributes aren't cached
+    class Custom(Rectangle):
+        pass
+    assert Custom(10, fill=(255, 0, 0)).render() is not Custom(10, fill=(255, 0, 0)).render()
+
+    # Test eviction of least-recently used shapes and disabling the cache
+    P.draw_cache_size = a.nbytes * 1.5 / (1024 * 1024)
+    KLDraw._render_cache.clear()
+    a = Rectangle(10, fill=(255, 0, 0)).render()
+    Rectangle(10, fill=(0, 255, 0)).render()
+    assert len(KLDraw._render_cache) == 1
+    assert Rectangle(10, fill=(255, 0, 0)).render() is not a
+    P.draw_cache_size = 0
+    KLDraw._render_cache.clear()
+    Rectangle(10, fill=(255, 0, 0)).render()
+    assert len(KLDraw._render_cache) == 0
+    P.draw_cache_size = cache_size
@@ -100,6 +100,41 @@ def test_copy():
     surf.content[0][0][0] = 255
     assert surf.content[0][0][0] != surf_copy.content[0][0][0]
 
+    # Test that copies share content until modified (copy-on-write)
+    surf_copy = surf.copy()
+    assert surf_copy.render() is surf.render()
+    surf_copy.blit(np.zeros((10, 10, 4), dtype=np.uint8), blend=False)
+    assert surf_copy.render() is not surf.render()
+    assert surf.content[0][0][0] == 255 and surf_copy.content[0][0][0] == 0
+    surf_copy = surf.copy()
+    surf.mask(np.zeros((10, 10), dtype=np.uint8), invert=False)
+    assert surf.content[0][0][3] == 0 and surf_copy.content[0][0][3] == 255
+
+
+def test_shared_content(tmpdir):
+
+    # Test that RGBA arrays are wrapped without copying, and copied before modifying
+    arr = maketestsurface()
+    surf = NumpySurface(arr)
+    assert surf.render() is arr
+    surf.blit(np.zeros((10, 10, 4), dtype=np.uint8), location=(0, 0), blend=False)
+    assert surf.render() is not arr and arr[0][0][0] == 255
+
+    # Test that read-only memory-mapped arrays can be used as surface content
+    path = str(tmpdir.join("test.npy"))
+    np.save(path, maketestsurface())
+    mapped = np.load(path, mmap_mode='r')
+    surf = NumpySurface(mapped)
+    assert surf.render() is mapped
+    surf.mask(np.zeros((10, 10), dtype=np.uint8), invert=False)
+    assert surf.content[0][0][3] == 0 and surf.content[0][0][0] == 255
+    assert mapped[0][0][3] == 255
+
+    # Test loading memory-mapped RGB arrays from .npy files
+    np.save(path, maketestsurface()[:, :, :3])
+    surf = NumpySurface(path)
+    assert surf.height == 100 and surf.width == 100 and surf.content[0][0][3] == 255
+
 
 def test_blit():
 
@@ -154,6 +189,50 @@ def test_blit():
         surf.blit(surf_clear, location=(0, 0), clip=False)
 
 
+def test_blit_alpha_composite():
+    from klibs.KLGraphics import alpha_composite
+    np.random.seed(1)
+    base = np.random.randint(0, 256, (100, 100, 4), dtype=np.uint8)
+    src = np.random.randint(0, 256, (40, 40, 4), dtype=np.uint8)
+
+    # Test that blending matches Pillow for sparse and dense semi-transparent sources
+    for mostly_solid in [True, False]:
+        if mostly_solid:
+            src[:, :15, 3] = 0
+            src[:, 25:, 3] = 255
+        img = Image.fromarray(base)
+        img.alpha_composite(Image.fromarray(src), (30, 20))
+        expected = np.asarray(img).astype(int)
+        surf = NumpySurface(base)
+        content = surf.content
+        surf.blit(src, location=(30, 20), blend=True)
+        assert surf.content is content # should blend in place
+        assert np.abs(surf.content - expected).max() <= 1
+        assert np.array_equal(surf.content[:20, :], base[:20, :])
+
+    # Test blending directly between interior (non-contiguous) regions of larger arrays
+    dest = base.copy()
+    region = dest[10:50, 20:60, :]
+    src_region = np.random.randint(0, 256, (60, 60, 4), dtype=np.uint8)[5:45, 10:50, :]
+    src_region[:, :16, 3] = 0
+    src_region[:, 25:, 3] = 255
+    assert not (region.flags.c_contiguous or src_region.flags.c_contiguous)
+    img = Image.fromarray(base)
+    img.alpha_composite(Image.fromarray(np.ascontiguousarray(src_region)), (20, 10))
+    assert alpha_composite(region, src_region) is region
+    assert np.abs(dest.astype(int) - np.asarray(img)).max() <= 1
+    assert np.array_equal(dest[:10], base[:10]) and np.array_equal(dest[:, 60:], base[:, 60:])
+
+    # Test compositing premultiplied content
+    dest = np.array([[[100, 50, 0, 200]]], dtype=np.uint8)
+    src = np.array([[[64, 0, 0, 128]]], dtype=np.uint8)
+    out = alpha_composite(dest, src, premultiplied=True)
+    assert out is dest
+    assert list(dest[0, 0]) == [64 + 50, 25, 0, 128 + 100]
+    with pytest.raises(ValueError):
+        alpha_composite(dest, np.zeros((2, 2, 4), dtype=np.uint8))
+
+
 def test_mask():
 
     # Initialize test surface and masks
@@ -198,6 +277,31 @@ def test_mask():
         assert surf.content[0][0][3] == 0 and surf.content[25][25][3] == 255
         assert surf.content[-1][-1][3] == (0 if complete else 255)
 
+    # Test that masking is done in place and only within the mask region
+    surf = surface.copy()
+    content = surf.content
+    version = surf._version
+    surf.mask(nps_mask, registration=5, location=(110, 50))
+    assert surf.render() is content and surf._version == version + 1
+    assert surf.content[50][85][3] == 0 and surf.content[50][85][0] == 255
+    assert surf.content[50][84][3] == 255 and surf.content[24][99][3] == 255
+    surf.mask(nps_mask, registration=7, location=(200, 200))
+    assert surf.content[99][99][3] == 255
+    surf.mask(nps_mask, registration=7, location=(200, 200), complete=True)
+    assert surf.content[:, :, 3].max() == 0
+
+    # Test that inverted surface/shape masks are cached
+    from klibs.KLGraphics import KLNumpySurface as kln
+    kln._masks.clear()
+    for i in range(3):
+        surface.copy().mask(nps_mask)
+        surface.copy().mask(circle_mask)
+    assert len(kln._masks) == 2
+    nps_mask.blit(np.zeros((10, 10, 4), dtype=np.uint8), blend=False)
+    surf = surface.copy().mask(nps_mask)
+    assert len(kln._masks) == 3
+    assert surf.content[0][0][3] == 255 and surf.content[10][10][3] == 0
+
     # Test exception for invalid mask type
     with pytest.raises(TypeError):
         surf = surface.copy()
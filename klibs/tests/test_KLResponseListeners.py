@@ -1,6 +1,7 @@
 import pytest
 import mock
 
+from klibs import P
 from klibs.KLGraphics import KLDraw as kld
 from klibs.KLResponseListeners import (
     KeypressListener, MouseButtonListener, ColorWheelListener,
@@ -56,6 +57,26 @@ class TestKeypressListener(object):
         assert not listener.listen(test_keys)
         listener.cleanup()
 
+    def test_collect_wait(self):
+        listener = KeypressListener({'z': 'left'}, timeout=2.0)
+        queues = [[], [keydown('a')], [keydown('z')]]
+        P.wait_for_input = True
+        try:
+            with mock.patch("klibs.KLResponseListeners.wait", side_effect=queues) as w:
+                with mock.patch.object(listener, '_timestamp', new=mock_timestamp):
+                    assert listener.collect()[0] == 'left'
+            # Make sure the loop waited for input instead of polling, never
+            # waiting longer than the remaining time before timing out
+            assert w.call_count == 3
+            assert all(0 < c[0][0] <= 2.0 for c in w.call_args_list)
+            # Make sure loops with callbacks still check in frequently
+            listener = KeypressListener({'z': 'left'}, loop_callback=lambda: False)
+            with mock.patch("klibs.KLResponseListeners.wait", return_value=[keydown('z')]) as w:
+                assert listener.collect()[0] == 'left'
+                assert w.call_args[0][0] <= 0.001
+        finally:
+            P.wait_for_input = False
+
 
 class TestMouseButtonListener(object):
 
@@ -63,3 +63,122 @@ def test_TextStyle(with_text_init):
     P.default_font_unit = 'deg'
     tst = TextStyle(size=1.0)
     assert tst.size_px == int(round(P.ppd * 1.0))
+
+
+def test_render_cache(with_text_init):
+    from klibs import env
+    from klibs.KLText import _text_cache
+
+    _text_cache.clear()
+    cache_size = P.text_cache_size
+    P.text_cache_size = 16
+    try:
+        # Test that repeated strings are only rendered once
+        msg1 = env.txtm.render("Hello there!")
+        msg2 = env.txtm.render("Hello there!")
+        assert msg1.render() is msg2.render()
+        assert len(_text_cache) == 1
+
+        # Test that modifying a rendered surface doesn't affect the cached text
+        original = msg2.render().copy()
+        msg1.content[0:5, 0:5] = (255, 0, 0, 255)
+        assert (env.txtm.render("Hello there!").render() == original).all()
+
+        # Test that the same text with a different style or layout is cached separately
+        env.txtm.render("Hello there!", style=TextStyle(size="20px", color=(255, 0, 0)))
+        env.txtm.render("Hello\nthere!", align="right")
+        env.txtm.render("Hello\nthere!", align="center")
+        assert len(_text_cache) == 6 # including the individual lines
+
+        # Test that text isn't cached when caching is disabled
+        _text_cache.clear()
+        P.text_cache_size = 0
+        msg1 = env.txtm.render("Hello there!")
+        msg2 = env.txtm.render("Hello there!")
+        assert msg1.render() is not msg2.render()
+        assert len(_text_cache) == 0
+    finally:
+        P.text_cache_size = cache_size
+
+
+def test_wrap_line(with_text_init):
+    from klibs import env
+    from klibs.KLText import _wrap_line, _get_text_width
+
+    font = TextStyle(size="20px")._font_ttf
+    text = b"The quick brown fox jumps over the lazy dog, " * 10
+    widths = {}
+
+    # Test that lines are filled as much as possible without exceeding the width
+    wrapped = _wrap_line(font, text, 300, widths)
+    assert len(wrapped) > 1
+    for i, line in enumerate(wrapped[:-1]):
+        assert _get_text_width(font, line) <= 300
+        next_word = wrapped[i + 1].split(b" ")[0]
+        assert _get_text_width(font, line + b" " + next_word) > 300
+    assert b" ".join(wrapped) == text
+    assert b"quick" in widths
+
+    # Test lines that don't need wrapping, extra spaces, and words wider than the line
+    assert _wrap_line(font, b"Hello there!  ", 300, {}) == [b"Hello there!  "]
+    assert _wrap_line(font, b"", 300, {}) == [b""]
+    wrapped = _wrap_line(font, b"Hello    there!", _get_text_width(font, b"Hello there!") - 1, {})
+    assert wrapped == [b"Hello", b"there!"]
+    long_word = b"Supercalifragilisticexpialidocious"
+    wrapped = _wrap_line(font, b"A " + long_word + b" B", 100, {})
+    assert b"".join(wrapped[1:-1]) == long_word
+    assert all(_get_text_width(font, line) <= 100 for line in wrapped)
+
+    # Test wrapping multi-line text
+    msg = env.txtm.render(b"Hello there!\n\n" + text, max_width=300)
+    assert msg.width == 300
+
+
+def test_shared_fonts(with_text_init):
+    from klibs.KLText import _fonts
+
+    # Test that fonts are only opened when first needed
+    n_fonts = len(_fonts)
+    style1 = TextStyle(font="Roboto-Medium", size="33px")
+    style2 = TextStyle(font="Roboto-Medium", size="33px", color=(255, 0, 0))
+    assert len(_fonts) == n_fonts
+
+    # Test that styles with the same font and size share a font handle
+    font = style1._font_ttf
+    assert len(_fonts) == n_fonts + 1
+    assert style2._font_ttf is font
+    assert TextStyle(font="Roboto-Medium", size="34px")._font_ttf is not font
+
+    # Test that styles with sizes between whole points don't share rendered text
+    style3 = TextStyle(font="Roboto-Medium", size="33pt")
+    style4 = TextStyle(font="Roboto-Medium", size="33.6pt")
+    assert style3._font_ttf is style4._font_ttf
+    assert style3._key != style4._key
+
+
+def test_preload(with_text_init):
+    from klibs import env
+    from klibs.KLText import _text_cache
+
+    _text_cache.clear()
+    cache_size = P.text_cache_size
+    P.text_cache_size = 1
+    try:
+        # Test that preloaded text is cached
+        texts = ["Press space to continue.", "Too slow!", 12345]
+        assert env.txtm.preload(texts) == 3
+        preloaded = env.txtm.render("Too slow!").render()
+        assert not preloaded.flags.writeable
+
+        # Test that preloaded text isn't dropped to make room for new text
+        for i in range(200):
+            env.txtm.render("Trial {0} of 200".format(i))
+        assert env.txtm.render("Too slow!").render() is preloaded
+        assert _text_cache.size <= 1024 * 1024
+
+        # Test that nothing is preloaded if caching is disabled
+        P.text_cache_size = 0
+        assert env.txtm.preload(texts) == 0
+    finally:
+        P.text_cache_size = cache_size
+        _text_cache.clear()
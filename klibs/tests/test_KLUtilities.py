@@ -0,0 +1,84 @@
+import pytest
+import numpy as np
+
+from klibs import P
+from klibs import KLUtilities as utils
+
+
+def test_rotate_points():
+    pts = [(10, 0), (0, 5), (-3, -4)]
+    rotated = utils.rotate_points(pts, (0, 0), 90)
+    assert rotated == [(0.0, 10.0), (-5.0, 0.0), (4.0, -3.0)]
+    flat = utils.rotate_points([10, 0, 0, 5], (0, 0), 90, clockwise=False, flat=True)
+    assert flat == [0.0, -10.0, 5.0, 0.0]
+    # Test the array version with a non-zero origin
+    arr = utils.rotate_points_array(np.array([[2.0, 1.0], [1.0, 2.0]]), (1, 1), 180)
+    assert isinstance(arr, np.ndarray) and arr.shape == (2, 2)
+    assert np.allclose(arr, [[0, 1], [1, 0]])
+    # Test that long lists (rotated with NumPy) match short ones (rotated in Python)
+    many = [(i, i % 7) for i in range(utils._ROTATE_ARRAY_MIN * 2)]
+    rotated = utils.rotate_points(many, (3, 2), 33)
+    assert rotated[:5] == utils.rotate_points(many[:5], (3, 2), 33)
+    assert all(type(p) is tuple and len(p) == 2 for p in rotated)
+    flat = [v for p in many for v in p]
+    assert utils.rotate_points(flat, (3, 2), 33, flat=True)[:10] == \
+        utils.rotate_points(flat[:10], (3, 2), 33, flat=True)
+
+
+def test_translate_points():
+    pts = [(10, 0), (0, 5)]
+    assert utils.translate_points(pts, (1, -2)) == [(11, -2), (1, 3)]
+    assert utils.translate_points([10, 0, 0, 5], (1, -2), flat=True) == [11, -2, 1, 3]
+    arr = utils.translate_points_array(np.array(pts), (1, -2))
+    assert np.array_equal(arr, [[11, -2], [1, 3]])
+    # Test that integer points stay integers unless the delta is a float
+    assert all(type(v) is int for v in utils.translate_points(pts, (1, -2))[0])
+    assert arr.dtype.kind == 'i'
+    assert utils.translate_points(pts, (0.5, 0)) == [(10.5, 0.0), (0.5, 5.0)]
+    assert utils.translate_points_array(np.array(pts), (0.5, 0)).dtype.kind == 'f'
+    # Test that arrays can be passed to the list version
+    assert utils.translate_points(np.array(pts), (1, -2)) == [(11, -2), (1, 3)]
+
+
+def test_canvas_size_from_points():
+    pts = [(-10, 5), (20, 5), (0, -5)]
+    assert utils.canvas_size_from_points(pts) == [32, 12]
+    assert utils.canvas_size_from_points([-10, 5, 20, 5, 0, -5], flat=True) == [32, 12]
+    assert utils.canvas_size_from_points(np.array(pts)) == [32, 12]
+
+
+def test_interpolated_path_len():
+    square = [(0, 0), (10, 0), (10, 10), (0, 10)]
+    assert utils.interpolated_path_len(square) == pytest.approx(40.0)
+    assert utils.interpolated_path_len(np.array(square)) == pytest.approx(40.0)
+    triangle = [(0, 0), (3, 0), (3, 4)]
+    assert utils.interpolated_path_len(triangle) == pytest.approx(12.0)
+
+
+def test_point_pos_array():
+    angles = np.arange(0, 360, 15.5)
+    pts = utils.point_pos_array((50, 50), 20, angles, rotation=10, return_int=False)
+    assert pts.shape == (len(angles), 2)
+    for i, angle in enumerate(angles):
+        expected = utils.point_pos((50, 50), 20, angle, 10, return_int=False)
+        assert np.allclose(pts[i], expected)
+    # Test integer output and clockwise angles with multiple amplitudes
+    pts = utils.point_pos_array((0, 0), [10, 20], [90, 90], clockwise=True)
+    assert pts.dtype.kind == 'i'
+    assert pts.tolist() == [[0, 10], [0, 20]]
+
+
+def test_scale():
+    screen = (P.screen_x, P.screen_y, P.screen_x_y)
+    P.screen_x, P.screen_y, P.screen_x_y = (1920, 1080, (1920, 1080))
+    try:
+        assert utils.scale((1000, 700), (1920, 1080)) == (1000, 700)
+        assert utils.scale((512, 384), (1024, 768)) == (960, 540)
+        assert utils.scale((512, 384), (1024, 768), scale=False) == (960, 540)
+        coords = np.array([(0, 0), (512, 384), (1024, 768)])
+        scaled = utils.scale_array(coords, (1024, 768))
+        assert scaled.tolist() == [[240, 0], [960, 540], [1680, 1080]]
+        for i, c in enumerate(coords.tolist()):
+            assert tuple(scaled[i]) == utils.scale(c, (1024, 768))
+    finally:
+        P.screen_x, P.screen_y, P.screen_x_y = screen
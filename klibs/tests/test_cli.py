@@ -128,6 +128,24 @@ def test_initialize_path(tmpdir):
         os.rename(os.path.join(expt_path, "ExpAssets", "tmp"), config_path)
 
 
+def test_hard_reset(tmpdir):
+    from klibs import P
+    global _input_queue
+    expt_path = create_experiment("TestExpt", str(tmpdir))
+    P.initialize_paths("TestExpt")
+    # Test that databases are removed along with any write-ahead log and journal files
+    for suffix in ["", "-wal", "-shm", ".journal"]:
+        open(P.database_path + suffix, "w").close()
+    open(P.database_backup_path, "w").close()
+    _input_queue += ["y"]
+    with patch("klibs.cli.getinput", tst_getinput):
+        with patch("klibs.cli.cso", tst_cso):
+            cli.hard_reset(expt_path)
+    for suffix in ["", "-wal", "-shm", ".journal"]:
+        assert not os.path.exists(P.database_path + suffix)
+    assert not os.path.exists(P.database_backup_path)
+
+
 @pytest.mark.skip("not implemented")
 def test_run(tmpdir):
     # NOTE: will require a lot of patching
@@ -46,7 +46,8 @@ setup(
         'PyOpenGL>=3.1.0'
     ],
     extras_require={
-        'AudioResponse': ['PyAudio>=0.2.9']
+        'AudioResponse': ['PyAudio>=0.2.9'],
+        'ColumnarExport': ['pyarrow>=1.0.0']
     }
 )
 